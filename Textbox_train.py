@@ -9,6 +9,9 @@ from tensorflow.python.ops import control_flow_ops
 import os, os.path
 import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),'..')))
+import profiling
+import step_timing
+import summary_policy
 import tf_utils
 from deployment import model_deploy
 import load_batch
@@ -23,6 +26,20 @@ tf.app.flags.DEFINE_float(
 	'loss_alpha', 1., 'Alpha parameter in the loss function.')
 tf.app.flags.DEFINE_float(
 	'negative_ratio', 3., 'Negative ratio in the loss function.')
+tf.app.flags.DEFINE_string(
+	'ohem', 'global',
+	'Hard negative mining: "global" (top negatives of the batch), '
+	'"per_image" or "histogram" (per image, fixed-cost threshold).')
+tf.app.flags.DEFINE_integer(
+	'ohem_bins', 256, 'Histogram bins of --ohem=histogram.')
+tf.app.flags.DEFINE_string(
+	'cls_loss', 'softmax',
+	'Classification loss: "softmax" (cross entropy with hard negative '
+	'mining) or "focal" (all the anchors, no sort).')
+tf.app.flags.DEFINE_float(
+	'focal_gamma', 2., 'Focusing parameter of the focal loss.')
+tf.app.flags.DEFINE_float(
+	'focal_alpha', 0.25, 'Weight of the positives in the focal loss.')
 tf.app.flags.DEFINE_float(
 	'match_threshold', 0.5, 'Matching threshold in the loss function.')
 tf.app.flags.DEFINE_string(
@@ -47,6 +64,21 @@ tf.app.flags.DEFINE_integer(
 	'num_ps_tasks', 0,
 	'The number of parameter servers. If the value is 0, then the parameters '
 	'are handled locally by the worker.')
+tf.app.flags.DEFINE_string(
+	'job_name', '',
+	'"ps" or "worker" in a distributed training (see launch_distributed.py), '
+	'empty for a single process.')
+tf.app.flags.DEFINE_string(
+	'ps_hosts', '', 'Comma-separated host:port of the parameter servers.')
+tf.app.flags.DEFINE_string(
+	'worker_hosts', '', 'Comma-separated host:port of the workers.')
+tf.app.flags.DEFINE_boolean(
+	'sync_replicas', True,
+	'With --job_name, aggregate the gradients of the workers with '
+	'SyncReplicasOptimizer instead of asynchronous updates.')
+tf.app.flags.DEFINE_integer(
+	'replicas_to_aggregate', 0,
+	'Gradients aggregated by every synchronous update, 0 for all the workers.')
 tf.app.flags.DEFINE_integer(
 	'num_readers', 4,
 	'The number of parallel readers that read data from the dataset.')
@@ -106,6 +138,35 @@ tf.app.flags.DEFINE_float(
 	'The momentum for the MomentumOptimizer and RMSPropOptimizer.')
 tf.app.flags.DEFINE_float('rmsprop_momentum', 0.9, 'Momentum.')
 tf.app.flags.DEFINE_float('rmsprop_decay', 0.9, 'Decay term for RMSProp.')
+tf.app.flags.DEFINE_integer(
+	'steps_per_run', 1,
+	'Number of training steps run by one session.run, in a tf.while_loop. '
+	'Summaries and checkpoints are written between two runs.')
+tf.app.flags.DEFINE_boolean(
+	'step_timing', False,
+	'Log the step time split into input wait, forward/backward, optimizer '
+	'apply, summaries and checkpoints, and the input queues fill ratios, '
+	'to TensorBoard and <train_dir>/step_time.log.')
+tf.app.flags.DEFINE_integer(
+	'step_timing_trace_steps', 50,
+	'With --step_timing, one step every n runs with a full trace.')
+tf.app.flags.DEFINE_integer(
+	'profile_every_n_steps', 0,
+	'Profile one step every n with a full trace: Chrome trace and op time '
+	'table by name scope in --profile_dir. 0 to disable.')
+tf.app.flags.DEFINE_string(
+	'profile_dir', '',
+	'Directory of the profiles, <train_dir>/profile by default.')
+tf.app.flags.DEFINE_string(
+	'summary_policy', '',
+	'Summaries by category, written with the train op runs: a preset, '
+	'"debug", "standard" or "production", optionally followed by '
+	'overrides, e.g. "standard,histograms=5000,histogram_samples=1000". '
+	'Empty for all the summaries every --save_summaries_secs.')
+tf.app.flags.DEFINE_integer(
+	'accumulate_steps', 1,
+	'Number of batches whose gradients are summed before one update: the '
+	'effective batch is batch_size * num_clones * accumulate_steps.')
 
 # =========================================================================== #
 # Learning Rate Flags.
@@ -133,6 +194,14 @@ tf.app.flags.DEFINE_float(
 tf.app.flags.DEFINE_boolean(
 	'use_batch', True,
 	'Wheather use batch_norm or not')
+tf.app.flags.DEFINE_boolean(
+	'merge_heads', False,
+	'Compute the class and location predictions with one convolution per '
+	'feature layer. Convert separate-heads checkpoints with export_model.py.')
+tf.app.flags.DEFINE_boolean(
+	'recompute', False,
+	'Keep only the outputs of the conv1-conv4 VGG blocks for the backward '
+	'pass and recompute the other activations: less memory, slower step.')
 tf.app.flags.DEFINE_boolean(
 	'use_hard_neg', True,
 	'Wheather use use_hard_neg or not')
@@ -151,6 +220,15 @@ tf.app.flags.DEFINE_string(
 	'dataset_split_name', 'train', 'The name of the train/test split.')
 tf.app.flags.DEFINE_string(
 	'dataset_dir', None, 'The directory where the dataset files are stored.')
+tf.app.flags.DEFINE_boolean(
+	'packed_bbox', False,
+	'Whether the tfrecords store the boxes as one packed float32 blob.')
+tf.app.flags.DEFINE_string(
+	'compression', '',
+	'Compression of the tfrecords: "", "GZIP" or "ZLIB".')
+tf.app.flags.DEFINE_string(
+	'data_format', 'NHWC',
+	'Layout of the network input: "NHWC" or "NCHW" (faster on CPU with MKL).')
 tf.app.flags.DEFINE_integer(
 	'labels_offset', 0,
 	'An offset for the labels in the dataset. This flag is primarily used to '
@@ -199,9 +277,41 @@ FLAGS = tf.app.flags.FLAGS
 def main(_):
 	if not FLAGS.dataset_dir:
 		raise ValueError('You must supply the dataset directory with --dataset_dir')
+	if FLAGS.steps_per_run > 1 and FLAGS.accumulate_steps > 1:
+		raise ValueError('--steps_per_run and --accumulate_steps are exclusive')
+	if FLAGS.steps_per_run > 1 and FLAGS.job_name:
+		raise ValueError('--steps_per_run only runs in a single process')
+	policy = summary_policy.parse_policy(FLAGS.summary_policy)
 
 	tf.logging.set_verbosity(tf.logging.DEBUG)
 
+	# Distributed training: the cluster is given by the host lists.
+	master = ''
+	num_replicas = FLAGS.worker_replicas
+	num_ps_tasks = FLAGS.num_ps_tasks
+	device_filters = None
+	# A single process is its own chief, with local updates.
+	is_chief = True
+	sync_replicas = False
+	if FLAGS.job_name:
+		ps_hosts = [h for h in FLAGS.ps_hosts.split(',') if h]
+		worker_hosts = [h for h in FLAGS.worker_hosts.split(',') if h]
+		if not ps_hosts or not worker_hosts:
+			raise ValueError('--job_name needs both --ps_hosts and --worker_hosts')
+		cluster = tf.train.ClusterSpec({'ps': ps_hosts, 'worker': worker_hosts})
+		server = tf.train.Server(cluster, job_name=FLAGS.job_name,
+								 task_index=FLAGS.task)
+		if FLAGS.job_name == 'ps':
+			server.join()
+			return
+		master = server.target
+		num_replicas = len(worker_hosts)
+		num_ps_tasks = len(ps_hosts)
+		# A worker only talks to the parameter servers.
+		device_filters = ['/job:ps', '/job:worker/task:%d' % FLAGS.task]
+		is_chief = FLAGS.task == 0
+		sync_replicas = FLAGS.sync_replicas and num_replicas > 1
+
 	with tf.Graph().as_default():
 		######################
 		# Config model_deploy#
@@ -210,8 +320,8 @@ def main(_):
 			num_clones=FLAGS.num_clones,
 			clone_on_cpu=FLAGS.clone_on_cpu,
 			replica_id=FLAGS.task,
-			num_replicas=FLAGS.worker_replicas,
-			num_ps_tasks=FLAGS.num_ps_tasks)
+			num_replicas=num_replicas,
+			num_ps_tasks=num_ps_tasks)
 
 		# Create global_step
 		with tf.device(deploy_config.variables_device()):
@@ -227,22 +337,34 @@ def main(_):
 		anchors = net.anchors(out_shape)
 
 		# create batch dataset
+		# Every clone of every replica has its own input pipeline, reading
+		# its own subset of the record files.
+		num_workers = num_replicas * deploy_config.num_clones
+		batch_queues = []
 		with tf.device(deploy_config.inputs_device()):
-			b_image, b_glocalisations, b_gscores = \
-			load_batch.get_batch(FLAGS.dataset_dir,
-								 FLAGS.num_readers,
-								 FLAGS.batch_size,
-								 out_shape,
-								 net,
-								 anchors,
-								 FLAGS,
-								 file_pattern = FLAGS.file_pattern,
-								 is_training = True,
-								 shuffe = FLAGS.shuffle_data)
-				
-			batch_queue = slim.prefetch_queue.prefetch_queue(
-				tf_utils.reshape_list([b_image, b_glocalisations, b_gscores]),
-				capacity=2 * deploy_config.num_clones)
+			for i in range(deploy_config.num_clones):
+				b_image, b_glocalisations, b_gscores = \
+				load_batch.get_batch(FLAGS.dataset_dir,
+									 FLAGS.num_readers,
+									 FLAGS.batch_size,
+									 out_shape,
+									 net,
+									 anchors,
+									 FLAGS,
+									 file_pattern = FLAGS.file_pattern,
+									 is_training = True,
+									 shuffe = FLAGS.shuffle_data,
+									 packed_bbox = FLAGS.packed_bbox,
+									 compression = FLAGS.compression,
+									 data_format = FLAGS.data_format,
+									 worker_index = FLAGS.task * deploy_config.num_clones + i,
+									 num_workers = num_workers)
+					
+				batch_queues.append(slim.prefetch_queue.prefetch_queue(
+					tf_utils.reshape_list([b_image, b_glocalisations, b_gscores]),
+					capacity=2))
+		# Clone i gets queue i, see create_clones per_clone_args.
+		clone_queues = [[batch_queue] for batch_queue in batch_queues]
 
 
 		# =================================================================== #
@@ -259,22 +381,33 @@ def main(_):
 				tf_utils.reshape_list(batch_queue.dequeue(), batch_shape)
 
 			# Construct SSD network.
-			arg_scope = net.arg_scope(weight_decay=FLAGS.weight_decay)
+			arg_scope = net.arg_scope(weight_decay=FLAGS.weight_decay,
+									  data_format=FLAGS.data_format)
 			with slim.arg_scope(arg_scope):
 				localisations, logits, end_points = \
-					net.net(b_image, is_training=True, use_batch=FLAGS.use_batch)
+					net.net(b_image, is_training=True, use_batch=FLAGS.use_batch,
+							merge_heads=FLAGS.merge_heads,
+							recompute=FLAGS.recompute)
+			if policy is not None and policy['images']:
+				summary_policy.image('input_images', b_image, FLAGS.data_format)
 			# Add loss function.
 			net.losses(logits, localisations,
 							   b_glocalisations, b_gscores,
 							   negative_ratio=FLAGS.negative_ratio,
 							   use_hard_neg=FLAGS.use_hard_neg,
 							   alpha=FLAGS.loss_alpha,
-							   label_smoothing=FLAGS.label_smoothing)
+							   label_smoothing=FLAGS.label_smoothing,
+							   ohem=FLAGS.ohem,
+							   ohem_bins=FLAGS.ohem_bins,
+							   cls_loss=FLAGS.cls_loss,
+							   focal_gamma=FLAGS.focal_gamma,
+							   focal_alpha=FLAGS.focal_alpha)
 			return end_points
 
 		
 
-		clones = model_deploy.create_clones(deploy_config, clone_fn, [batch_queue])
+		clones = model_deploy.create_clones(deploy_config, clone_fn,
+											per_clone_args=clone_queues)
 		first_clone_scope = deploy_config.clone_scope(0)
 
 		# Gather summaries.
@@ -284,10 +417,13 @@ def main(_):
 		update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS, first_clone_scope)
 
 		
+		histograms = summary_policy.enabled(policy, 'histograms')
+		histogram_samples = policy['histogram_samples'] if policy else 0
 		end_points = clones[0].outputs
-		for end_point in end_points:
+		for end_point in end_points if histograms else []:
 			x = end_points[end_point]
-			summaries.add(tf.summary.histogram('activations/' + end_point, x))
+			summaries.add(summary_policy.histogram('activations/' + end_point, x,
+												   histogram_samples))
 			#summaries.add(tf.summary.scalar('sparsity/' + end_point,
 			#								tf.nn.zero_fraction(x)))
 		
@@ -302,8 +438,9 @@ def main(_):
 			summaries.add(tf.summary.scalar(loss.op.name, loss))
 
 		
-		for variable in slim.get_model_variables():
-			summaries.add(tf.summary.histogram(variable.op.name, variable))
+		for variable in slim.get_model_variables() if histograms else []:
+			summaries.add(summary_policy.histogram(variable.op.name, variable,
+												   histogram_samples))
 		
 		#################################
 		# Configure the moving averages #
@@ -324,8 +461,17 @@ def main(_):
 															 global_step)
 			optimizer = tf_utils.configure_optimizer(FLAGS, learning_rate)
 			summaries.add(tf.summary.scalar('learning_rate', learning_rate))
-
-		if FLAGS.moving_average_decay:
+			if sync_replicas:
+				# Every update aggregates the gradients of the workers, the
+				# moving averages are updated by the chief.
+				optimizer = tf.train.SyncReplicasOptimizer(
+					optimizer,
+					replicas_to_aggregate=FLAGS.replicas_to_aggregate or num_replicas,
+					total_num_replicas=num_replicas,
+					variable_averages=variable_averages,
+					variables_to_average=moving_average_variables)
+
+		if FLAGS.moving_average_decay and not sync_replicas:
 			# Update ops executed locally by trainer.
 			update_ops.append(variable_averages.apply(moving_average_variables))
 
@@ -341,8 +487,22 @@ def main(_):
 		#summaries.add(tf.summary.scalar('total_loss', total_loss))
 
 		# Create gradient updates.
-		grad_updates = optimizer.apply_gradients(clones_gradients,
-												 global_step=global_step)
+		train_step_fn = slim.learning.train_step
+		if FLAGS.accumulate_steps > 1:
+			# Batch norm updates run on every micro-step, the moving
+			# averages with the update only.
+			bn_update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS,
+											  first_clone_scope)
+			update_ops = [op for op in update_ops if op not in bn_update_ops]
+			accumulate_op, grad_updates = tf_utils.accumulate_gradients(
+				optimizer, clones_gradients, FLAGS.accumulate_steps,
+				global_step=global_step, update_ops=bn_update_ops)
+			train_step_fn = tf_utils.accumulate_train_step_fn(
+				control_flow_ops.with_dependencies([accumulate_op], total_loss),
+				FLAGS.accumulate_steps)
+		else:
+			grad_updates = optimizer.apply_gradients(clones_gradients,
+													 global_step=global_step)
 		update_ops.append(grad_updates)
 
 		update_op = tf.group(*update_ops)
@@ -357,32 +517,108 @@ def main(_):
 		# Merge all summaries together.
 		summary_op = tf.summary.merge(list(summaries), name='summary_op')
 
+		if FLAGS.steps_per_run > 1:
+			def loop_step():
+				# The clones are built again inside the loop, on their own
+				# batches, reusing the variables and the optimizer slots.
+				regularization_loss = tf_utils.l2_regularization_loss(
+					FLAGS.weight_decay)
+				with tf_utils.loop_collections():
+					with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+						loop_clones = model_deploy.create_clones(
+							deploy_config, clone_fn,
+							per_clone_args=clone_queues)
+					loop_update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS,
+														loop_clones[0].scope)
+					loop_loss, loop_gradients = model_deploy.optimize_clones(
+						loop_clones,
+						optimizer,
+						regularization_losses=[regularization_loss],
+						var_list=variables_to_train)
+				loop_update_ops.append(optimizer.apply_gradients(
+					loop_gradients, global_step=global_step))
+				if FLAGS.moving_average_decay:
+					loop_update_ops.append(tf_utils.moving_average_updates(
+						variable_averages, moving_average_variables,
+						global_step, FLAGS.moving_average_decay))
+				return control_flow_ops.with_dependencies(
+					[tf.group(*loop_update_ops)], loop_loss)
+			train_tensor = tf_utils.multi_step_train_op(
+				loop_step, FLAGS.steps_per_run, global_step,
+				max_number_of_steps=FLAGS.max_number_of_steps)
+
 		# =================================================================== #
 		# Kicks off the training.
 		# =================================================================== #
 		gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=FLAGS.gpu_memory_fraction)
 		config = tf.ConfigProto(gpu_options=gpu_options,
 								log_device_placement=False,
-								allow_soft_placement = True)
+								allow_soft_placement = True,
+								device_filters=device_filters)
 		saver = tf.train.Saver(max_to_keep=5,
 							   keep_checkpoint_every_n_hours=1.0,
 							   write_version=2,
 							   pad_step_number=False)
 
+		if policy is not None:
+			# The summaries are fetched with the train op, by the chief.
+			if is_chief:
+				train_step_fn = summary_policy.SummaryPolicy(
+					FLAGS.train_dir, list(summaries), policy,
+					train_step_fn=train_step_fn,
+					steps_per_run=FLAGS.steps_per_run)
+			summary_op = None
+
+		save_summaries_secs = FLAGS.save_summaries_secs
+		save_interval_secs = FLAGS.save_interval_secs
+		log_every_n_steps = FLAGS.log_every_n_steps
+		if FLAGS.steps_per_run > 1:
+			# The global step moves by steps_per_run.
+			log_every_n_steps = FLAGS.steps_per_run * \
+				max(1, log_every_n_steps // FLAGS.steps_per_run)
+		if FLAGS.step_timing:
+			# The timer runs the summaries and the checkpoints itself.
+			train_step_fn = step_timing.StepTimer(
+				FLAGS.train_dir if is_chief else
+				os.path.join(FLAGS.train_dir, 'worker_%d' % FLAGS.task),
+				train_step_fn=train_step_fn,
+				summary_op=summary_op if is_chief else None,
+				saver=saver if is_chief else None,
+				save_summaries_secs=save_summaries_secs,
+				save_interval_secs=save_interval_secs,
+				trace_every_n_steps=FLAGS.step_timing_trace_steps,
+				log_every_n_steps=log_every_n_steps // FLAGS.steps_per_run)
+			save_summaries_secs = save_interval_secs = 0
+		elif FLAGS.steps_per_run > 1:
+			# Summaries and checkpoints between two runs of the loop.
+			train_step_fn = tf_utils.boundary_train_step_fn(
+				FLAGS.train_dir, summary_op, saver,
+				save_summaries_secs, save_interval_secs)
+			save_summaries_secs = save_interval_secs = 0
+
+		if FLAGS.profile_every_n_steps:
+			profile_dir = FLAGS.profile_dir or os.path.join(FLAGS.train_dir, 'profile')
+			if not is_chief:
+				profile_dir = os.path.join(profile_dir, 'worker_%d' % FLAGS.task)
+			train_step_fn = profiling.Profiler(
+				profile_dir, FLAGS.profile_every_n_steps,
+				train_step_fn=train_step_fn)
+
 		slim.learning.train(
 			train_tensor,
 			logdir=FLAGS.train_dir,
-			master='',
-			is_chief=True,
+			master=master,
+			is_chief=is_chief,
 			init_fn=tf_utils.get_init_fn(FLAGS),
 			summary_op=summary_op,
 			number_of_steps=FLAGS.max_number_of_steps,
-			log_every_n_steps=FLAGS.log_every_n_steps,
-			save_summaries_secs=FLAGS.save_summaries_secs,
+			log_every_n_steps=log_every_n_steps,
+			save_summaries_secs=save_summaries_secs,
 			saver=saver,
-			save_interval_secs=FLAGS.save_interval_secs,
+			save_interval_secs=save_interval_secs,
 			session_config=config,
-			sync_optimizer=None)
+			train_step_fn=train_step_fn,
+			sync_optimizer=optimizer if sync_replicas else None)
 
 if __name__ == '__main__':
 	tf.app.run()
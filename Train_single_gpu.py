@@ -9,6 +9,9 @@ from tensorflow.python.ops import control_flow_ops
 import os, os.path
 import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),'..')))
+import profiling
+import step_timing
+import summary_policy
 import tf_utils
 import load_batch
 from nets import nets_factory
@@ -23,6 +26,20 @@ tf.app.flags.DEFINE_float(
     'loss_alpha', 1., 'Alpha parameter in the loss function.')
 tf.app.flags.DEFINE_float(
     'negative_ratio', 3., 'Negative ratio in the loss function.')
+tf.app.flags.DEFINE_string(
+    'ohem', 'global',
+    'Hard negative mining: "global" (top negatives of the batch), '
+    '"per_image" or "histogram" (per image, fixed-cost threshold).')
+tf.app.flags.DEFINE_integer(
+    'ohem_bins', 256, 'Histogram bins of --ohem=histogram.')
+tf.app.flags.DEFINE_string(
+    'cls_loss', 'softmax',
+    'Classification loss: "softmax" (cross entropy with hard negative '
+    'mining) or "focal" (all the anchors, no sort).')
+tf.app.flags.DEFINE_float(
+    'focal_gamma', 2., 'Focusing parameter of the focal loss.')
+tf.app.flags.DEFINE_float(
+    'focal_alpha', 0.25, 'Weight of the positives in the focal loss.')
 tf.app.flags.DEFINE_boolean(
     'use_hard_neg', True,
     'Wheather use use_hard_neg or not')
@@ -101,6 +118,35 @@ tf.app.flags.DEFINE_float(
     'The momentum for the MomentumOptimizer and RMSPropOptimizer.')
 tf.app.flags.DEFINE_float('rmsprop_momentum', 0.9, 'Momentum.')
 tf.app.flags.DEFINE_float('rmsprop_decay', 0.9, 'Decay term for RMSProp.')
+tf.app.flags.DEFINE_integer(
+    'steps_per_run', 1,
+    'Number of training steps run by one session.run, in a tf.while_loop. '
+    'Summaries and checkpoints are written between two runs.')
+tf.app.flags.DEFINE_boolean(
+    'step_timing', False,
+    'Log the step time split into input wait, forward/backward, optimizer '
+    'apply, summaries and checkpoints, and the input queues fill ratios, '
+    'to TensorBoard and <train_dir>/step_time.log.')
+tf.app.flags.DEFINE_integer(
+    'step_timing_trace_steps', 50,
+    'With --step_timing, one step every n runs with a full trace.')
+tf.app.flags.DEFINE_integer(
+    'profile_every_n_steps', 0,
+    'Profile one step every n with a full trace: Chrome trace and op time '
+    'table by name scope in --profile_dir. 0 to disable.')
+tf.app.flags.DEFINE_string(
+    'profile_dir', '',
+    'Directory of the profiles, <train_dir>/profile by default.')
+tf.app.flags.DEFINE_string(
+    'summary_policy', '',
+    'Summaries by category, written with the train op runs: a preset, '
+    '"debug", "standard" or "production", optionally followed by '
+    'overrides, e.g. "standard,histograms=5000,histogram_samples=1000". '
+    'Empty for all the summaries every --save_summaries_secs.')
+tf.app.flags.DEFINE_integer(
+    'accumulate_steps', 1,
+    'Number of batches whose gradients are summed before one update: the '
+    'effective batch is batch_size * accumulate_steps.')
 
 # =========================================================================== #
 # Learning Rate Flags.
@@ -128,6 +174,14 @@ tf.app.flags.DEFINE_float(
 tf.app.flags.DEFINE_boolean(
     'use_batch', True,
     'Wheather use batch_norm or not')
+tf.app.flags.DEFINE_boolean(
+    'merge_heads', False,
+    'Compute the class and location predictions with one convolution per '
+    'feature layer. Convert separate-heads checkpoints with export_model.py.')
+tf.app.flags.DEFINE_boolean(
+    'recompute', False,
+    'Keep only the outputs of the conv1-conv4 VGG blocks for the backward '
+    'pass and recompute the other activations: less memory, slower step.')
 tf.app.flags.DEFINE_boolean(
     'use_whiten', True,
     'Wheather use whiten or not,genally you can choose whiten or batchnorm tech.')
@@ -142,6 +196,15 @@ tf.app.flags.DEFINE_string(
     'dataset_split_name', 'train', 'The name of the train/test split.')
 tf.app.flags.DEFINE_string(
     'dataset_dir', None, 'The directory where the dataset files are stored.')
+tf.app.flags.DEFINE_boolean(
+    'packed_bbox', False,
+    'Whether the tfrecords store the boxes as one packed float32 blob.')
+tf.app.flags.DEFINE_string(
+    'compression', '',
+    'Compression of the tfrecords: "", "GZIP" or "ZLIB".')
+tf.app.flags.DEFINE_string(
+    'data_format', 'NHWC',
+    'Layout of the network input: "NHWC" or "NCHW" (faster on CPU with MKL).')
 tf.app.flags.DEFINE_integer(
     'labels_offset', 0,
     'An offset for the labels in the dataset. This flag is primarily used to '
@@ -192,6 +255,9 @@ FLAGS = tf.app.flags.FLAGS
 def main(_):
     if not FLAGS.dataset_dir:
         raise ValueError('You must supply the dataset directory with --dataset_dir')
+    if FLAGS.steps_per_run > 1 and FLAGS.accumulate_steps > 1:
+        raise ValueError('--steps_per_run and --accumulate_steps are exclusive')
+    policy = summary_policy.parse_policy(FLAGS.summary_policy)
 
     tf.logging.set_verbosity(tf.logging.DEBUG)
 
@@ -219,27 +285,47 @@ def main(_):
                              FLAGS,
                              file_pattern = FLAGS.file_pattern,
                              is_training = True,
-                             shuffe = FLAGS.shuffle_data)
-            
-
-
-        with tf.device(FLAGS.gpu_train):
-            #with tf.device(FLAGS.gpu_train):
-
-            arg_scope = net.arg_scope(weight_decay=FLAGS.weight_decay)
-
-            with slim.arg_scope(arg_scope):
-                localisations, logits, end_points = \
-                        net.net(b_image, is_training=True, use_batch=FLAGS.use_batch)
-            # Add loss function.
-            total_loss = net.losses(logits, localisations,
-                               b_glocalisations, b_gscores,
-                               negative_ratio=FLAGS.negative_ratio,
-                               use_hard_neg=FLAGS.use_hard_neg,
-                               alpha=FLAGS.loss_alpha,
-                               label_smoothing=FLAGS.label_smoothing)
+                             shuffe = FLAGS.shuffle_data,
+                             packed_bbox = FLAGS.packed_bbox,
+                             compression = FLAGS.compression,
+                             data_format = FLAGS.data_format)
+        if FLAGS.steps_per_run > 1:
+            # The in-graph loop dequeues a batch on every step.
+            batch_queue = slim.prefetch_queue.prefetch_queue(
+                tf_utils.reshape_list([b_image, b_glocalisations, b_gscores]),
+                capacity=2)
+            batch_shape = [1] + [len(anchors)] * 2
+            b_image, b_glocalisations, b_gscores = \
+                tf_utils.reshape_list(batch_queue.dequeue(), batch_shape)
+
+        def model_fn(b_image, b_glocalisations, b_gscores):
+            with tf.device(FLAGS.gpu_train):
+                arg_scope = net.arg_scope(weight_decay=FLAGS.weight_decay,
+                                          data_format=FLAGS.data_format)
+
+                with slim.arg_scope(arg_scope):
+                    localisations, logits, end_points = \
+                            net.net(b_image, is_training=True, use_batch=FLAGS.use_batch,
+                                    merge_heads=FLAGS.merge_heads,
+                                    recompute=FLAGS.recompute)
+                # Add loss function.
+                return net.losses(logits, localisations,
+                                  b_glocalisations, b_gscores,
+                                  negative_ratio=FLAGS.negative_ratio,
+                                  use_hard_neg=FLAGS.use_hard_neg,
+                                  alpha=FLAGS.loss_alpha,
+                                  label_smoothing=FLAGS.label_smoothing,
+                                  ohem=FLAGS.ohem,
+                                  ohem_bins=FLAGS.ohem_bins,
+                                  cls_loss=FLAGS.cls_loss,
+                                  focal_gamma=FLAGS.focal_gamma,
+                                  focal_alpha=FLAGS.focal_alpha)
+
+        total_loss = model_fn(b_image, b_glocalisations, b_gscores)
 
         # Gather summaries.
+        if policy is not None and policy['images']:
+            summary_policy.image('input_images', b_image, FLAGS.data_format)
         summaries = set(tf.get_collection(tf.GraphKeys.SUMMARIES))
         '''
         for end_point in end_points:
@@ -295,8 +381,21 @@ def main(_):
         # Variables to train.
         variables_to_train = tf_utils.get_variables_to_train(FLAGS)
         vars_grad = optimizer.compute_gradients(total_loss, variables_to_train)
-        grad_updates = optimizer.apply_gradients(vars_grad,
-                                                 global_step=global_step)
+        train_step_fn = slim.learning.train_step
+        if FLAGS.accumulate_steps > 1:
+            # Batch norm updates run on every micro-step, the moving averages
+            # with the update only.
+            bn_update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+            update_ops = [op for op in update_ops if op not in bn_update_ops]
+            accumulate_op, grad_updates = tf_utils.accumulate_gradients(
+                optimizer, vars_grad, FLAGS.accumulate_steps,
+                global_step=global_step, update_ops=bn_update_ops)
+            train_step_fn = tf_utils.accumulate_train_step_fn(
+                control_flow_ops.with_dependencies([accumulate_op], total_loss),
+                FLAGS.accumulate_steps)
+        else:
+            grad_updates = optimizer.apply_gradients(vars_grad,
+                                                     global_step=global_step)
         update_ops.append(grad_updates)
 
         update_op = tf.group(*update_ops)
@@ -304,6 +403,29 @@ def main(_):
                                                           name='train_op')
         #train_op = slim.learning.create_train_op(total_loss, optimizer, gradient_multipliers=gradient_multipliers)
 
+        if FLAGS.steps_per_run > 1:
+            def loop_step():
+                # The model is built again inside the loop, on its own batch,
+                # reusing the variables and the optimizer slots.
+                with tf_utils.loop_collections():
+                    with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+                        loop_loss = model_fn(*tf_utils.reshape_list(
+                            batch_queue.dequeue(), batch_shape))
+                    loop_update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+                loop_grads = optimizer.compute_gradients(loop_loss,
+                                                         variables_to_train)
+                loop_update_ops.append(optimizer.apply_gradients(
+                    loop_grads, global_step=global_step))
+                if FLAGS.moving_average_decay:
+                    loop_update_ops.append(tf_utils.moving_average_updates(
+                        variable_averages, moving_average_variables,
+                        global_step, FLAGS.moving_average_decay))
+                return control_flow_ops.with_dependencies(
+                    [tf.group(*loop_update_ops)], loop_loss)
+            train_op = tf_utils.multi_step_train_op(
+                loop_step, FLAGS.steps_per_run, global_step,
+                max_number_of_steps=FLAGS.max_number_of_steps)
+
 
         # =================================================================== #
         # Kicks off the training.
@@ -317,6 +439,45 @@ def main(_):
                                write_version=2,
                                pad_step_number=False)
 
+        summary_op = tf.summary.merge(list(summaries))
+        if policy is not None:
+            # The summaries are fetched with the train op.
+            train_step_fn = summary_policy.SummaryPolicy(
+                FLAGS.train_dir, list(summaries), policy,
+                train_step_fn=train_step_fn,
+                steps_per_run=FLAGS.steps_per_run)
+            summary_op = None
+
+        save_summaries_secs = FLAGS.save_summaries_secs
+        save_interval_secs = FLAGS.save_interval_secs
+        log_every_n_steps = FLAGS.log_every_n_steps
+        if FLAGS.steps_per_run > 1:
+            # The global step moves by steps_per_run.
+            log_every_n_steps = FLAGS.steps_per_run * \
+                max(1, log_every_n_steps // FLAGS.steps_per_run)
+        if FLAGS.step_timing:
+            # The timer runs the summaries and the checkpoints itself.
+            train_step_fn = step_timing.StepTimer(
+                FLAGS.train_dir,
+                train_step_fn=train_step_fn,
+                summary_op=summary_op,
+                saver=saver,
+                save_summaries_secs=save_summaries_secs,
+                save_interval_secs=save_interval_secs,
+                trace_every_n_steps=FLAGS.step_timing_trace_steps,
+                log_every_n_steps=log_every_n_steps // FLAGS.steps_per_run)
+            save_summaries_secs = save_interval_secs = 0
+        elif FLAGS.steps_per_run > 1:
+            # Summaries and checkpoints between two runs of the loop.
+            train_step_fn = tf_utils.boundary_train_step_fn(
+                FLAGS.train_dir, summary_op, saver,
+                save_summaries_secs, save_interval_secs)
+            save_summaries_secs = save_interval_secs = 0
+
+        if FLAGS.profile_every_n_steps:
+            train_step_fn = profiling.Profiler(
+                FLAGS.profile_dir or os.path.join(FLAGS.train_dir, 'profile'),
+                FLAGS.profile_every_n_steps, train_step_fn=train_step_fn)
 
         slim.learning.train(
             train_op,
@@ -324,12 +485,14 @@ def main(_):
             master='',
             is_chief=True,
             init_fn=tf_utils.get_init_fn(FLAGS),
+            summary_op=summary_op,
             number_of_steps=FLAGS.max_number_of_steps,
-            log_every_n_steps=FLAGS.log_every_n_steps,
-            save_summaries_secs=FLAGS.save_summaries_secs,
+            log_every_n_steps=log_every_n_steps,
+            save_summaries_secs=save_summaries_secs,
             saver=saver,
-            save_interval_secs=FLAGS.save_interval_secs,
+            save_interval_secs=save_interval_secs,
             session_config=config,
+            train_step_fn=train_step_fn,
             sync_optimizer=None)
 
 if __name__ == '__main__':
@@ -0,0 +1,560 @@
+"""
+Model benchmarks, on synthetic inputs so that the input pipeline is left out.
+
+--mode=data_format
+  Forward and forward+backward step time of the text box networks in NHWC
+  and NCHW layouts. NCHW inputs are transposed once, as load_batch does.
+  Plain (non MKL) TensorFlow CPU builds do not implement NCHW convolutions,
+  such configurations are reported as unsupported.
+
+--mode=heads
+  Forward latency with separate class/location heads and with merged heads
+  (--merge_heads of the training and evaluation scripts).
+
+--mode=post
+  Latency of the post-processing (decoding, selection, sort, NMS) without
+  and with the per-layer top-k pruning of --layer_top_ks, decoding every
+  anchor ('all') or only the selected ones ('selected'), on the outputs of
+  the network for random images. 'agreement' is the fraction of the
+  reference detections (all anchors, no pruning) found again
+  (jaccard >= 0.5); measure the recall impact on real data with
+  eval.py --layer_top_k.
+
+--mode=nms
+  Latency of tfe.bboxes_nms_batch (map over the images) and of the
+  vectorized tfe.bboxes_nms_batch_padded for every batch size of
+  --nms_batch_sizes, on --select_top_k random sorted boxes per image. Both
+  outputs are checked against the NumPy reference np_methods.bboxes_nms_padded.
+
+--mode=ohem
+  Step time (loss and its gradients, on random network outputs and targets)
+  of the hard negative mining modes of text_losses and of the sort-free
+  focal loss, for every batch size of --loss_batch_sizes, and check of the
+  selected negatives against a NumPy reference: 'global' and 'per_image'
+  must match exactly, 'histogram' keeps a few more negatives. 'collection'
+  checks that the LOSSES collection, what Textbox_train.py optimizes through
+  model_deploy, sums to the returned total loss.
+
+--mode=recompute
+  Training step time and peak memory of the networks without and with
+  --recompute (outputs of the conv1-conv4 VGG blocks only kept for the
+  backward pass), and their ratios.
+
+--mode=summaries
+  Training step time without summaries, then the extra time of fetching the
+  scalar, image and histogram summaries (all the activations and model
+  variables, every value or the histogram_samples sample of a preset)
+  with the train op, the time of the whole summary op run alone as the
+  Supervisor thread does, and the amortized overhead per step of every
+  preset of summary_policy.
+
+python benchmark.py --mode=data_format --model_names=text_box_300,text_box_512 --batch_size=8
+python benchmark.py --mode=heads --batch_size=1
+python benchmark.py --mode=post --layer_top_ks=0,50,100,200 --batch_size=1
+python benchmark.py --mode=nms --nms_batch_sizes=1,4,16,64
+python benchmark.py --mode=ohem --loss_batch_sizes=8,32
+python benchmark.py --mode=recompute --batch_size=8
+python benchmark.py --mode=summaries --model_names=text_box_512 --batch_size=8
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+
+import numpy as np
+import tensorflow as tf
+import tf_extended as tfe
+
+from nets import nets_factory
+from nets import np_methods
+from nets import textbox_common
+import summary_policy
+
+slim = tf.contrib.slim
+
+tf.app.flags.DEFINE_string(
+    'mode', 'data_format',
+    'Benchmark to run: "data_format", "heads", "post", "nms", "ohem", '
+    '"recompute" or "summaries".')
+tf.app.flags.DEFINE_string(
+    'model_names', 'text_box_300,text_box_512',
+    'Comma-separated networks to benchmark.')
+tf.app.flags.DEFINE_string(
+    'data_formats', 'NHWC,NCHW',
+    'Comma-separated data formats to compare.')
+tf.app.flags.DEFINE_string(
+    'device', '/cpu:0',
+    'Device the network is placed on.')
+tf.app.flags.DEFINE_integer(
+    'batch_size', 8, 'The number of samples in each batch.')
+tf.app.flags.DEFINE_integer(
+    'num_steps', 20, 'Number of timed steps per configuration.')
+tf.app.flags.DEFINE_integer(
+    'warmup_steps', 3, 'Number of steps run before timing.')
+tf.app.flags.DEFINE_integer(
+    'intra_op_threads', 0,
+    'Threads of a single op, 0 lets TensorFlow pick (number of cores).')
+tf.app.flags.DEFINE_integer(
+    'inter_op_threads', 0,
+    'Ops run in parallel, 0 lets TensorFlow pick.')
+tf.app.flags.DEFINE_boolean(
+    'use_batch', True,
+    'Wheather use batch_norm or not')
+tf.app.flags.DEFINE_string(
+    'layer_top_ks', '0,50,100,200',
+    'Comma-separated layer_top_k of detected_bboxes compared by --mode=post, '
+    '0 for no pruning.')
+tf.app.flags.DEFINE_string(
+    'nms_batch_sizes', '1,4,16,64',
+    'Comma-separated batch sizes compared by --mode=nms.')
+tf.app.flags.DEFINE_string(
+    'ohem_modes', 'global,per_image,histogram,focal',
+    'Comma-separated hard negative mining modes compared by --mode=ohem, '
+    '"focal" for the focal loss.')
+tf.app.flags.DEFINE_string(
+    'loss_batch_sizes', '8,32',
+    'Comma-separated batch sizes compared by --mode=ohem.')
+tf.app.flags.DEFINE_float(
+    'select_threshold', 0.01, 'Selection threshold.')
+tf.app.flags.DEFINE_integer(
+    'select_top_k', 400, 'Select top-k detected bounding boxes.')
+tf.app.flags.DEFINE_integer(
+    'keep_top_k', 200, 'Keep top-k detected objects.')
+tf.app.flags.DEFINE_float(
+    'nms_threshold', 0.25, 'Non-Maximum Selection threshold.')
+
+FLAGS = tf.app.flags.FLAGS
+
+
+def _session_config():
+    return tf.ConfigProto(intra_op_parallelism_threads=FLAGS.intra_op_threads,
+                          inter_op_parallelism_threads=FLAGS.inter_op_threads,
+                          allow_soft_placement=False)
+
+
+def _time_steps(sess, fetch):
+    """Return the mean and std of the step time of `fetch`, in ms.
+    """
+    for _ in range(FLAGS.warmup_steps):
+        sess.run(fetch)
+    times = []
+    for _ in range(FLAGS.num_steps):
+        start = time.time()
+        sess.run(fetch)
+        times.append(1000. * (time.time() - start))
+    return np.mean(times), np.std(times)
+
+
+def _build_net(model_name, data_format, merge_heads=False, backward=True,
+               recompute=False):
+    """Build the network on random images, return the forward and train step
+    ops.
+    """
+    net = nets_factory.get_network(model_name)()
+    shape = net.params.img_shape
+    with tf.device(FLAGS.device):
+        images = tf.random_uniform([FLAGS.batch_size, shape[0], shape[1], 3])
+        if data_format == 'NCHW':
+            images = tf.transpose(images, perm=(0, 3, 1, 2))
+        with slim.arg_scope(net.arg_scope(data_format=data_format)):
+            localisations, logits, _ = \
+                net.net(images, is_training=backward, use_batch=FLAGS.use_batch,
+                        merge_heads=merge_heads, recompute=recompute)
+        # Any scalar of all the outputs gives a full backward pass.
+        loss = tf.add_n([tf.reduce_sum(t) for t in localisations + logits])
+        grads = tf.gradients(loss, tf.trainable_variables())
+        forward = tf.group(*(localisations + logits))
+        train_step = tf.group(*grads)
+    return forward, train_step
+
+
+def _benchmark_net(model_name, data_format, merge_heads=False, backward=True):
+    """Return ((forward mean, std), (train step mean, std)) in ms. Without
+    `backward` the network is built for inference and the train step is None.
+    """
+    with tf.Graph().as_default():
+        forward, train_step = _build_net(model_name, data_format,
+                                         merge_heads=merge_heads,
+                                         backward=backward)
+        with tf.Session(config=_session_config()) as sess:
+            sess.run(tf.global_variables_initializer())
+            forward_time = _time_steps(sess, forward)
+            if not backward:
+                return forward_time, None
+            return forward_time, _time_steps(sess, train_step)
+
+
+def _peak_memory(sess, fetch):
+    """Return the peak memory in use by the allocators during one run of
+    `fetch`, in MB, sampled after every op.
+    """
+    run_metadata = tf.RunMetadata()
+    sess.run(fetch,
+             options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+             run_metadata=run_metadata)
+    peak = 0
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            for memory in node_stats.memory:
+                peak = max(peak, memory.allocator_bytes_in_use,
+                           memory.peak_bytes)
+    return peak / 2.**20
+
+
+def run_data_format():
+    results = []
+    for model_name in FLAGS.model_names.split(','):
+        for data_format in FLAGS.data_formats.split(','):
+            try:
+                forward, train_step = _benchmark_net(model_name, data_format)
+            except (tf.errors.InvalidArgumentError,
+                    tf.errors.UnimplementedError) as e:
+                print('%s %s: unsupported on %s (%s)' % (
+                    model_name, data_format, FLAGS.device, e.message.split('\n')[0]))
+                continue
+            results.append((model_name, data_format, forward, train_step))
+            print('%s %s: forward %.1f ms, forward+backward %.1f ms' % (
+                model_name, data_format, forward[0], train_step[0]))
+
+    print('\n%-14s %-6s %18s %18s' % ('model', 'format',
+                                      'forward (ms)', 'fwd+bwd (ms)'))
+    for model_name, data_format, forward, train_step in results:
+        print('%-14s %-6s %10.1f +- %5.1f %10.1f +- %5.1f' % (
+            model_name, data_format, forward[0], forward[1],
+            train_step[0], train_step[1]))
+
+
+def run_heads():
+    data_format = FLAGS.data_formats.split(',')[0]
+    print('%-14s %18s %18s %8s' % ('model', 'separate (ms)', 'merged (ms)',
+                                   'speedup'))
+    for model_name in FLAGS.model_names.split(','):
+        separate, _ = _benchmark_net(model_name, data_format,
+                                     merge_heads=False, backward=False)
+        merged, _ = _benchmark_net(model_name, data_format,
+                                   merge_heads=True, backward=False)
+        print('%-14s %10.1f +- %5.1f %10.1f +- %5.1f %7.2fx' % (
+            model_name, separate[0], separate[1], merged[0], merged[1],
+            separate[0] / merged[0]))
+
+
+def _agreement(ref_scores, ref_bboxes, scores, bboxes, threshold=0.5):
+    """Fraction of the reference detections matched by a detection.
+    """
+    found = 0
+    total = 0
+    for i in range(ref_scores.shape[0]):
+        ref = ref_bboxes[i][ref_scores[i] > 0.]
+        det = bboxes[i][scores[i] > 0.]
+        total += ref.shape[0]
+        if ref.shape[0] and det.shape[0]:
+            jaccard = np_methods.bboxes_jaccard(ref[:, np.newaxis],
+                                                det[np.newaxis])
+            found += np.sum(np.max(jaccard, axis=0) >= threshold)
+    return found / max(total, 1)
+
+
+def run_post():
+    print('%-14s %8s %9s %14s %10s' % ('model', 'top_k', 'decode',
+                                       'post (ms)', 'agreement'))
+    for model_name in FLAGS.model_names.split(','):
+        with tf.Graph().as_default():
+            net = nets_factory.get_network(model_name)()
+            shape = net.params.img_shape
+            anchors = net.anchors(shape)
+            images = tf.random_uniform([FLAGS.batch_size, shape[0], shape[1], 3],
+                                       -0.5, 0.5, seed=0)
+            with slim.arg_scope(net.arg_scope()):
+                localisations, logits, _ = \
+                    net.net(images, is_training=False, use_batch=FLAGS.use_batch)
+            predictions = [slim.softmax(l) for l in logits]
+            with tf.Session(config=_session_config()) as sess:
+                sess.run(tf.global_variables_initializer())
+                outputs = sess.run(predictions + localisations)
+        num_layers = len(predictions)
+        # Time the post-processing only, on fixed network outputs.
+        reference = None
+        for layer_top_k in [int(k) for k in FLAGS.layer_top_ks.split(',')]:
+            for decode in ['all', 'selected']:
+                with tf.Graph().as_default():
+                    inputs = [tf.constant(o) for o in outputs]
+                    with tf.device(FLAGS.device):
+                        if decode == 'all':
+                            post_anchors = None
+                            locs = net.bboxes_decode(inputs[num_layers:],
+                                                     anchors)
+                        else:
+                            post_anchors = anchors
+                            locs = inputs[num_layers:]
+                        rscores, rbboxes = net.detected_bboxes(
+                            inputs[:num_layers], locs,
+                            select_threshold=FLAGS.select_threshold,
+                            nms_threshold=FLAGS.nms_threshold,
+                            top_k=FLAGS.select_top_k,
+                            keep_top_k=FLAGS.keep_top_k,
+                            layer_top_k=layer_top_k or None,
+                            anchors=post_anchors)
+                    fetch = [rscores[1], rbboxes[1]]
+                    with tf.Session(config=_session_config()) as sess:
+                        scores, bboxes = sess.run(fetch)
+                        post = _time_steps(sess, fetch)
+                if reference is None:
+                    reference = scores, bboxes
+                agreement = _agreement(reference[0], reference[1],
+                                       scores, bboxes)
+                print('%-14s %8s %9s %7.1f +- %4.1f %9.1f%%' % (
+                    model_name, layer_top_k or 'all', decode, post[0],
+                    post[1], 100. * agreement))
+
+
+def _random_detections(batch_size, num_boxes, rng):
+    """Sorted scores and boxes, a third of them zero as after the selection.
+    """
+    scores = rng.uniform(0., 1., [batch_size, num_boxes]).astype(np.float32)
+    scores[scores < 0.33] = 0.
+    scores = -np.sort(-scores, axis=1)
+    centers = rng.uniform(0., 1., [batch_size, num_boxes, 2])
+    sizes = rng.uniform(0.01, 0.2, [batch_size, num_boxes, 2])
+    bboxes = np.concatenate([centers - sizes / 2., centers + sizes / 2.],
+                            axis=2).astype(np.float32)
+    bboxes[scores == 0.] = 0.
+    return scores, bboxes
+
+
+def run_nms():
+    rng = np.random.RandomState(0)
+    print('%-6s %18s %18s %8s %8s' % ('batch', 'map_fn (ms)', 'padded (ms)',
+                                      'speedup', 'match'))
+    for batch_size in [int(b) for b in FLAGS.nms_batch_sizes.split(',')]:
+        scores, bboxes = _random_detections(batch_size, FLAGS.select_top_k, rng)
+        ref_scores, ref_bboxes, _ = np_methods.bboxes_nms_padded(
+            scores, bboxes, FLAGS.nms_threshold, FLAGS.keep_top_k)
+        with tf.Graph().as_default():
+            with tf.device(FLAGS.device):
+                t_scores = tf.constant(scores)
+                t_bboxes = tf.constant(bboxes)
+                mapped = tfe.bboxes_nms_batch(t_scores, t_bboxes,
+                                              FLAGS.nms_threshold,
+                                              FLAGS.keep_top_k)
+                padded = tfe.bboxes_nms_batch_padded(t_scores, t_bboxes,
+                                                     FLAGS.nms_threshold,
+                                                     FLAGS.keep_top_k)[:2]
+            with tf.Session(config=_session_config()) as sess:
+                outputs = sess.run([mapped, padded])
+                mapped_time = _time_steps(sess, mapped)
+                padded_time = _time_steps(sess, padded)
+        match = all(np.allclose(o[0], ref_scores) and
+                    np.allclose(o[1], ref_bboxes) for o in outputs)
+        print('%-6d %10.1f +- %5.1f %10.1f +- %5.1f %7.2fx %8s' % (
+            batch_size, mapped_time[0], mapped_time[1], padded_time[0],
+            padded_time[1], mapped_time[0] / padded_time[0], match))
+
+
+def _np_hard_negative_mask(loss_neg, nmask, pmask, negative_ratio,
+                           per_image):
+    """NumPy reference of textbox_common.hard_negative_mask.
+    """
+    if not per_image:
+        return _np_hard_negative_mask(loss_neg.reshape([1, -1]),
+                                      nmask.reshape([1, -1]),
+                                      pmask.reshape([1, -1]),
+                                      negative_ratio,
+                                      True).reshape(loss_neg.shape)
+    mask = np.zeros_like(nmask)
+    for i in range(loss_neg.shape[0]):
+        n_neg = min(int(negative_ratio * (np.sum(pmask[i]) + 1)),
+                    loss_neg.shape[1])
+        minval = np.sort(loss_neg[i])[::-1][n_neg - 1]
+        mask[i] = np.logical_and(nmask[i], loss_neg[i] >= minval)
+    return mask
+
+
+def _random_targets(net, batch_size, rng):
+    """Random network outputs and targets with the anchor layout of `net`.
+    """
+    shape = net.params.img_shape
+    # Network output shapes: batch x anchors of a layer x 2 | 4.
+    layer_shapes = [[batch_size] + list(np.broadcast(*anchors_layer).shape)
+                    for anchors_layer in net.anchors(shape)]
+    logits = [rng.normal(0., 1., s + [2]).astype(np.float32)
+              for s in layer_shapes]
+    localisations = [rng.normal(0., 1., s + [4]).astype(np.float32)
+                     for s in layer_shapes]
+    glocalisations = [rng.normal(0., 1., s + [4]).astype(np.float32)
+                      for s in layer_shapes]
+    # A few percent of positives, unevenly spread over the images.
+    gscores = [(rng.uniform(0., 1., s) **
+                rng.uniform(5., 40., [batch_size] + [1] * (len(s) - 1))
+                ).astype(np.float32) for s in layer_shapes]
+    return logits, localisations, glocalisations, gscores
+
+
+def run_ohem():
+    rng = np.random.RandomState(0)
+    modes = FLAGS.ohem_modes.split(',')
+    print('%-14s %6s %-10s %18s %10s %10s %12s %10s' % (
+        'model', 'batch', 'loss', 'step (ms)', 'value', 'negatives',
+        'reference', 'collection'))
+    for model_name in FLAGS.model_names.split(','):
+        net = nets_factory.get_network(model_name)()
+        for batch_size in [int(b) for b in FLAGS.loss_batch_sizes.split(',')]:
+            logits, localisations, glocalisations, gscores = \
+                _random_targets(net, batch_size, rng)
+            for mode in modes:
+                with tf.Graph().as_default():
+                    with tf.device(FLAGS.device):
+                        t_logits = [tf.constant(l) for l in logits]
+                        t_localisations = [tf.constant(l) for l in localisations]
+                        if mode == 'focal':
+                            loss_args = dict(cls_loss='focal')
+                        else:
+                            loss_args = dict(use_hard_neg=True, ohem=mode)
+                        loss = net.losses(t_logits, t_localisations,
+                                          [tf.constant(g) for g in glocalisations],
+                                          [tf.constant(g) for g in gscores],
+                                          **loss_args)
+                        collection_loss = tf.add_n(tf.losses.get_losses())
+                        grads = tf.gradients(loss, t_logits + t_localisations)
+                        step = tf.group(*grads)
+                        # Selection alone, against the NumPy reference.
+                        flat_gscores = tf.concat(
+                            [tf.reshape(g, [batch_size, -1]) for g in gscores], 1)
+                        flat_logits = tf.concat(
+                            [tf.reshape(l, [batch_size, -1, 2]) for l in logits], 1)
+                        pmask = flat_gscores > net.params.match_threshold
+                        nmask = tf.logical_not(pmask)
+                        xent = tf.nn.sparse_softmax_cross_entropy_with_logits(
+                            logits=flat_logits, labels=tf.cast(pmask, tf.int32))
+                        loss_neg = tf.where(pmask, tf.zeros_like(xent), xent)
+                        if mode == 'focal':
+                            # Every negative is weighted.
+                            mask = nmask
+                        else:
+                            mask = textbox_common.hard_negative_mask(
+                                loss_neg, nmask, pmask, mode=mode)
+                    with tf.Session(config=_session_config()) as sess:
+                        loss_value, collection_value, outputs = sess.run(
+                            [loss, collection_loss,
+                             [mask, loss_neg, nmask, pmask]])
+                        step_time = _time_steps(sess, step)
+                mask, loss_neg, nmask, pmask = outputs
+                if mode == 'focal':
+                    check = '-'
+                else:
+                    reference = _np_hard_negative_mask(
+                        loss_neg, nmask, pmask, 3., per_image=(mode != 'global'))
+                    if mode == 'histogram':
+                        check = '%+.1f%%' % (100. * (mask.sum() - reference.sum())
+                                             / max(reference.sum(), 1))
+                    elif np.array_equal(mask, reference):
+                        check = 'match'
+                    else:
+                        check = '%d diff' % np.sum(mask != reference)
+                collection = ('match' if np.isclose(collection_value, loss_value,
+                                                    rtol=1e-5) else
+                              '%.4f' % collection_value)
+                print('%-14s %6d %-10s %10.1f +- %5.1f %10.4f %10d %12s %10s' % (
+                    model_name, batch_size, mode, step_time[0], step_time[1],
+                    loss_value, mask.sum(), check, collection))
+
+
+def run_recompute():
+    data_format = FLAGS.data_formats.split(',')[0]
+    print('%-14s %-10s %18s %14s' % ('model', 'recompute', 'fwd+bwd (ms)',
+                                     'peak (MB)'))
+    for model_name in FLAGS.model_names.split(','):
+        results = []
+        for recompute in [False, True]:
+            with tf.Graph().as_default():
+                _, train_step = _build_net(model_name, data_format,
+                                           recompute=recompute)
+                with tf.Session(config=_session_config()) as sess:
+                    sess.run(tf.global_variables_initializer())
+                    step_time = _time_steps(sess, train_step)
+                    peak = _peak_memory(sess, train_step)
+            results.append((step_time, peak))
+            print('%-14s %-10s %10.1f +- %5.1f %14.1f' % (
+                model_name, recompute, step_time[0], step_time[1], peak))
+        (base_time, base_peak), (step_time, peak) = results
+        print('%-14s %-10s %17.2fx %13.2fx' % (
+            model_name, 'ratio', step_time[0] / base_time[0], peak / base_peak))
+
+
+def run_summaries():
+    data_format = FLAGS.data_formats.split(',')[0]
+    caps = sorted(set(p['histogram_samples']
+                      for p in summary_policy.PRESETS.values()))
+    for model_name in FLAGS.model_names.split(','):
+        with tf.Graph().as_default():
+            net = nets_factory.get_network(model_name)()
+            shape = net.params.img_shape
+            with tf.device(FLAGS.device):
+                images = tf.random_uniform([FLAGS.batch_size, shape[0],
+                                            shape[1], 3])
+                net_images = images
+                if data_format == 'NCHW':
+                    net_images = tf.transpose(images, perm=(0, 3, 1, 2))
+                with slim.arg_scope(net.arg_scope(data_format=data_format)):
+                    localisations, logits, end_points = \
+                        net.net(net_images, is_training=True,
+                                use_batch=FLAGS.use_batch)
+                loss = tf.add_n([tf.reduce_sum(t)
+                                 for t in localisations + logits])
+                train_op = tf.train.GradientDescentOptimizer(1e-9).minimize(loss)
+            # Summary ops only run on the CPU.
+            categories = {
+                'scalars': tf.summary.merge([tf.summary.scalar('loss', loss)]),
+                'images': tf.summary.merge(
+                    [summary_policy.image('input_images', images)])}
+            for cap in caps:
+                tensors = sorted(end_points.items()) + [
+                    (v.op.name, v) for v in slim.get_model_variables()]
+                categories['histograms/%d' % cap] = tf.summary.merge(
+                    [summary_policy.histogram(name, x, cap)
+                     for name, x in tensors])
+            with tf.Session(config=_session_config()) as sess:
+                sess.run(tf.global_variables_initializer())
+                base = _time_steps(sess, train_op)
+                print('%-14s %-22s %10.1f +- %5.1f ms/step' % (
+                    model_name, 'no summaries', base[0], base[1]))
+                costs = {}
+                for name, summary_op in sorted(categories.items()):
+                    step_time = _time_steps(sess, [train_op, summary_op])
+                    costs[name] = step_time[0] - base[0]
+                    print('%-14s %-22s %+10.1f ms on summary steps' % (
+                        model_name, name, costs[name]))
+                alone = _time_steps(sess, tf.summary.merge(
+                    [categories['scalars'], categories['images'],
+                     categories['histograms/0']]))
+                print('%-14s %-22s %10.1f ms per summary run' % (
+                    model_name, 'separate run', alone[0]))
+            for preset, policy in sorted(summary_policy.PRESETS.items()):
+                overhead = 0.
+                for category in summary_policy.CATEGORIES:
+                    if not policy[category]:
+                        continue
+                    key = category
+                    if category == 'histograms':
+                        key = 'histograms/%d' % policy['histogram_samples']
+                    overhead += max(costs[key], 0.) / policy[category]
+                print('%-14s %-22s %+10.2f ms/step (%.2f%%)' % (
+                    model_name, 'preset ' + preset, overhead,
+                    100. * overhead / base[0]))
+
+
+def main(_):
+    modes = {'data_format': run_data_format,
+             'heads': run_heads,
+             'post': run_post,
+             'nms': run_nms,
+             'ohem': run_ohem,
+             'recompute': run_recompute,
+             'summaries': run_summaries}
+    if FLAGS.mode not in modes:
+        raise ValueError('Unknown benchmark mode %s' % FLAGS.mode)
+    modes[FLAGS.mode]()
+
+
+if __name__ == '__main__':
+    tf.app.run()
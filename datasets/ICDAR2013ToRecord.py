@@ -6,7 +6,8 @@ import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),'..')))
 import tensorflow as tf 
 import re
-from datasets.dataset_utils import int64_feature, float_feature, bytes_feature ,ImageCoder, norm
+from datasets.dataset_utils import int64_feature, float_feature, bytes_feature ,ImageCoder, ImageCoderPool, norm, packed_bboxes_feature, tfrecord_options
+from datasets.icdar2013_gt import load_gt
 from PIL import Image
 
 data_path = 'data/ICDAR2013/'
@@ -31,6 +32,23 @@ tf.app.flags.DEFINE_string(
  'tf_filename_test', '../data/ICDAR2013/ICDAR2013_Test.tfrecord',
  'test set tfrecord file name')
 
+tf.app.flags.DEFINE_boolean(
+ 'packed_bbox', False,
+ 'Store the boxes as one packed float32 blob plus a count.')
+
+tf.app.flags.DEFINE_string(
+ 'compression', '',
+ 'Compression of the written tfrecord: "", "GZIP" or "ZLIB".')
+
+tf.app.flags.DEFINE_integer(
+ 'num_threads', 8,
+ 'Number of threads parsing the ground truth files.')
+
+tf.app.flags.DEFINE_integer(
+ 'num_decoders', 0,
+ 'Number of image decoding processes. If 0, a single in-process '
+ 'TensorFlow ImageCoder is used.')
+
 tf.app.flags.DEFINE_string(
  'tf_filename_train', '../data/ICDAR2013/ICDAR2013_Train.tfrecord',
  'train set tfrecord file name')
@@ -48,124 +66,61 @@ image_path_train = '../data/ICDAR2013/ICDAR-Training-Images/'
 
 # Read from and parse the txt files
 def readGT(gt_dir):
-	#create structure for the columns
-	gt_coordinate_and_words = []
-	gt_names = []
-	path_list = []
-	txt_name_list = []
-
-	if (FLAGS.dataset == 'test'):
-	# Save the paths for all gound truth txt files
-		for txt_name in os.listdir(gt_dir):
-			txt_path = str(FLAGS.ground_truth_path) + txt_name
-			txt_name_list.append(txt_name)
-			path_list.append(txt_path)
-
-		for file_path in path_list:
-			try:
-				gt_file = np.loadtxt(file_path, dtype={'names':('xmin','ymin','xmax','ymax','word'),'formats':(np.float, np.float, np.float, np.float, '|S15')}, delimiter = ',')
-				gt_coordinate_and_words.append(gt_file)
-				
-				# Save image names
-				image_name = os.path.basename(file_path)
-				"""
-				if len(image_name) == 12:
-					imname = image_name[3:8] + '.jpg'
-				if len(image_name) == 13:
-					imname = image_name[3:9] + '.jpg'
-				if len(image_name) == 14:
-					imname = image_name[3:10] +'.jpg'
-				"""
-				pattern = re.compile(r"\d+")
-				imname = 'img_' + pattern.findall(image_name)[0] + '.jpg'
-				gt_names.append(imname)
-
-			except ValueError:
-				pass
-
-	else:
-		for txt_name in os.listdir(gt_dir):
-			txt_path = str(FLAGS.ground_truth_path) + txt_name
-			txt_name_list.append(txt_name)
-			path_list.append(txt_path)
-
-		for file_path in path_list:
-			try:
-				gt_file = np.loadtxt(file_path, dtype={'names':('xmin','ymin','xmax','ymax','word'),'formats':(np.float, np.float, np.float, np.float, '|S15')}, delimiter = ' ')
-				gt_coordinate_and_words.append(gt_file)
-
-				# Save image names
-				image_name = os.path.basename(file_path)
-				pattern = re.compile(r"\d+")
-				imname = pattern.findall(image_name)[0] + '.jpg'
-				gt_names.append(imname)
-
-			except ValueError:
-				pass
-		print gt_names
-				
-	return gt_names, gt_coordinate_and_words
-
-def _convert_to_example(image_data, shape, bbox, label, imname):
+	gt_names, gt_boxes, gt_offsets, gt_words, failures, line_errors = \
+		load_gt(gt_dir, dataset=FLAGS.dataset, num_threads=FLAGS.num_threads)
+	for path, reason in line_errors:
+		print 'Skipped ground truth line {}: {}'.format(path, reason)
+	for path, reason in failures:
+		print 'Skipped ground truth {}: {}'.format(path, reason)
+	print '{} ground truth files parsed, {} skipped, {} lines skipped'.format(
+		len(gt_names), len(failures), len(line_errors))
+	return gt_names, gt_boxes, gt_offsets
+
+def _convert_to_example(image_data, shape, bbox, label, imname, packed_bbox=False):
 	nbbox = np.array(bbox)
-	ymin = list(nbbox[:, 0])
-	xmin = list(nbbox[:, 1])
-	ymax = list(nbbox[:, 2])
-	xmax = list(nbbox[:, 3])
 
 	print 'shape:{}, height:{}, width:{}'.format(shape, shape[0], shape[1])
-	example = tf.train.Example(features=tf.train.Features(feature={
+	feature = {
 			'image/height': int64_feature(shape[0]),
 			'image/width': int64_feature(shape[1]),
 			'image/channels': int64_feature(shape[2]),
 			'image/shape': int64_feature(shape),
-			'image/object/bbox/ymin': float_feature(ymin),
-			'image/object/bbox/xmin': float_feature(xmin),
-			'image/object/bbox/ymax': float_feature(ymax),
-			'image/object/bbox/xmax': float_feature(xmax),
 			'image/object/bbox/label': int64_feature(label),
 			'image/format': bytes_feature('jpeg'),
 			'image/encoded': bytes_feature(image_data),
 			'image/name': bytes_feature(imname),
-			}))
+			}
+	if packed_bbox:
+		# One float32 blob instead of four float lists.
+		feature['image/object/bbox/packed'] = packed_bboxes_feature(nbbox)
+		feature['image/object/bbox/count'] = int64_feature(len(label))
+	else:
+		feature['image/object/bbox/ymin'] = float_feature(list(nbbox[:, 0]))
+		feature['image/object/bbox/xmin'] = float_feature(list(nbbox[:, 1]))
+		feature['image/object/bbox/ymax'] = float_feature(list(nbbox[:, 2]))
+		feature['image/object/bbox/xmax'] = float_feature(list(nbbox[:, 3]))
+	example = tf.train.Example(features=tf.train.Features(feature=feature))
 	return example
 
 
-# Deal with the image and the labels
-def _image_processing(wordbb, imname, coder):
+def _read_image(imname):
 	# Read image according to the imname
 	if (FLAGS.dataset == 'test'): 
 		imname_path = FLAGS.image_path_test + imname
 	else:
 		imname_path = FLAGS.image_path_train + imname
-	
-	image_data = tf.gfile.GFile(imname_path, 'r').read()
-	image = coder.decode_jpeg(image_data)
-	shape = image.shape
-	
-	# The number of boxes in an image
-	bbox = []
+	return tf.gfile.GFile(imname_path, 'r').read()
 
-	ymin = wordbb['ymin']
-	xmin = wordbb['xmin']
-	ymax = wordbb['ymax']
-	xmax = wordbb['xmax']
-	
-	ymin = np.maximum(ymin/shape[0], 0.0)
-	xmin = np.maximum(xmin/shape[1], 0.0)
-	ymax = np.minimum(ymax/shape[0], 1.0)
-	xmax = np.minimum(xmax/shape[1], 1.0)
-	
-	
-	try:
-		number_of_boxes = wordbb.shape[0]
-	except IndexError:
-		number_of_boxes = 1
 
-	if (number_of_boxes == 1):
-		bbox = [[ymin,xmin,ymax,xmax]]
-	else:
-		bbox = [[ymin[i],xmin[i],ymax[i],xmax[i]] for i in range(number_of_boxes)] 
+# Deal with the image and the labels
+def _image_processing(wordbb, imname, image_data, shape):
+	# wordbb: [number_of_boxes, 4] pixels, xmin, ymin, xmax, ymax
+	number_of_boxes = wordbb.shape[0]
+	xmin = np.maximum(wordbb[:, 0]/shape[1], 0.0)
+	ymin = np.maximum(wordbb[:, 1]/shape[0], 0.0)
+	xmax = np.minimum(wordbb[:, 2]/shape[1], 1.0)
+	ymax = np.minimum(wordbb[:, 3]/shape[0], 1.0)
+	bbox = np.stack([ymin, xmin, ymax, xmax], axis=1)
 	
 	label = [1 for i in range(number_of_boxes)]
 	shape = list(shape)
@@ -176,30 +131,41 @@ def _image_processing(wordbb, imname, coder):
 
 def main():
 	# Get gt_names and gt_coordinate_and_words
-	coder = ImageCoder()
+	if FLAGS.num_decoders > 0:
+		coder = ImageCoderPool(FLAGS.num_decoders)
+	else:
+		coder = ImageCoder()
 
+	gt_names, gt_boxes, gt_offsets = readGT(FLAGS.ground_truth_path)
 	if (FLAGS.dataset == 'test'):
-		gt_names, gt_coordinate_and_words = readGT(FLAGS.ground_truth_path)
 		tf_filename = FLAGS.tf_filename_test
 	else:
-		gt_names, gt_coordinate_and_words = readGT(FLAGS.ground_truth_path)
 		tf_filename = FLAGS.tf_filename_train
 
-	tfrecord_writer = tf.python_io.TFRecordWriter(tf_filename)
+	tfrecord_writer = tf.python_io.TFRecordWriter(tf_filename,
+									options=tfrecord_options(FLAGS.compression))
 	# Generate index and shuffle
 	index = [i for i in range(len(gt_names))]
 	random_index = np.random.permutation(index)
+	# Decode all the images at once, on every decoding process.
+	datas = [_read_image(gt_names[i]) for i in random_index]
+	shapes = coder.map('decode_jpeg_shape', datas)
+	if FLAGS.num_decoders > 0:
+		coder.close()
 	# Deal with every image
-	for i in random_index:
+	for i, image_data, shape in zip(random_index, datas, shapes):
 		imname = gt_names[i]
-		wordbb = gt_coordinate_and_words[i]
+		wordbb = gt_boxes[gt_offsets[i]:gt_offsets[i+1]]
 		#print wordbb
-		image_data, shape, bbox, label, imname = _image_processing(wordbb, imname, coder)
+		image_data, shape, bbox, label, imname = _image_processing(wordbb, imname, image_data, shape)
 		#print bounding_box
 		print imname
-		example = _convert_to_example(image_data, shape, bbox, label, imname)
+		example = _convert_to_example(image_data, shape, bbox, label, imname,
+									  packed_bbox=FLAGS.packed_bbox)
 		tfrecord_writer.write(example.SerializeToString())
 		#print i
+	# Flush the compressed stream, if any.
+	tfrecord_writer.close()
 
 	if (FLAGS.dataset == 'test'):
 		print 'Transform test set to tfrecord finished!'
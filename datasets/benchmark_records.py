@@ -0,0 +1,146 @@
+## Benchmark tfrecord input throughput for compressed vs. uncompressed shards.
+## For every compression type, the first --num_shards shards of --record_dir are
+## copied (records are not re-encoded) under --benchmark_dir/<TYPE>/, then read
+## back with the slim pipeline used in training, at each reader count.
+##   read   : parallel readers only (I/O + decompression).
+##   decode : full DatasetDataProvider (I/O + decompression + parsing + JPEG).
+## Pick GZIP/ZLIB on storage tiers where `read` is the bottleneck, none otherwise.
+##
+## python datasets/benchmark_records.py --record_dir=data/sythtext/ --benchmark_dir=/tmp/record_bench
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os, os.path
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),'..')))
+import tensorflow as tf
+
+from datasets import sythtextprovider
+from datasets.dataset_utils import tfrecord_options
+
+slim = tf.contrib.slim
+
+tf.app.flags.DEFINE_string(
+    'record_dir', '../data/sythtext/',
+    'Directory of the uncompressed tfrecord shards.')
+tf.app.flags.DEFINE_string(
+    'file_pattern', '*.tfrecord',
+    'Pattern of the shards inside record_dir.')
+tf.app.flags.DEFINE_string(
+    'benchmark_dir', '/tmp/record_bench',
+    'Scratch directory for the compressed copies.')
+tf.app.flags.DEFINE_integer(
+    'num_shards', 4,
+    'Number of shards copied for the benchmark.')
+tf.app.flags.DEFINE_string(
+    'compression_types', 'NONE,GZIP,ZLIB',
+    'Comma-separated compression types to compare.')
+tf.app.flags.DEFINE_string(
+    'num_readers_list', '1,2,4,8',
+    'Comma-separated reader counts to benchmark.')
+tf.app.flags.DEFINE_string(
+    'modes', 'read,decode',
+    'Comma-separated benchmark modes: "read" and/or "decode".')
+tf.app.flags.DEFINE_integer(
+    'num_examples', 2000,
+    'Number of examples timed per configuration.')
+tf.app.flags.DEFINE_integer(
+    'warmup', 100,
+    'Number of examples read before timing.')
+tf.app.flags.DEFINE_boolean(
+    'packed_bbox', False,
+    'Whether the tfrecords store the boxes as one packed float32 blob.')
+
+FLAGS = tf.app.flags.FLAGS
+
+
+def _copy_shards(shards, compression):
+    """Copy the shards with a given compression, return (directory, bytes on disk).
+    """
+    out_dir = os.path.join(FLAGS.benchmark_dir, compression)
+    tf.gfile.MakeDirs(out_dir)
+    options = tfrecord_options(compression)
+    size = 0
+    for shard in shards:
+        out_path = os.path.join(out_dir, os.path.basename(shard))
+        if not tf.gfile.Exists(out_path):
+            writer = tf.python_io.TFRecordWriter(out_path, options=options)
+            for record in tf.python_io.tf_record_iterator(shard):
+                writer.write(record)
+            writer.close()
+        size += tf.gfile.Stat(out_path).length
+    return out_dir, size
+
+
+def _benchmark(data_dir, compression, num_readers, mode):
+    """Return the examples/s of one configuration.
+    """
+    with tf.Graph().as_default():
+        dataset = sythtextprovider.get_datasets(data_dir,
+                                                file_pattern=FLAGS.file_pattern,
+                                                packed_bbox=FLAGS.packed_bbox,
+                                                compression=compression)
+        if mode == 'read':
+            _, record = slim.parallel_reader.parallel_read(
+                dataset.data_sources, dataset.reader,
+                num_readers=num_readers, shuffle=False)
+            # Any consumer forces the dequeue, avoid copying the record back.
+            fetch = tf.not_equal(record, '')
+        else:
+            provider = slim.dataset_data_provider.DatasetDataProvider(
+                dataset, num_readers=num_readers,
+                common_queue_capacity=64, common_queue_min=32, shuffle=False)
+            image, bboxes = provider.get(['image', 'object/bbox'])
+            fetch = tf.size(image) + tf.size(bboxes)
+        with tf.Session() as sess:
+            sess.run(tf.local_variables_initializer())
+            with slim.queues.QueueRunners(sess):
+                for _ in range(FLAGS.warmup):
+                    sess.run(fetch)
+                start = time.time()
+                for _ in range(FLAGS.num_examples):
+                    sess.run(fetch)
+                elapsed = time.time() - start
+    return FLAGS.num_examples / elapsed
+
+
+def run():
+    shards = sorted(tf.gfile.Glob(os.path.join(FLAGS.record_dir,
+                                               FLAGS.file_pattern)))[:FLAGS.num_shards]
+    if not shards:
+        raise ValueError('No shard matching %s in %s' % (FLAGS.file_pattern,
+                                                        FLAGS.record_dir))
+    num_records = sum(1 for s in shards for _ in tf.python_io.tf_record_iterator(s))
+    compressions = [c.strip().upper() for c in FLAGS.compression_types.split(',')]
+    readers = [int(n) for n in FLAGS.num_readers_list.split(',')]
+    modes = [m.strip() for m in FLAGS.modes.split(',')]
+
+    results = []
+    for compression in compressions:
+        data_dir, size = _copy_shards(shards, compression)
+        print('%s: %d records, %.1f MB on disk' % (compression, num_records, size / 1e6))
+        for mode in modes:
+            for num_readers in readers:
+                rate = _benchmark(data_dir, compression, num_readers, mode)
+                # Bytes pulled from storage per second at this example rate.
+                disk_rate = rate * size / num_records / 1e6
+                results.append((compression, mode, num_readers, rate, disk_rate))
+                print('  %-6s readers=%-2d %8.1f examples/s %8.1f MB/s from disk' % (
+                    mode, num_readers, rate, disk_rate))
+
+    print('\n%-6s %-6s %7s %12s %10s' % ('type', 'mode', 'readers', 'examples/s', 'disk MB/s'))
+    for compression, mode, num_readers, rate, disk_rate in results:
+        print('%-6s %-6s %7d %12.1f %10.1f' % (compression, mode, num_readers,
+                                              rate, disk_rate))
+
+
+def main(_):
+    run()
+
+
+if __name__ == '__main__':
+    tf.app.run()
@@ -10,10 +10,37 @@ import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),'..')))
 import tensorflow as tf
 import re
-from datasets.dataset_utils import int64_feature, float_feature, bytes_feature ,ImageCoder, norm
+from datasets.dataset_utils import int64_feature, float_feature, bytes_feature ,ImageCoder, ImageCoderPool, norm, packed_bboxes_feature, tfrecord_options
+from datasets.sythtext_annotations import AnnotationStore
 
 from PIL import Image
 
+tf.app.flags.DEFINE_boolean(
+	'packed_bbox', False,
+	'Store the boxes as one packed float32 blob plus a count.')
+tf.app.flags.DEFINE_string(
+	'compression', '',
+	'Compression of the written tfrecords: "", "GZIP" or "ZLIB".')
+tf.app.flags.DEFINE_string(
+	'annotation_store', None,
+	'Prefix of the memory-mapped annotation store built by '
+	'sythtext_annotations.py. If None, gt.mat is loaded in memory.')
+tf.app.flags.DEFINE_integer(
+	'folder_start', 0,
+	'First folder (0-based) converted by this worker.')
+tf.app.flags.DEFINE_integer(
+	'folder_end', 200,
+	'Folder after the last one converted by this worker.')
+tf.app.flags.DEFINE_integer(
+	'num_decoders', 0,
+	'Number of image decoding processes. If 0, a single in-process '
+	'TensorFlow ImageCoder is used.')
+tf.app.flags.DEFINE_integer(
+	'decode_batch', 64,
+	'Number of images read and decoded together.')
+
+FLAGS = tf.app.flags.FLAGS
+
 data_path = '../data/sythtext/'
 os.chdir(data_path)
 cellname = 'gt'
@@ -27,37 +54,36 @@ NUMoffolder = 200
 ## So Transform tfrecord according to dir name
 
 
-def _convert_to_example(image_data, shape, bbox, label,imname):
+def _convert_to_example(image_data, shape, bbox, label,imname, packed_bbox=False):
 	nbbox = np.array(bbox)
-	ymin = list(nbbox[:, 0])
-	xmin = list(nbbox[:, 1])
-	ymax = list(nbbox[:, 2])
-	xmax = list(nbbox[:, 3])
 
 	#print 'shape: {}, height:{}, width:{}'.format(shape,shape[0],shape[1])
-	example = tf.train.Example(features=tf.train.Features(feature={
+	feature = {
 			'image/height': int64_feature(shape[0]),
 			'image/width': int64_feature(shape[1]),
 			'image/channels': int64_feature(shape[2]),
 			'image/shape': int64_feature(shape),
-			'image/object/bbox/ymin': float_feature(ymin),
-			'image/object/bbox/xmin': float_feature(xmin),
-			'image/object/bbox/ymax': float_feature(ymax),
-			'image/object/bbox/xmax': float_feature(xmax),
 			'image/object/bbox/label': int64_feature(label),
 			'image/format': bytes_feature('jpeg'),
 			'image/encoded': bytes_feature(image_data),
 			'image/name': bytes_feature(imname.tostring()),
-			}))
+			}
+	if packed_bbox:
+		# One float32 blob instead of four float lists.
+		feature['image/object/bbox/packed'] = packed_bboxes_feature(nbbox)
+		feature['image/object/bbox/count'] = int64_feature(len(label))
+	else:
+		feature['image/object/bbox/ymin'] = float_feature(list(nbbox[:, 0]))
+		feature['image/object/bbox/xmin'] = float_feature(list(nbbox[:, 1]))
+		feature['image/object/bbox/ymax'] = float_feature(list(nbbox[:, 2]))
+		feature['image/object/bbox/xmax'] = float_feature(list(nbbox[:, 3]))
+	example = tf.train.Example(features=tf.train.Features(feature=feature))
 	return example
 	
 
-def _processing_image(wordbb, imname,coder):
+def _processing_image(wordbb, imname, image_data, shape):
 	#wordbb = tf.cast(wordbb, tf.float32)
-	image_data = tf.gfile.GFile(imname, 'r').read()
-	image = coder.decode_jpeg(image_data)
 	#image_data = np.array(Image.open(imname))
-	shape = image.shape
 	if(len(wordbb.shape) < 3 ):
 		numofbox = 1
 	else:
@@ -81,32 +107,57 @@ def _processing_image(wordbb, imname,coder):
 
 
 def run():
-	labels = sio.loadmat('gt.mat')
-	print labels.keys()
-	texts = labels[textname]
-	imnames = labels[imcell]
-	wordBB = labels[wordname]
-	charBB = labels[charname]
-	coder = ImageCoder()
-	for i in range(NUMoffolder):
+	if FLAGS.annotation_store is not None:
+		# Only the pages of the folders handled here are ever read.
+		store = AnnotationStore(FLAGS.annotation_store)
+		folder_indices = store.folder_indices
+		get_wordbb = store.wordbb
+		get_imname = store.name
+	else:
+		labels = sio.loadmat('gt.mat')
+		print labels.keys()
+		texts = labels[textname]
+		imnames = labels[imcell]
+		wordBB = labels[wordname]
+		charBB = labels[charname]
+		def folder_indices(dir):
+			pattern = re.compile(r'^{}\/'.format(dir))
+			print pattern
+			return [k for k in range(imnames.shape[1]) if pattern.match(imnames[0,k][0]) != None ]
+		get_wordbb = lambda j: wordBB[0,j]
+		get_imname = lambda j: imnames[0,j][0]
+	if FLAGS.num_decoders > 0:
+		coder = ImageCoderPool(FLAGS.num_decoders)
+	else:
+		coder = ImageCoder()
+	for i in range(FLAGS.folder_start, min(FLAGS.folder_end, NUMoffolder)):
 		tf_filename = str(i+1) + '.tfrecord'
-		tfrecord_writer = tf.python_io.TFRecordWriter(tf_filename)
+		tfrecord_writer = tf.python_io.TFRecordWriter(tf_filename,
+										options=tfrecord_options(FLAGS.compression))
 		dir = i+1
-		pattern = re.compile(r'^{}\/'.format(dir))
 		print dir
-		print pattern
-		res =[k for k in range(imnames.shape[1]) if pattern.match(imnames[0,k][0]) != None ]
+		res = folder_indices(dir)
 		print "The size of %s folder : %s" % (dir,len(res))
 		# shuffle
 		res = np.random.permutation(res)
-		for j in res:
-			wordbb = wordBB[0,j]
-			imname = imnames[0,j][0]
-			#print str(i) + imname
-			image_data, shape, bbox, label ,imname= _processing_image(wordbb, imname,coder)
-
-			example = _convert_to_example(image_data, shape, bbox, label, imname)
-			tfrecord_writer.write(example.SerializeToString())  
+		for k in range(0, len(res), FLAGS.decode_batch):
+			batch = res[k:k + FLAGS.decode_batch]
+			batch_names = [get_imname(j) for j in batch]
+			datas = [tf.gfile.GFile(imname, 'r').read() for imname in batch_names]
+			# Decode the whole batch at once, on every decoding process.
+			shapes = coder.map('decode_jpeg_shape', datas)
+			for j, imname, image_data, shape in zip(batch, batch_names, datas, shapes):
+				wordbb = get_wordbb(j)
+				#print str(i) + imname
+				image_data, shape, bbox, label ,imname= _processing_image(wordbb, imname, image_data, shape)
+
+				example = _convert_to_example(image_data, shape, bbox, label, imname,
+											  packed_bbox=FLAGS.packed_bbox)
+				tfrecord_writer.write(example.SerializeToString())  
+		# Flush the compressed stream, if any.
+		tfrecord_writer.close()
+	if FLAGS.num_decoders > 0:
+		coder.close()
 	print 'Transform to tfrecord finished'
 
 if __name__ == '__main__':
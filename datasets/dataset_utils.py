@@ -17,13 +17,21 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import io
+import multiprocessing
 import os
 import sys
 import tarfile
 
+import numpy as np
 from six.moves import urllib
 import tensorflow as tf
 
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
 LABELS_FILENAME = 'labels.txt'
 def norm(x):
     if x < 0:
@@ -57,6 +65,32 @@ def bytes_feature(value):
     return tf.train.Feature(bytes_list=tf.train.BytesList(value=value))
 
 
+def packed_bboxes_feature(bboxes):
+    """Wrapper for inserting a list of [ymin, xmin, ymax, xmax] boxes as one
+    little-endian float32 bytes blob into Example proto.
+    """
+    bboxes = np.asarray(bboxes, dtype='<f4').reshape([-1, 4])
+    return bytes_feature(bboxes.tostring())
+
+
+def tfrecord_options(compression=None):
+    """Returns the TFRecordOptions matching a compression name.
+
+    Args:
+    compression: None, '' or 'NONE' for plain records, 'GZIP' or 'ZLIB'.
+
+    Returns:
+    A `TFRecordOptions`, or None for uncompressed records.
+    """
+    if not compression or compression.upper() == 'NONE':
+        return None
+    types = {'GZIP': tf.python_io.TFRecordCompressionType.GZIP,
+             'ZLIB': tf.python_io.TFRecordCompressionType.ZLIB}
+    if compression.upper() not in types:
+        raise ValueError('Unknown tfrecord compression %s' % compression)
+    return tf.python_io.TFRecordOptions(types[compression.upper()])
+
+
 def image_to_tfexample(image_data, image_format, height, width, class_id):
     return tf.train.Example(features=tf.train.Features(feature={
       'image/encoded': bytes_feature(image_data),
@@ -143,9 +177,9 @@ def read_label_file(dataset_dir, filename=LABELS_FILENAME):
 class ImageCoder(object):
   """Helper class that provides TensorFlow image coding utilities."""
 
-  def __init__(self):
+  def __init__(self, config=None):
     # Create a single Session to run all image coding calls.
-    self._sess = tf.Session()
+    self._sess = tf.Session(config=config)
 
     # Initializes function that converts PNG to JPEG data.
     self._png_data = tf.placeholder(dtype=tf.string)
@@ -175,3 +209,129 @@ class ImageCoder(object):
     assert len(image.shape) == 3
     assert image.shape[2] == 3
     return image
+
+  def decode_jpeg_shape(self, image_data):
+    return self.decode_jpeg(image_data).shape
+
+  def map(self, method, datas):
+    """Serial counterpart of `ImageCoderPool.map`."""
+    return [getattr(self, method)(image_data) for image_data in datas]
+
+
+## Worker side of ImageCoderPool. PIL is used when it can decode the data,
+## the TensorFlow coder (CPU only, created on first use) otherwise.
+_worker_tf_coder = None
+
+
+def _tf_coder():
+  global _worker_tf_coder
+  if _worker_tf_coder is None:
+    config = tf.ConfigProto(device_count={'GPU': 0},
+                            intra_op_parallelism_threads=1,
+                            inter_op_parallelism_threads=1)
+    _worker_tf_coder = ImageCoder(config=config)
+  return _worker_tf_coder
+
+
+def _pil_open(image_data, fmt):
+  if Image is None:
+    return None
+  try:
+    image = Image.open(io.BytesIO(image_data))
+    if image.format != fmt:
+      return None
+    image.load()
+  except Exception:
+    return None
+  return image
+
+
+def _pil_to_jpeg(image):
+  buf = io.BytesIO()
+  image.convert('RGB').save(buf, format='JPEG', quality=100)
+  return buf.getvalue()
+
+
+def _png_to_jpeg(image_data):
+  image = _pil_open(image_data, 'PNG')
+  if image is None:
+    return _tf_coder().png_to_jpeg(image_data)
+  return _pil_to_jpeg(image)
+
+
+def _cmyk_to_rgb(image_data):
+  image = _pil_open(image_data, 'JPEG')
+  if image is None:
+    return _tf_coder().cmyk_to_rgb(image_data)
+  return _pil_to_jpeg(image)
+
+
+def _decode_jpeg(image_data):
+  image = _pil_open(image_data, 'JPEG')
+  if image is None:
+    return _tf_coder().decode_jpeg(image_data)
+  image = np.asarray(image.convert('RGB'))
+  assert len(image.shape) == 3
+  assert image.shape[2] == 3
+  return image
+
+
+def _decode_jpeg_shape(image_data):
+  # Only the shape travels back to the parent, not the pixels.
+  return _decode_jpeg(image_data).shape
+
+
+_POOL_METHODS = {
+  'png_to_jpeg': _png_to_jpeg,
+  'cmyk_to_rgb': _cmyk_to_rgb,
+  'decode_jpeg': _decode_jpeg,
+  'decode_jpeg_shape': _decode_jpeg_shape,
+}
+
+
+class ImageCoderPool(object):
+  """Drop-in replacement of ImageCoder backed by a pool of worker processes.
+
+  Single calls behave as ImageCoder's; `map` and `map_async` spread a list
+  of byte strings over all the workers. Create the pool before any
+  tf.Session in the parent process, and `close` it when done.
+  """
+
+  def __init__(self, num_workers=None, chunksize=4):
+    self._pool = multiprocessing.Pool(num_workers)
+    self._chunksize = chunksize
+
+  def png_to_jpeg(self, image_data):
+    return self._pool.apply(_png_to_jpeg, (image_data, ))
+
+  def cmyk_to_rgb(self, image_data):
+    return self._pool.apply(_cmyk_to_rgb, (image_data, ))
+
+  def decode_jpeg(self, image_data):
+    return self._pool.apply(_decode_jpeg, (image_data, ))
+
+  def decode_jpeg_shape(self, image_data):
+    return self._pool.apply(_decode_jpeg_shape, (image_data, ))
+
+  def map(self, method, datas):
+    """Apply a coder method, by name, to a list of byte strings.
+
+    Return:
+      The list of results, in the order of `datas`.
+    """
+    return self._pool.map(_POOL_METHODS[method], datas, self._chunksize)
+
+  def map_async(self, method, datas, callback=None):
+    """Asynchronous `map`: return an AsyncResult, call `get()` on it."""
+    return self._pool.map_async(_POOL_METHODS[method], datas,
+                                self._chunksize, callback)
+
+  def close(self):
+    self._pool.close()
+    self._pool.join()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
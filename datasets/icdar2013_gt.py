@@ -0,0 +1,128 @@
+"""Bulk parser for the ICDAR2013 ground truth txt files.
+
+Each ground truth file holds one word per line:
+  test  : xmin, ymin, xmax, ymax, "word"
+  train : xmin ymin xmax ymax "word"
+All files are parsed in a thread pool and returned as one flat box array with
+per-image offsets, so the record writer can slice them directly. A bad line is
+reported and skipped, the other boxes of its file are kept.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import io
+import os
+import re
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+_DIGITS = re.compile(r'\d+')
+
+
+def test_image_name(gt_name):
+    """gt_img_12.txt ==> img_12.jpg"""
+    return 'img_' + _DIGITS.findall(gt_name)[0] + '.jpg'
+
+
+def train_image_name(gt_name):
+    """gt_100.txt ==> 100.jpg"""
+    return _DIGITS.findall(gt_name)[0] + '.jpg'
+
+
+def parse_gt_lines(lines, delimiter=','):
+    """Tokenize ground truth lines into boxes and words.
+
+    Args:
+      lines: Iterable of text lines.
+      delimiter: ',' for the test set, None (any whitespace) for the train set.
+    Return:
+      boxes, words: list of [xmin, ymin, xmax, ymax] and list of words;
+      errors: list of the skipped lines, with their line number and reason.
+    """
+    boxes = []
+    words = []
+    errors = []
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        # The word is everything after the 4th delimiter, quotes included.
+        tokens = line.split(delimiter, 4)
+        if len(tokens) != 5:
+            errors.append('line %d: expected 5 fields, got %d' % (lineno, len(tokens)))
+            continue
+        try:
+            box = [float(t) for t in tokens[:4]]
+        except ValueError:
+            errors.append('line %d: bad coordinates %r' % (lineno, tokens[:4]))
+            continue
+        if box[2] <= box[0] or box[3] <= box[1]:
+            errors.append('line %d: degenerate box %s' % (lineno, box))
+            continue
+        boxes.append(box)
+        words.append(tokens[4].strip().strip('"'))
+    return boxes, words, errors
+
+
+def _parse_file(args):
+    path, delimiter = args
+    try:
+        # Some files start with a UTF-8 BOM, which breaks the first float.
+        with io.open(path, 'r', encoding='utf-8-sig') as f:
+            boxes, words, errors = parse_gt_lines(f, delimiter)
+    except (IOError, UnicodeDecodeError) as e:
+        return path, None, None, str(e), []
+    if not boxes:
+        return path, None, None, 'no boxes', errors
+    return path, boxes, words, None, errors
+
+
+def load_gt(gt_dir, dataset='test', num_threads=8):
+    """Parse every ground truth file of a directory.
+
+    Args:
+      gt_dir: Directory of the gt_*.txt files.
+      dataset: 'test' (comma separated) or 'train' (space separated).
+      num_threads: Size of the parsing thread pool.
+    Return:
+      names: list of image names, in file name order;
+      boxes: float32 [num_boxes, 4] array of xmin, ymin, xmax, ymax pixels;
+      offsets: int64 [num_images + 1] array, boxes of image i are
+        boxes[offsets[i]:offsets[i+1]];
+      words: list of the transcriptions, aligned with boxes;
+      failures: list of (path, reason) of the files left out;
+      line_errors: list of (path, reason) of the lines left out.
+    """
+    if dataset == 'test':
+        delimiter, name_fn = ',', test_image_name
+    else:
+        delimiter, name_fn = None, train_image_name
+    paths = [os.path.join(gt_dir, n) for n in sorted(os.listdir(gt_dir))
+             if n.endswith('.txt')]
+    pool = ThreadPool(num_threads)
+    try:
+        results = pool.map(_parse_file, [(p, delimiter) for p in paths])
+    finally:
+        pool.close()
+        pool.join()
+
+    names = []
+    counts = [0]
+    all_boxes = []
+    words = []
+    failures = []
+    line_errors = []
+    for path, boxes, file_words, error, errors in results:
+        line_errors.extend((path, e) for e in errors)
+        if error is not None:
+            failures.append((path, error))
+            continue
+        names.append(name_fn(os.path.basename(path)))
+        counts.append(len(boxes))
+        all_boxes.extend(boxes)
+        words.extend(file_words)
+    offsets = np.cumsum(counts, dtype=np.int64)
+    boxes = np.array(all_boxes, dtype=np.float32).reshape([-1, 4])
+    return names, boxes, offsets, words, failures, line_errors
@@ -0,0 +1,128 @@
+"""Compact, memory-mapped store for the SythText gt.mat annotations.
+
+`sio.loadmat('gt.mat')` keeps the 858k images' annotations as MATLAB cell
+objects, several gigabytes in memory. `convert_mat` turns it once into three
+flat numpy files sharing a prefix:
+  <prefix>_corners.npy : float32 [num_words, 2, 4] word corners (x row, y row);
+  <prefix>_offsets.npy : int64 [num_images + 1], words of image i are
+                         corners[offsets[i]:offsets[i+1]];
+  <prefix>_names.npy   : fixed width unicode [num_images], image names, the
+                         dtype of gt.mat so that data2record writes the same
+                         image/name bytes (UTF-32-LE) with or without store.
+`AnnotationStore` memory-maps them, so a worker only pages in the images it
+actually reads.
+
+python datasets/sythtext_annotations.py ../data/sythtext/gt.mat ../data/sythtext/gt
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+
+import numpy as np
+
+CORNERS_SUFFIX = '_corners.npy'
+OFFSETS_SUFFIX = '_offsets.npy'
+NAMES_SUFFIX = '_names.npy'
+
+
+def _word_corners(wordbb):
+    """MATLAB drops the last axis for single-word images: restore [n, 2, 4].
+    """
+    wordbb = np.asarray(wordbb, dtype=np.float32)
+    if wordbb.ndim < 3:
+        wordbb = wordbb[:, :, np.newaxis]
+    return np.transpose(wordbb, (2, 0, 1))
+
+
+def convert_mat(mat_path, prefix, wordname='wordBB', imcell='imnames'):
+    """Convert gt.mat into the columnar store. Needs to run only once.
+
+    Args:
+      mat_path: Path of the SythText gt.mat file.
+      prefix: Output path prefix of the three .npy files.
+    Return:
+      Number of images converted.
+    """
+    import scipy.io as sio
+    labels = sio.loadmat(mat_path, variable_names=[wordname, imcell])
+    wordBB = labels[wordname]
+    imnames = labels[imcell]
+    num_images = wordBB.shape[1]
+
+    counts = np.zeros((num_images, ), dtype=np.int64)
+    for i in range(num_images):
+        wordbb = wordBB[0, i]
+        counts[i] = 1 if wordbb.ndim < 3 else wordbb.shape[2]
+    offsets = np.zeros((num_images + 1, ), dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    corners = np.lib.format.open_memmap(prefix + CORNERS_SUFFIX, mode='w+',
+                                        dtype=np.float32,
+                                        shape=(int(offsets[-1]), 2, 4))
+    for i in range(num_images):
+        corners[offsets[i]:offsets[i+1]] = _word_corners(wordBB[0, i])
+    corners.flush()
+    del corners
+
+    names = np.array([imnames[0, i][0] for i in range(num_images)],
+                     dtype='U')
+    np.save(prefix + OFFSETS_SUFFIX, offsets)
+    np.save(prefix + NAMES_SUFFIX, names)
+    return num_images
+
+
+class AnnotationStore(object):
+    """Lazy reader of the columnar annotation store.
+
+    Indexing mimics the gt.mat cells used by data2record: `wordbb(i)` is a
+    2 x 4 x n array (2 x 4 for single-word images) and `name(i)` the image
+    path relative to the dataset directory.
+    """
+
+    def __init__(self, prefix, mmap_mode='r'):
+        self._corners = np.load(prefix + CORNERS_SUFFIX, mmap_mode=mmap_mode)
+        self._offsets = np.load(prefix + OFFSETS_SUFFIX, mmap_mode=mmap_mode)
+        self._names = np.load(prefix + NAMES_SUFFIX, mmap_mode=mmap_mode)
+
+    def __len__(self):
+        return self._names.shape[0]
+
+    def num_words(self, i):
+        return int(self._offsets[i+1] - self._offsets[i])
+
+    def name(self, i):
+        name = self._names[i]
+        if isinstance(name, np.bytes_):
+            # Stores converted when the names were kept as bytes.
+            name = np.array(name.decode('utf-8'))[()]
+        return name
+
+    def wordbb(self, i):
+        corners = np.array(self._corners[self._offsets[i]:self._offsets[i+1]])
+        wordbb = np.transpose(corners, (1, 2, 0))
+        if wordbb.shape[2] == 1:
+            wordbb = wordbb[:, :, 0]
+        return wordbb
+
+    def folder_indices(self, folder):
+        """Indices of the images stored under `folder`/.
+        """
+        prefix = u'%s/' % folder
+        if self._names.dtype.kind == 'S':
+            prefix = prefix.encode('ascii')
+        return np.flatnonzero(np.char.startswith(self._names, prefix))
+
+
+def main(argv):
+    if len(argv) != 3:
+        print('Usage: python sythtext_annotations.py <gt.mat> <output prefix>')
+        return 1
+    num_images = convert_mat(argv[1], argv[2])
+    print('Converted %d images to %s*' % (num_images, argv[2]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,9 +1,11 @@
 ## an initial version
 ## Transform the tfrecord to slim data provider format
 
+import functools
 import numpy 
 import tensorflow as tf
 import os
+from datasets.dataset_utils import tfrecord_options
 slim = tf.contrib.slim
 
 
@@ -24,19 +26,31 @@ NUM_CLASSES = 2
 
 
 
-def get_datasets(data_dir,file_pattern = '*.tfrecord'):
-    file_patterns = os.path.join(data_dir, file_pattern)
+def _decode_packed_bboxes(keys_to_tensors):
+    """Decode the packed little-endian float32 blob into a [count, 4] Tensor.
+    """
+    packed = keys_to_tensors['image/object/bbox/packed']
+    count = keys_to_tensors['image/object/bbox/count']
+    bboxes = tf.decode_raw(packed, tf.float32, little_endian=True)
+    return tf.reshape(bboxes, tf.stack([tf.to_int32(count[0]), 4]))
+
+
+def get_datasets(data_dir,file_pattern = '*.tfrecord', packed_bbox=False,
+                 compression=None, data_sources=None):
+    # data_sources: explicit list of files, e.g. the shard of a worker.
+    file_patterns = data_sources or os.path.join(data_dir, file_pattern)
     print 'file_path: {}'.format(file_patterns)
-    reader = tf.TFRecordReader
+    options = tfrecord_options(compression)
+    if options is None:
+        reader = tf.TFRecordReader
+    else:
+        # GZIP / ZLIB records: the readers decompress on the fly.
+        reader = functools.partial(tf.TFRecordReader, options=options)
     keys_to_features = {
         'image/height': tf.FixedLenFeature([1], tf.int64),
         'image/width': tf.FixedLenFeature([1], tf.int64),
         'image/channels': tf.FixedLenFeature([1], tf.int64),
         'image/shape': tf.FixedLenFeature([3], tf.int64),
-        'image/object/bbox/ymin': tf.VarLenFeature(dtype=tf.float32),
-        'image/object/bbox/xmin': tf.VarLenFeature(dtype=tf.float32),
-        'image/object/bbox/ymax': tf.VarLenFeature(dtype=tf.float32),
-        'image/object/bbox/xmax': tf.VarLenFeature(dtype=tf.float32),
         'image/object/bbox/label': tf.VarLenFeature(dtype=tf.int64),
         'image/format': tf.FixedLenFeature([], tf.string, default_value='jpeg'),
         'image/encoded': tf.FixedLenFeature([], tf.string, default_value=''),
@@ -49,13 +63,27 @@ def get_datasets(data_dir,file_pattern = '*.tfrecord'):
         'shape': slim.tfexample_decoder.Tensor('image/shape'),
         'height': slim.tfexample_decoder.Tensor('image/height'),
         'width': slim.tfexample_decoder.Tensor('image/width'),
-        'object/bbox': slim.tfexample_decoder.BoundingBox(
-                ['ymin', 'xmin', 'ymax', 'xmax'], 'image/object/bbox/'),
         'object/label': slim.tfexample_decoder.Tensor('image/object/bbox/label'),
         #'imaname': slim.tfexample_decoder.Tensor('image/name'),
         #'objext/txt': slim.tfexample_decoder.Tensor('image/object/bbox/label_text'),
       }
 
+    if packed_bbox:
+        # Boxes stored as one float32 blob: a single decode_raw, no sparse ops.
+        keys_to_features['image/object/bbox/packed'] = \
+            tf.FixedLenFeature([], tf.string, default_value='')
+        keys_to_features['image/object/bbox/count'] = \
+            tf.FixedLenFeature([1], tf.int64)
+        items_to_handlers['object/bbox'] = slim.tfexample_decoder.ItemHandlerCallback(
+                ['image/object/bbox/packed', 'image/object/bbox/count'],
+                _decode_packed_bboxes)
+    else:
+        for k in ['ymin', 'xmin', 'ymax', 'xmax']:
+            keys_to_features['image/object/bbox/' + k] = \
+                tf.VarLenFeature(dtype=tf.float32)
+        items_to_handlers['object/bbox'] = slim.tfexample_decoder.BoundingBox(
+                ['ymin', 'xmin', 'ymax', 'xmax'], 'image/object/bbox/')
+
     decoder = slim.tfexample_decoder.TFExampleDecoder(
         keys_to_features, items_to_handlers)
 
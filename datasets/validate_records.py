@@ -0,0 +1,239 @@
+## Validate the tfrecords produced by data2record / ICDAR2013ToRecord
+## Every shard is streamed by a worker process, each example is checked for
+##   - a decodable JPEG,
+##   - a decoded size consistent with 'image/shape',
+##   - sane boxes (finite, inside [0, 1], ymax > ymin and xmax > xmin).
+## Clean examples are copied (raw bytes, no re-serialization) into a new shard
+## with the same name under --output_dir. Rejected ones go to a quarantine list.
+##
+## python datasets/validate_records.py --record_dir=data/sythtext/ --output_dir=data/sythtext_clean/
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import io
+import math
+import os, os.path
+import struct
+import sys
+import time
+from multiprocessing import Pool
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),'..')))
+import tensorflow as tf
+from PIL import Image
+
+from datasets.dataset_utils import tfrecord_options
+
+tf.app.flags.DEFINE_string(
+    'record_dir', '../data/sythtext/',
+    'Directory of the tfrecord shards to validate.')
+tf.app.flags.DEFINE_string(
+    'file_pattern', '*.tfrecord',
+    'Pattern of the shards inside record_dir.')
+tf.app.flags.DEFINE_string(
+    'output_dir', None,
+    'Where the clean shards are written. If None, only report.')
+tf.app.flags.DEFINE_string(
+    'quarantine_file', 'quarantine.txt',
+    'Quarantine list, relative to output_dir (or record_dir when no output_dir).')
+tf.app.flags.DEFINE_string(
+    'compression', '',
+    'Compression of the input shards: "", "GZIP" or "ZLIB". Clean shards '
+    'are written with the same compression.')
+tf.app.flags.DEFINE_integer(
+    'num_workers', 8,
+    'Number of worker processes, one shard per worker at a time.')
+tf.app.flags.DEFINE_boolean(
+    'full_decode', True,
+    'Decode every JPEG entirely. If False only the header is parsed, which '
+    'is enough for shape checks and keeps up with disk speed.')
+
+FLAGS = tf.app.flags.FLAGS
+
+BBOX_KEYS = ['ymin', 'xmin', 'ymax', 'xmax']
+
+
+def _feature_list(feature, key, kind):
+    if key not in feature:
+        return None
+    return list(getattr(feature[key], kind).value)
+
+
+def _text(value):
+    """Unicode text of a str / bytes value, undecodable bytes replaced.
+    """
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def decode_name(raw):
+    """Decode an image/name feature.
+
+    data2record.py stores the numpy unicode scalar of gt.mat, i.e. UTF-32-LE
+    with NUL padding; ICDAR2013ToRecord.py stores UTF-8.
+    """
+    if raw and len(raw) % 4 == 0 and raw[3:4] == b'\x00' and b'\x00\x00' in raw:
+        try:
+            return raw.decode('utf-32-le').rstrip(u'\x00')
+        except UnicodeDecodeError:
+            pass
+    return raw.decode('utf-8', 'replace')
+
+
+def check_example(serialized, full_decode=True):
+    """Check one serialized tf.train.Example.
+
+    Return:
+      (name, reason): reason is None if the example is clean.
+    """
+    example = tf.train.Example()
+    try:
+        example.ParseFromString(serialized)
+    except Exception as e:
+        return u'', 'unparsable example: %s' % e
+    feature = example.features.feature
+
+    name = _feature_list(feature, 'image/name', 'bytes_list')
+    name = decode_name(name[0]) if name else u''
+
+    # Image decodability and shape.
+    encoded = _feature_list(feature, 'image/encoded', 'bytes_list')
+    if not encoded or not encoded[0]:
+        return name, 'missing image/encoded'
+    shape = _feature_list(feature, 'image/shape', 'int64_list')
+    if shape is None or len(shape) != 3:
+        return name, 'bad image/shape %s' % shape
+    try:
+        image = Image.open(io.BytesIO(encoded[0]))
+        if full_decode:
+            image.load()
+    except Exception as e:
+        return name, 'undecodable image: %s' % e
+    width, height = image.size
+    if [height, width] != shape[:2] or shape[2] != 3:
+        return name, 'shape mismatch: decoded %dx%d, stored %s' % (
+            height, width, shape)
+
+    # Boxes sanity.
+    packed = _feature_list(feature, 'image/object/bbox/packed', 'bytes_list')
+    if packed is not None:
+        count = _feature_list(feature, 'image/object/bbox/count', 'int64_list')
+        if not count or len(packed[0]) != 16 * count[0]:
+            return name, 'packed bbox size mismatch: %d bytes, count %s' % (
+                len(packed[0]), count)
+        flat = struct.unpack('<%df' % (4 * count[0]), packed[0])
+        coords = [list(flat[k::4]) for k in range(4)]
+    else:
+        coords = [_feature_list(feature, 'image/object/bbox/' + k, 'float_list')
+                  for k in BBOX_KEYS]
+    labels = _feature_list(feature, 'image/object/bbox/label', 'int64_list')
+    if any(c is None for c in coords) or labels is None:
+        return name, 'missing bbox features'
+    num = len(labels)
+    if num == 0:
+        return name, 'no boxes'
+    if any(len(c) != num for c in coords):
+        return name, 'bbox length mismatch: %s vs %d labels' % (
+            [len(c) for c in coords], num)
+    for i, (ymin, xmin, ymax, xmax) in enumerate(zip(*coords)):
+        box = (ymin, xmin, ymax, xmax)
+        if any(math.isnan(v) or math.isinf(v) for v in box):
+            return name, 'non finite box %d: %s' % (i, box)
+        if min(box) < 0. or max(box) > 1.:
+            return name, 'box %d out of [0, 1]: %s' % (i, box)
+        if ymax <= ymin or xmax <= xmin:
+            return name, 'degenerate box %d: %s' % (i, box)
+    return name, None
+
+
+def _validate_shard(args):
+    """Worker: stream one shard, copy clean records and collect rejects.
+    """
+    shard, output_path, full_decode, compression = args
+    options = tfrecord_options(compression)
+    writer = None
+    if output_path is not None:
+        writer = tf.python_io.TFRecordWriter(output_path, options=options)
+    num_records = 0
+    num_bytes = 0
+    rejects = []
+    try:
+        for serialized in tf.python_io.tf_record_iterator(shard, options=options):
+            num_bytes += len(serialized)
+            name, reason = check_example(serialized, full_decode)
+            if reason is None:
+                if writer is not None:
+                    writer.write(serialized)
+            else:
+                rejects.append((num_records, name, reason))
+            num_records += 1
+    except Exception as e:
+        # Truncated / corrupted shard: keep what has been read so far.
+        rejects.append((num_records, u'', 'corrupted shard: %s' % e))
+    finally:
+        if writer is not None:
+            writer.close()
+    return shard, num_records, num_bytes, rejects
+
+
+def run():
+    shards = sorted(tf.gfile.Glob(os.path.join(FLAGS.record_dir, FLAGS.file_pattern)))
+    if not shards:
+        raise ValueError('No shard matching %s in %s' % (FLAGS.file_pattern,
+                                                        FLAGS.record_dir))
+    if FLAGS.output_dir is not None:
+        if os.path.abspath(FLAGS.output_dir) == os.path.abspath(FLAGS.record_dir):
+            raise ValueError('output_dir must differ from record_dir')
+        tf.gfile.MakeDirs(FLAGS.output_dir)
+        out_dir = FLAGS.output_dir
+    else:
+        out_dir = FLAGS.record_dir
+    jobs = []
+    for shard in shards:
+        output_path = None
+        if FLAGS.output_dir is not None:
+            output_path = os.path.join(FLAGS.output_dir, os.path.basename(shard))
+        jobs.append((shard, output_path, FLAGS.full_decode, FLAGS.compression))
+
+    print('Validating %d shards with %d workers' % (len(shards), FLAGS.num_workers))
+    quarantine_path = os.path.join(out_dir, FLAGS.quarantine_file)
+    total_records = 0
+    total_bytes = 0
+    total_rejects = 0
+    start = time.time()
+    pool = Pool(FLAGS.num_workers)
+    try:
+        # UTF-8 bytes: the names are unicode, the shards and reasons may not be.
+        with open(quarantine_path, 'wb') as quarantine:
+            # Small chunks keep every worker busy until the last shard.
+            for shard, num_records, num_bytes, rejects in \
+                    pool.imap_unordered(_validate_shard, jobs, chunksize=1):
+                total_records += num_records
+                total_bytes += num_bytes
+                total_rejects += len(rejects)
+                for index, name, reason in rejects:
+                    line = u'%s\t%d\t%s\t%s\n' % (_text(shard), index, name,
+                                                  _text(reason))
+                    quarantine.write(line.encode('utf-8'))
+                elapsed = time.time() - start
+                print('%s: %d records, %d rejected | total %.1f MB/s, %.1f records/s' % (
+                    os.path.basename(shard), num_records, len(rejects),
+                    total_bytes / 1e6 / elapsed, total_records / elapsed))
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+    print('Validation finished in %.1f s: %d records, %d rejected, %.1f MB/s' % (
+        elapsed, total_records, total_rejects, total_bytes / 1e6 / elapsed))
+    print('Quarantine list written to %s' % quarantine_path)
+
+
+def main(_):
+    run()
+
+
+if __name__ == '__main__':
+    tf.app.run()
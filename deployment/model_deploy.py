@@ -143,7 +143,8 @@ _deployment_params = {'num_clones': 1,
                       'ps_job_name': 'ps'}
 
 
-def create_clones(config, model_fn, args=None, kwargs=None):
+def create_clones(config, model_fn, args=None, kwargs=None,
+                  per_clone_args=None):
     """Creates multiple clones according to config using a `model_fn`.
 
     The returned values of `model_fn(*args, **kwargs)` are collected along with
@@ -165,7 +166,9 @@ def create_clones(config, model_fn, args=None, kwargs=None):
     of such clones.
 
     The argument `model_fn` is called `config.num_clones` times to create the
-    model clones as `model_fn(*args, **kwargs)`.
+    model clones as `model_fn(*args, **kwargs)`. With `per_clone_args`, clone i
+    is created as `model_fn(*(args + per_clone_args[i]), **kwargs)`, e.g. to
+    give every clone its own input queue.
 
     If `config` specifies deployment on multiple replicas then the default
     tensorflow device is set appropriatly for each call to `model_fn` and for the
@@ -177,13 +180,22 @@ def create_clones(config, model_fn, args=None, kwargs=None):
         model_fn: A callable. Called as `model_fn(*args, **kwargs)`
         args: Optional list of arguments to pass to `model_fn`.
         kwargs: Optional list of keyword arguments to pass to `model_fn`.
+        per_clone_args: Optional list of `config.num_clones` lists of
+            arguments, appended to `args` for the matching clone.
 
     Returns:
         A list of namedtuples `Clone`.
+
+    Raises:
+        ValueError: if `per_clone_args` does not have one entry per clone.
     """
     clones = []
-    args = args or []
+    args = list(args or [])
     kwargs = kwargs or {}
+    if per_clone_args is None:
+        per_clone_args = [[]] * config.num_clones
+    if len(per_clone_args) != config.num_clones:
+        raise ValueError('per_clone_args must have num_clones entries')
     with slim.arg_scope([slim.model_variable, slim.variable],
                         device=config.variables_device()):
         # Create clones.
@@ -193,7 +205,8 @@ def create_clones(config, model_fn, args=None, kwargs=None):
                 with tf.device(clone_device):
                     with tf.variable_scope(tf.get_variable_scope(),
                                            reuse=True if i > 0 else None):
-                        outputs = model_fn(*args, **kwargs)
+                        outputs = model_fn(*(args + list(per_clone_args[i])),
+                                           **kwargs)
                     clones.append(Clone(outputs, clone_scope, clone_device))
     return clones
 
@@ -539,7 +552,9 @@ class DeploymentConfig(object):
         self._num_replicas = num_replicas
         self._num_ps_tasks = num_ps_tasks
         self._ps_device = '/job:' + ps_job_name if num_ps_tasks > 0 else ''
-        self._worker_device = '/job:' + worker_job_name if num_ps_tasks > 0 else ''
+        # Every replica places its clones on its own worker task.
+        self._worker_device = ('/job:%s/task:%d' % (worker_job_name, replica_id)
+                               if num_ps_tasks > 0 else '')
 
     @property
     def num_clones(self):
@@ -675,7 +690,7 @@ class DeploymentConfig(object):
                 if op.device:
                     return op.device
                 node_def = op if isinstance(op, tf.NodeDef) else op.node_def
-                if node_def.op == 'Variable':
+                if node_def.op in ('Variable', 'VariableV2', 'VarHandleOp'):
                     t = self._task
                     self._task = (self._task + 1) % self._tasks
                     d = '%s/task:%d' % (self._device, t)
@@ -0,0 +1,320 @@
+"""
+Text detection on images larger than the network resolution, by tiling.
+
+The image is cut into a grid of overlapping tiles, every tile is resized to
+the network input shape and a batch of tiles goes through one forward pass.
+The detections of a tile, after the usual per-tile selection and NMS, are
+mapped back to image coordinates with np_methods.bboxes_resize and an
+inverted reference box, then the words found twice along the tile seams are
+merged by a global NMS over all the tiles of the image.
+
+--tile_rows / --tile_cols fix the grid; 0 picks the number of tiles so that a
+tile is about --tile_shape pixels, i.e. the image is seen at its native
+resolution. --overlap is the fraction of a tile shared with its neighbour and
+should be larger than the words crossing a seam. --full_image adds the whole
+image, resized, as one more tile for the words too large for a tile.
+
+Outputs one res_<image name>.txt per image in --output_dir, ICDAR style:
+  xmin,ymin,xmax,ymax,score     (pixels)
+
+python detect_tiled.py --checkpoint_path=./checkpoints/ --image_dir=./demo/ --output_dir=./results/
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import math
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from nets import nets_factory
+from nets import np_methods
+from processing import txt_preprocessing
+
+slim = tf.contrib.slim
+
+tf.app.flags.DEFINE_string(
+    'checkpoint_path', './checkpoints/',
+    'The directory where the model was written to or an absolute path to a '
+    'checkpoint file.')
+tf.app.flags.DEFINE_string(
+    'image_dir', './demo/', 'Directory of the images to process.')
+tf.app.flags.DEFINE_string(
+    'image_pattern', '*.jpg', 'Pattern of the images inside image_dir.')
+tf.app.flags.DEFINE_string(
+    'output_dir', './results/', 'Directory where the detections are written.')
+tf.app.flags.DEFINE_string(
+    'model_name', 'text_box_300', 'The name of the architecture to evaluate.')
+tf.app.flags.DEFINE_string(
+    'tile_shape', '',
+    'Network input shape of a tile, "height,width". Default: the training '
+    'shape of the model.')
+tf.app.flags.DEFINE_integer(
+    'tile_rows', 0, 'Rows of tiles, 0 for the native resolution.')
+tf.app.flags.DEFINE_integer(
+    'tile_cols', 0, 'Columns of tiles, 0 for the native resolution.')
+tf.app.flags.DEFINE_float(
+    'overlap', 0.2, 'Fraction of a tile shared with its neighbour.')
+tf.app.flags.DEFINE_integer(
+    'tile_batch_size', 16, 'Number of tiles in one forward pass.')
+tf.app.flags.DEFINE_boolean(
+    'full_image', True, 'Add the whole resized image as an extra tile.')
+tf.app.flags.DEFINE_float(
+    'select_threshold', 0.5, 'Selection threshold.')
+tf.app.flags.DEFINE_integer(
+    'select_top_k', 400, 'Select top-k detected bounding boxes per tile.')
+tf.app.flags.DEFINE_integer(
+    'keep_top_k', 200, 'Keep top-k detected objects.')
+tf.app.flags.DEFINE_float(
+    'nms_threshold', 0.25, 'Non-Maximum Selection threshold.')
+tf.app.flags.DEFINE_integer(
+    'layer_top_k', 0,
+    'If > 0, candidates kept per feature layer and tile before the NMS.')
+tf.app.flags.DEFINE_string(
+    'data_format', 'NHWC', 'Layout of the network: "NHWC" or "NCHW".')
+tf.app.flags.DEFINE_boolean(
+    'use_batch', True,
+    'Wheather use batch_norm or not')
+tf.app.flags.DEFINE_boolean(
+    'merge_heads', False,
+    'Merge the class and location heads of a feature layer.')
+tf.app.flags.DEFINE_boolean(
+    'use_whiten', True,
+    'Wheather use whiten or not,genally you can choose whiten or batchnorm tech.')
+tf.app.flags.DEFINE_float(
+    'moving_average_decay', None,
+    'The decay to use for the moving average.'
+    'If left as None, then moving averages are not used.')
+
+FLAGS = tf.app.flags.FLAGS
+
+
+def tile_grid(height, width, tile_shape, rows=0, cols=0, overlap=0.2,
+              full_image=True):
+    """Reference boxes of the tiles of an image.
+
+    Args:
+      height, width: Image size in pixels.
+      tile_shape: Network input shape, the tile size for rows/cols = 0.
+      rows, cols: Grid size, 0 to derive it from tile_shape.
+      overlap: Fraction of a tile shared with its neighbour, in [0, 1).
+      full_image: Append the [0, 0, 1, 1] box when there is more than a tile.
+    Return:
+      float32 [num_tiles, 4] array of ymin, xmin, ymax, xmax, relative to the
+      image.
+    """
+    if not 0. <= overlap < 1.:
+        raise ValueError('overlap must be in [0, 1), got %s' % overlap)
+
+    def _axis(size, tile_size, num):
+        if num <= 0:
+            num = max(1, int(math.ceil((size / tile_size - overlap) /
+                                       (1. - overlap))))
+        # Tiles of equal size covering exactly [0, 1].
+        length = 1. / (num - (num - 1) * overlap)
+        starts = np.arange(num) * length * (1. - overlap)
+        return np.stack([starts, np.minimum(starts + length, 1.)], axis=1)
+
+    ys = _axis(height, tile_shape[0], rows)
+    xs = _axis(width, tile_shape[1], cols)
+    tiles = [[y[0], x[0], y[1], x[1]] for y in ys for x in xs]
+    if full_image and len(tiles) > 1:
+        tiles.append([0., 0., 1., 1.])
+    return np.array(tiles, dtype=np.float32)
+
+
+def to_global(tile, bboxes):
+    """Map boxes relative to a tile back to image coordinates.
+
+    bboxes_resize(ref, .) maps image coordinates into the frame of `ref`: the
+    inverse is bboxes_resize with the image box expressed in the tile frame.
+    """
+    height = tile[2] - tile[0]
+    width = tile[3] - tile[1]
+    inverse = [-tile[0] / height, -tile[1] / width,
+               (1. - tile[0]) / height, (1. - tile[1]) / width]
+    return np_methods.bboxes_resize(inverse, bboxes)
+
+
+class TiledDetector(object):
+    """Tile, batch and stitch the detections of a TextboxNet.
+
+    The graph is built in the default graph at construction: `detect` then
+    runs one forward pass per `batch_size` tiles of an image and merges their
+    detections.
+    """
+
+    def __init__(self, net, tile_shape=None, rows=0, cols=0, overlap=0.2,
+                 batch_size=16, full_image=True, select_threshold=0.5,
+                 select_top_k=400, keep_top_k=200, nms_threshold=0.25,
+                 layer_top_k=None, data_format='NHWC', use_batch=True,
+                 merge_heads=False, use_whiten=True):
+        self.net = net
+        self.tile_shape = tuple(tile_shape or net.params.img_shape)
+        self.rows = rows
+        self.cols = cols
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.full_image = full_image
+        self.keep_top_k = keep_top_k
+        self.nms_threshold = nms_threshold
+
+        self.image = tf.placeholder(tf.uint8, [None, None, 3], name='image')
+        self.tiles = tf.placeholder(tf.float32, [None, 4], name='tiles')
+        # All the tiles of a batch are cropped and resized by one op.
+        images = tf.expand_dims(tf.to_float(self.image), 0)
+        crops = tf.image.crop_and_resize(
+            images, self.tiles, tf.zeros([tf.shape(self.tiles)[0]], tf.int32),
+            self.tile_shape)
+        if use_whiten:
+            means = [txt_preprocessing._R_MEAN, txt_preprocessing._G_MEAN,
+                     txt_preprocessing._B_MEAN]
+            crops = (crops - tf.constant(means)) / 255.0
+        if data_format == 'NCHW':
+            crops = tf.transpose(crops, perm=(0, 3, 1, 2))
+        with slim.arg_scope(net.arg_scope(data_format=data_format)):
+            localisations, logits, _ = \
+                net.net(crops, is_training=False, use_batch=use_batch,
+                        merge_heads=merge_heads)
+        predictions = [slim.softmax(l) for l in logits]
+        with tf.device('/device:CPU:0'):
+            # Only the selected boxes of the raw outputs are decoded.
+            rscores, rbboxes = \
+                net.detected_bboxes(predictions, localisations,
+                                    select_threshold=select_threshold,
+                                    nms_threshold=nms_threshold,
+                                    top_k=select_top_k,
+                                    keep_top_k=keep_top_k,
+                                    layer_top_k=layer_top_k,
+                                    anchors=net.anchors(self.tile_shape),
+                                    batched_nms=True)
+        # Text is the only class.
+        self.scores = rscores[1]
+        self.bboxes = rbboxes[1]
+
+    def tile_boxes(self, height, width):
+        return tile_grid(height, width, self.tile_shape, self.rows, self.cols,
+                         self.overlap, self.full_image)
+
+    def detect(self, sess, image):
+        """Detect the words of an image.
+
+        Args:
+          sess: Session holding the network variables.
+          image: uint8 [height, width, 3] array.
+        Return:
+          scores, bboxes, num_tiles: [N] scores and [N, 4] ymin, xmin, ymax,
+          xmax boxes relative to the image, by decreasing score.
+        """
+        tiles = self.tile_boxes(image.shape[0], image.shape[1])
+        l_scores = []
+        l_bboxes = []
+        for start in range(0, len(tiles), self.batch_size):
+            batch = tiles[start:start + self.batch_size]
+            scores, bboxes = sess.run([self.scores, self.bboxes],
+                                      feed_dict={self.image: image,
+                                                 self.tiles: batch})
+            for tile, t_scores, t_bboxes in zip(batch, scores, bboxes):
+                # Zero scores pad the NMS output.
+                mask = t_scores > 0.
+                l_scores.append(t_scores[mask])
+                l_bboxes.append(to_global(tile, t_bboxes[mask]))
+        scores = np.concatenate(l_scores)
+        bboxes = np.concatenate(l_bboxes).reshape([-1, 4])
+        classes = np.ones(scores.shape, dtype=np.int64)
+        # Global NMS: merge the words found by several tiles.
+        classes, scores, bboxes = np_methods.bboxes_sort(
+            classes, scores, bboxes, top_k=self.keep_top_k * len(tiles))
+        classes, scores, bboxes = np_methods.bboxes_nms(
+            classes, scores, bboxes, nms_threshold=self.nms_threshold)
+        bboxes = np_methods.bboxes_clip(bboxes)
+        return scores[:self.keep_top_k], bboxes[:self.keep_top_k], len(tiles)
+
+
+def write_detections(path, scores, bboxes, height, width):
+    with open(path, 'w') as f:
+        for score, bbox in zip(scores, bboxes):
+            f.write('%d,%d,%d,%d,%.4f\n' % (
+                int(bbox[1] * width), int(bbox[0] * height),
+                int(bbox[3] * width), int(bbox[2] * height), score))
+
+
+def main(_):
+    if tf.gfile.IsDirectory(FLAGS.checkpoint_path):
+        checkpoint_path = tf.train.latest_checkpoint(FLAGS.checkpoint_path)
+    else:
+        checkpoint_path = FLAGS.checkpoint_path
+    paths = sorted(tf.gfile.Glob(os.path.join(FLAGS.image_dir,
+                                              FLAGS.image_pattern)))
+    if not paths:
+        raise ValueError('No image matching %s in %s' % (FLAGS.image_pattern,
+                                                        FLAGS.image_dir))
+    tile_shape = None
+    if FLAGS.tile_shape:
+        tile_shape = [int(v) for v in FLAGS.tile_shape.split(',')]
+    tf.gfile.MakeDirs(FLAGS.output_dir)
+
+    with tf.Graph().as_default():
+        net = nets_factory.get_network(FLAGS.model_name)()
+        detector = TiledDetector(net, tile_shape,
+                                 rows=FLAGS.tile_rows,
+                                 cols=FLAGS.tile_cols,
+                                 overlap=FLAGS.overlap,
+                                 batch_size=FLAGS.tile_batch_size,
+                                 full_image=FLAGS.full_image,
+                                 select_threshold=FLAGS.select_threshold,
+                                 select_top_k=FLAGS.select_top_k,
+                                 keep_top_k=FLAGS.keep_top_k,
+                                 nms_threshold=FLAGS.nms_threshold,
+                                 layer_top_k=FLAGS.layer_top_k,
+                                 data_format=FLAGS.data_format,
+                                 use_batch=FLAGS.use_batch,
+                                 merge_heads=FLAGS.merge_heads,
+                                 use_whiten=FLAGS.use_whiten)
+        encoded = tf.placeholder(tf.string, [])
+        decoded = tf.image.decode_image(encoded, channels=3)
+
+        if FLAGS.moving_average_decay:
+            variable_averages = tf.train.ExponentialMovingAverage(
+                FLAGS.moving_average_decay)
+            variables_to_restore = variable_averages.variables_to_restore(
+                slim.get_model_variables())
+        else:
+            variables_to_restore = slim.get_variables_to_restore()
+        saver = tf.train.Saver(variables_to_restore)
+
+        with tf.Session() as sess:
+            saver.restore(sess, checkpoint_path)
+            num_tiles = 0
+            num_pixels = 0
+            detect_time = 0.
+            start = time.time()
+            for path in paths:
+                image = sess.run(decoded, feed_dict={
+                    encoded: tf.gfile.GFile(path, 'rb').read()})
+                height, width = image.shape[:2]
+                detect_start = time.time()
+                scores, bboxes, n = detector.detect(sess, image)
+                detect_time += time.time() - detect_start
+                num_tiles += n
+                num_pixels += height * width
+                name = os.path.splitext(os.path.basename(path))[0]
+                write_detections(os.path.join(FLAGS.output_dir,
+                                              'res_%s.txt' % name),
+                                 scores, bboxes, height, width)
+                print('%s: %dx%d, %d tiles, %d words' % (
+                    name, width, height, n, scores.shape[0]))
+            elapsed = time.time() - start
+
+    print('\n%d images, %d tiles in %.1f s (detection %.1f s)' % (
+        len(paths), num_tiles, elapsed, detect_time))
+    print('%.2f images/s, %.1f tiles/s, %.2f Mpixels/s (detection only)' % (
+        len(paths) / detect_time, num_tiles / detect_time,
+        num_pixels / 1e6 / detect_time))
+
+
+if __name__ == '__main__':
+    tf.app.run()
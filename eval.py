@@ -13,6 +13,7 @@ import os, os.path
 import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),'..')))
 import load_batch
+import profiling
 from nets import txtbox_300
 from nets import nets_factory
 slim = tf.contrib.slim
@@ -23,7 +24,6 @@ slim = tf.contrib.slim
 # List of recalls values at which precision is evaluated.
 LIST_RECALLS = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.85,
 				0.90, 0.95, 0.96, 0.97, 0.98, 0.99]
-DATA_FORMAT = 'NHWC'
 
 # =========================================================================== #
 # SSD evaluation Flags.
@@ -36,12 +36,37 @@ tf.app.flags.DEFINE_integer(
 	'keep_top_k', 200, 'Keep top-k detected objects.')
 tf.app.flags.DEFINE_float(
 	'nms_threshold', 0.25, 'Non-Maximum Selection threshold.')
+tf.app.flags.DEFINE_integer(
+	'layer_top_k', 0,
+	'If > 0, candidates kept per feature layer and image before the sort and '
+	'the NMS.')
+tf.app.flags.DEFINE_boolean(
+	'decode_selected', False,
+	'Select the top-k boxes on the raw network outputs and decode only those, '
+	'instead of decoding every anchor first.')
+tf.app.flags.DEFINE_boolean(
+	'batched_nms', False,
+	'Vectorized NMS of the whole batch instead of a map over the images.')
 tf.app.flags.DEFINE_float(
 	'matching_threshold', 0.5, 'Matching threshold with groundtruth objects.')
 tf.app.flags.DEFINE_integer(
 	'eval_resize', 4, 'Image resizing: None / CENTRAL_CROP / PAD_AND_RESIZE / WARP_RESIZE.')
 tf.app.flags.DEFINE_integer(
 	'eval_image_size', None, 'Eval image size.')
+tf.app.flags.DEFINE_string(
+	'eval_shape', '',
+	'Network input shape "height,width" of the evaluation, e.g. "384,768" for '
+	'wide images. Anchors are computed for it, no checkpoint change is '
+	'needed. If empty, the training shape of the network.')
+tf.app.flags.DEFINE_string(
+	'eval_scales', '',
+	'Comma-separated scale factors of the eval shape for multi-scale '
+	'inference, e.g. "0.75,1,1.5". Factors giving the same shape run once; the '
+	'detections of all the scales are merged by one NMS. Empty: single scale.')
+tf.app.flags.DEFINE_integer(
+	'scale_timing_batches', 20,
+	'With --eval_scales, number of batches timed per scale after the '
+	'evaluation (0 to skip).')
 tf.app.flags.DEFINE_boolean(
 	'remove_difficult', True, 'Remove difficult objects from evaluation.')
 tf.app.flags.DEFINE_integer(
@@ -76,6 +101,15 @@ tf.app.flags.DEFINE_integer(
 	'The number of threads used to create the batches.')
 tf.app.flags.DEFINE_string(
 	'dataset_dir', None, 'The directory where the dataset files are stored.')
+tf.app.flags.DEFINE_boolean(
+	'packed_bbox', False,
+	'Whether the tfrecords store the boxes as one packed float32 blob.')
+tf.app.flags.DEFINE_string(
+	'compression', '',
+	'Compression of the tfrecords: "", "GZIP" or "ZLIB".')
+tf.app.flags.DEFINE_string(
+	'data_format', 'NHWC',
+	'Layout of the network input: "NHWC" or "NCHW" (faster on CPU with MKL).')
 tf.app.flags.DEFINE_float(
 	'moving_average_decay', None,
 	'The decay to use for the moving average.'
@@ -92,14 +126,64 @@ tf.app.flags.DEFINE_integer('shuffle_data', False,
 tf.app.flags.DEFINE_boolean(
 	'use_batch', True,
 	'Wheather use batch_norm or not')
+tf.app.flags.DEFINE_boolean(
+	'merge_heads', False,
+	'Compute the class and location predictions with one convolution per '
+	'feature layer. Convert separate-heads checkpoints with export_model.py.')
 tf.app.flags.DEFINE_boolean(
 	'use_whiten', True,
 	'Wheather use whiten or not,genally you can choose whiten or batchnorm tech.')
+tf.app.flags.DEFINE_integer(
+	'profile_every_n_steps', 0,
+	'Profile one batch every n with a full trace: Chrome trace and op time '
+	'table by name scope in --profile_dir. 0 to disable.')
+tf.app.flags.DEFINE_string(
+	'profile_dir', '',
+	'Directory of the profiles, <eval_dir>/profile by default.')
 
 
 FLAGS = tf.app.flags.FLAGS
 
 
+def eval_scale_shapes(eval_shape, eval_scales):
+	"""Distinct network input shapes of the scales, from the smallest.
+	"""
+	if not eval_scales:
+		return [tuple(eval_shape)]
+	shapes = set()
+	for factor in eval_scales.split(','):
+		factor = float(factor)
+		shapes.add((int(round(eval_shape[0] * factor)),
+					int(round(eval_shape[1] * factor))))
+	return sorted(shapes, key=lambda s: s[0] * s[1])
+
+
+def time_scales(scale_fetches, detections, variables_to_restore,
+				checkpoint_path, config, num_batches):
+	"""Print the time of a batch at every scale (resize, network and, without
+	--decode_selected, box decoding) and of all the scales with the merged
+	NMS. Every run dequeues its own batch, the input pipeline is timed too.
+	"""
+	fetches = [('%dx%d' % shape, scale_fetches[shape])
+			   for shape in sorted(scale_fetches, key=lambda s: s[0] * s[1])]
+	fetches.append(('all + NMS', detections))
+	saver = tf.train.Saver(variables_to_restore)
+	with tf.Session(config=config) as sess:
+		sess.run(tf.local_variables_initializer())
+		saver.restore(sess, checkpoint_path)
+		with slim.queues.QueueRunners(sess):
+			print('\n%-12s %14s %14s' % ('scale', 'ms/batch', 'ms/image'))
+			for name, fetch in fetches:
+				# Warm up the kernels of this scale.
+				sess.run(fetch)
+				start = time.time()
+				for _ in range(num_batches):
+					sess.run(fetch)
+				elapsed = 1000. * (time.time() - start) / num_batches
+				print('%-12s %14.1f %14.1f' % (name, elapsed,
+											   elapsed / FLAGS.batch_size))
+
+
 def main(_):
 	if not FLAGS.dataset_dir:
 		raise ValueError('You must supply the dataset directory with --dataset_dir')
@@ -111,7 +195,13 @@ def main(_):
 		# initalize the net
 		network_fn = nets_factory.get_network(FLAGS.model_name)
 		net = network_fn()
-		out_shape = net.params.img_shape
+		if FLAGS.eval_shape:
+			eval_shape = tuple(int(v) for v in FLAGS.eval_shape.split(','))
+		else:
+			eval_shape = net.params.img_shape
+		scale_shapes = eval_scale_shapes(eval_shape, FLAGS.eval_scales)
+		# Images are read at the largest scale, the others are resized from it.
+		out_shape = scale_shapes[-1]
 		anchors = net.anchors(out_shape)
 		# =================================================================== #
 		# Create a dataset provider and batches.
@@ -127,31 +217,57 @@ def main(_):
 										 FLAGS,
 										 file_pattern =  '*.tfrecord',
 										 is_training = False,
-										 shuffe = FLAGS.shuffle_data)
+										 shuffe = FLAGS.shuffle_data,
+										 packed_bbox = FLAGS.packed_bbox,
+										 compression = FLAGS.compression)
 		b_gdifficults = tf.zeros(tf.shape(glabels), dtype=tf.int64)
 		dict_metrics = {}
-		arg_scope = net.arg_scope(data_format=DATA_FORMAT)
-		with slim.arg_scope(arg_scope):
-			localisations, logits, end_points  = \
-				net.net(b_image, is_training=False, use_batch=FLAGS.use_batch)
-		# Add losses functions.
-		total_loss = net.losses(logits, localisations,
-							  b_glocalisations, b_gscores)
-		predictions = []
-		for i in range(len(logits)):
-			predictions.append(slim.softmax(logits[i]))
+		arg_scope = net.arg_scope(data_format=FLAGS.data_format)
+		# One batch per scale: the images of the batch resized to its shape.
+		all_predictions = []
+		all_localisations = []
+		all_anchors = []
+		scale_fetches = {}
+		for i, shape in enumerate(scale_shapes):
+			s_image = b_image
+			if shape != out_shape:
+				s_image = tf.image.resize_bilinear(b_image, shape)
+			if FLAGS.data_format == 'NCHW':
+				s_image = tf.transpose(s_image, perm=(0, 3, 1, 2))
+			with slim.arg_scope(arg_scope):
+				localisations, logits, end_points  = \
+					net.net(s_image, is_training=False, use_batch=FLAGS.use_batch,
+							merge_heads=FLAGS.merge_heads, reuse=(i > 0) or None)
+			if shape == out_shape:
+				# Add losses functions.
+				total_loss = net.losses(logits, localisations,
+									  b_glocalisations, b_gscores)
+			predictions = []
+			for j in range(len(logits)):
+				predictions.append(slim.softmax(logits[j]))
+			if FLAGS.decode_selected:
+				all_anchors += net.anchors(shape)
+			else:
+				with tf.device('/device:CPU:0'):
+					localisations = net.bboxes_decode(localisations, net.anchors(shape))
+			all_predictions += predictions
+			all_localisations += localisations
+			scale_fetches[shape] = predictions + localisations
 		
 		# Performing post-processing on CPU: loop-intensive, usually more efficient.
 		with tf.device('/device:CPU:0'):
-			# Detected objects from SSD output.
-			localisations = net.bboxes_decode(localisations, anchors)
+			# Detected objects from SSD output, all the scales merged by one NMS.
 			rscores, rbboxes = \
-				net.detected_bboxes(predictions, localisations,
+				net.detected_bboxes(all_predictions, all_localisations,
 										select_threshold=FLAGS.select_threshold,
 										nms_threshold=FLAGS.nms_threshold,
 										clipping_bbox=None,
-										top_k=FLAGS.select_top_k,
-										keep_top_k=FLAGS.keep_top_k)
+										top_k=FLAGS.select_top_k * len(scale_shapes),
+										keep_top_k=FLAGS.keep_top_k,
+										layer_top_k=FLAGS.layer_top_k,
+										anchors=all_anchors or None,
+										batched_nms=FLAGS.batched_nms)
+			detections = [rscores, rbboxes]
 			# Compute TP and FP statistics.
 			num_gbboxes, tp, fp, rscores = \
 				tfe.bboxes_matching_batch(rscores.keys(), rscores, rbboxes,
@@ -234,6 +350,12 @@ def main(_):
 		else:
 			num_batches = math.ceil(FLAGS.num_samples / float(FLAGS.batch_size))
 
+		hooks = []
+		if FLAGS.profile_every_n_steps:
+			hooks.append(profiling.ProfileHook(
+				FLAGS.profile_dir or os.path.join(FLAGS.eval_dir, 'profile'),
+				FLAGS.profile_every_n_steps))
+
 		if not FLAGS.wait_for_checkpoints:
 			if tf.gfile.IsDirectory(FLAGS.checkpoint_path):
 				checkpoint_path = tf.train.latest_checkpoint(FLAGS.checkpoint_path)
@@ -250,12 +372,16 @@ def main(_):
 				num_evals=num_batches,
 				eval_op=list(names_to_updates.values()),
 				variables_to_restore=variables_to_restore,
-				session_config=config)
+				session_config=config,
+				hooks=hooks)
 			# Log time spent.
 			elapsed = time.time()
 			elapsed = elapsed - start
 			print('Time spent : %.3f seconds.' % elapsed)
 			print('Time spent per BATCH: %.3f seconds.' % (elapsed / num_batches))
+			if FLAGS.eval_scales and FLAGS.scale_timing_batches:
+				time_scales(scale_fetches, detections, variables_to_restore,
+							checkpoint_path, config, FLAGS.scale_timing_batches)
 
 		else:
 			checkpoint_path = FLAGS.checkpoint_path
@@ -272,7 +398,8 @@ def main(_):
 				eval_interval_secs=60,
 				max_number_of_evaluations=np.inf,
 				session_config=config,
-				timeout=None)
+				timeout=None,
+				hooks=hooks)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,303 @@
+"""
+Export a trained text box network for inference.
+
+With --fold_batch_norm (default), every conv2d followed by a batch norm
+(use_batch=True) is replaced by a single conv2d with bias:
+  scale = gamma / sqrt(moving_variance + epsilon)   (gamma = 1 without scale)
+  weights' = weights * scale        (per output channel)
+  biases'  = beta - moving_mean * scale
+The folded network is the use_batch=False graph of the same model, so the
+exported checkpoint holds no BatchNorm variable and the frozen graph no
+BatchNorm op. --merge_heads converts the checkpoint to the merged
+class/location heads layout (one convolution per feature layer, see
+custom_layers.merged_heads) and exports that network. --verify runs the
+original and exported networks on random inputs and fails if their outputs
+differ.
+
+Outputs in --output_dir:
+  model.ckpt      : checkpoint of the inference variables;
+  frozen_graph.pb : GraphDef with the variables as constants, input 'image'
+                    [batch_size, height, width, 3] (NHWC whatever
+                    --data_format, height and width unknown with
+                    --dynamic_shape), outputs 'logits_<i>' /
+                    'localisations_<i>'.
+
+python export_model.py --checkpoint_path=./checkpoints/ --output_dir=./export/
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework import graph_util
+
+from nets import nets_factory
+
+slim = tf.contrib.slim
+
+tf.app.flags.DEFINE_string(
+    'checkpoint_path', './checkpoints/',
+    'The directory where the model was written to or an absolute path to a '
+    'checkpoint file.')
+tf.app.flags.DEFINE_string(
+    'output_dir', './export/', 'Directory where the exported model is saved.')
+tf.app.flags.DEFINE_string(
+    'model_name', 'text_box_300', 'The name of the architecture to export.')
+tf.app.flags.DEFINE_string(
+    'data_format', 'NHWC',
+    'Layout of the exported network: "NHWC" or "NCHW".')
+tf.app.flags.DEFINE_integer(
+    'batch_size', 1, 'Batch size of the exported graph input.')
+tf.app.flags.DEFINE_boolean(
+    'dynamic_shape', False,
+    'Export the graph with an unknown input height and width. The anchors '
+    'of a given shape are then TextboxNet.anchors(shape).')
+tf.app.flags.DEFINE_boolean(
+    'use_batch', True,
+    'Wheather the checkpoint was trained with batch_norm or not')
+tf.app.flags.DEFINE_boolean(
+    'fold_batch_norm', True,
+    'Fold the batch norm statistics into the convolution weights.')
+tf.app.flags.DEFINE_boolean(
+    'merge_heads', False,
+    'Export with merged class/location heads, converting the checkpoint.')
+tf.app.flags.DEFINE_float(
+    'bn_epsilon', 0.001,
+    'Epsilon of the batch norm layers, as in the nets batch_norm_params.')
+tf.app.flags.DEFINE_float(
+    'moving_average_decay', None,
+    'If set, export the moving averages of the weights instead.')
+tf.app.flags.DEFINE_boolean(
+    'verify', True,
+    'Check the exported network against the original on random inputs.')
+tf.app.flags.DEFINE_integer(
+    'verify_batches', 4, 'Number of random batches compared by --verify.')
+tf.app.flags.DEFINE_float(
+    'verify_tolerance', 1e-4,
+    'Maximum difference allowed by --verify, relative to the largest output.')
+
+FLAGS = tf.app.flags.FLAGS
+
+BN_SCOPE = '/BatchNorm/'
+HEAD_SCOPES = ['conv_loc', 'conv_cls']
+MERGED_SCOPE = 'conv_merged'
+
+
+def read_checkpoint(checkpoint_path, moving_average_decay=None):
+    """Read every variable of a checkpoint into a {name: ndarray} dict.
+    Moving averages, if asked for, replace the variables they shadow.
+    """
+    reader = tf.train.NewCheckpointReader(checkpoint_path)
+    names = reader.get_variable_to_shape_map().keys()
+    values = {}
+    for name in names:
+        if name.endswith('/ExponentialMovingAverage'):
+            continue
+        ema_name = name + '/ExponentialMovingAverage'
+        if moving_average_decay and ema_name in names:
+            values[name] = reader.get_tensor(ema_name)
+        else:
+            values[name] = reader.get_tensor(name)
+    return values
+
+
+def is_merged(values):
+    """Whether a checkpoint uses the merged heads layout.
+    """
+    return any(name.endswith('/%s/weights' % MERGED_SCOPE) for name in values)
+
+
+def _head_slices(values, layer_scope):
+    """Output channels of every head inside a merged kernel.
+    """
+    slices = {}
+    start = 0
+    for head in HEAD_SCOPES:
+        prefix = '%s/%s' % (layer_scope, head)
+        if prefix + '/biases' in values:
+            size = values[prefix + '/biases'].shape[0]
+        else:
+            size = values[prefix + BN_SCOPE + 'moving_mean'].shape[0]
+        slices[head] = slice(start, start + size)
+        start += size
+    return slices
+
+
+def merge_heads(values):
+    """Convert a checkpoint with separate heads to the merged heads layout.
+
+    The class and location kernels of every feature layer are concatenated
+    along the output channels; biases and batch norm variables keep their
+    names.
+    """
+    merged = dict(values)
+    suffix = '/%s/weights' % HEAD_SCOPES[0]
+    for name in values:
+        if not name.endswith(suffix):
+            continue
+        layer_scope = name[:-len(suffix)]
+        kernels = [merged.pop('%s/%s/weights' % (layer_scope, head))
+                   for head in HEAD_SCOPES]
+        merged['%s/%s/weights' % (layer_scope, MERGED_SCOPE)] = \
+            np.concatenate(kernels, axis=3)
+    return merged
+
+
+def fold_batch_norm(values, epsilon=0.001):
+    """Fold the batch norm variables into the preceding convolutions.
+
+    Args:
+      values: {name: ndarray} of a use_batch=True network, separate or
+        merged heads.
+      epsilon: batch norm epsilon.
+    Return:
+      {name: ndarray} of the same network built with use_batch=False: the
+      BatchNorm variables are gone, the folded convolutions get `biases`.
+    """
+    folded = {}
+    for name, value in values.items():
+        if BN_SCOPE not in name:
+            folded[name] = value
+    for name in values:
+        if not name.endswith(BN_SCOPE + 'moving_mean'):
+            continue
+        scope = name[:-len(BN_SCOPE + 'moving_mean')]
+        mean = values[name]
+        variance = values[scope + BN_SCOPE + 'moving_variance']
+        gamma = values.get(scope + BN_SCOPE + 'gamma', np.ones_like(mean))
+        beta = values.get(scope + BN_SCOPE + 'beta', np.zeros_like(mean))
+        scale = gamma / np.sqrt(variance + epsilon)
+        # Kernels are [h, w, in, out]: scale the output channels.
+        if scope + '/weights' in values:
+            folded[scope + '/weights'] = values[scope + '/weights'] * scale
+        else:
+            # Head of a merged kernel: scale its slice only.
+            layer_scope, head = scope.rsplit('/', 1)
+            kernel_name = '%s/%s/weights' % (layer_scope, MERGED_SCOPE)
+            if head not in HEAD_SCOPES or kernel_name not in values:
+                raise ValueError('No convolution to fold %s into' % name)
+            kernel = np.array(folded[kernel_name])
+            kernel[..., _head_slices(values, layer_scope)[head]] *= scale
+            folded[kernel_name] = kernel
+        folded[scope + '/biases'] = beta - mean * scale
+    return folded
+
+
+def build_inference(net, use_batch, merge_heads, data_format, batch_size,
+                    dynamic_shape=False):
+    """Build the inference network on an NHWC 'image' placeholder.
+
+    Return:
+      image, outputs: placeholder and list of the logits and localisations.
+    """
+    shape = [None, None] if dynamic_shape else net.params.img_shape
+    image = tf.placeholder(tf.float32, [batch_size, shape[0], shape[1], 3],
+                           name='image')
+    inputs = image
+    if data_format == 'NCHW':
+        inputs = tf.transpose(inputs, perm=(0, 3, 1, 2))
+    with slim.arg_scope(net.arg_scope(data_format=data_format)):
+        localisations, logits, _ = \
+            net.net(inputs, is_training=False, use_batch=use_batch,
+                    merge_heads=merge_heads)
+    outputs = [tf.identity(l, name='logits_%d' % i)
+               for i, l in enumerate(logits)]
+    outputs += [tf.identity(l, name='localisations_%d' % i)
+                for i, l in enumerate(localisations)]
+    return image, outputs
+
+
+def load_values(sess, values):
+    """Load a {name: ndarray} dict into the global variables of the graph.
+    """
+    missing = []
+    for var in tf.global_variables():
+        if var.op.name in values:
+            var.load(values[var.op.name], sess)
+        else:
+            missing.append(var.op.name)
+    if missing:
+        raise ValueError('Variables missing from the checkpoint: %s' % missing)
+
+
+def _run_network(values, use_batch, inputs):
+    net = nets_factory.get_network(FLAGS.model_name)()
+    with tf.Graph().as_default():
+        image, outputs = build_inference(net, use_batch, is_merged(values),
+                                         FLAGS.data_format, FLAGS.batch_size)
+        with tf.Session() as sess:
+            load_values(sess, values)
+            return [sess.run(outputs, feed_dict={image: x}) for x in inputs]
+
+
+def verify(values, export_values, export_use_batch):
+    """Compare the original and exported networks on random inputs.
+    """
+    net = nets_factory.get_network(FLAGS.model_name)()
+    shape = net.params.img_shape
+    rng = np.random.RandomState(0)
+    # Whitened images are roughly in [-0.5, 0.5].
+    inputs = [rng.uniform(-0.5, 0.5, [FLAGS.batch_size, shape[0], shape[1], 3])
+              for _ in range(FLAGS.verify_batches)]
+    reference = _run_network(values, FLAGS.use_batch, inputs)
+    exported = _run_network(export_values, export_use_batch, inputs)
+    max_diff = 0.
+    max_value = 0.
+    for ref_outputs, exp_outputs in zip(reference, exported):
+        for r, e in zip(ref_outputs, exp_outputs):
+            max_diff = max(max_diff, np.max(np.abs(r - e)))
+            max_value = max(max_value, np.max(np.abs(r)))
+    relative = max_diff / max(max_value, 1e-12)
+    print('Verification: max abs diff %.3g, relative %.3g' % (max_diff, relative))
+    if relative > FLAGS.verify_tolerance:
+        raise ValueError('Exported network differs from the original: '
+                         'relative error %.3g > %.3g' % (relative,
+                                                         FLAGS.verify_tolerance))
+
+
+def main(_):
+    if tf.gfile.IsDirectory(FLAGS.checkpoint_path):
+        checkpoint_path = tf.train.latest_checkpoint(FLAGS.checkpoint_path)
+    else:
+        checkpoint_path = FLAGS.checkpoint_path
+    tf.logging.info('Exporting %s' % checkpoint_path)
+
+    values = read_checkpoint(checkpoint_path, FLAGS.moving_average_decay)
+    export_values = values
+    export_use_batch = FLAGS.use_batch
+    if FLAGS.use_batch and FLAGS.fold_batch_norm:
+        export_values = fold_batch_norm(values, FLAGS.bn_epsilon)
+        export_use_batch = False
+    if FLAGS.merge_heads and not is_merged(export_values):
+        export_values = merge_heads(export_values)
+
+    tf.gfile.MakeDirs(FLAGS.output_dir)
+    net = nets_factory.get_network(FLAGS.model_name)()
+    with tf.Graph().as_default() as graph:
+        _, outputs = build_inference(net, export_use_batch,
+                                     is_merged(export_values),
+                                     FLAGS.data_format, FLAGS.batch_size,
+                                     dynamic_shape=FLAGS.dynamic_shape)
+        num_bn = len([op for op in graph.get_operations()
+                      if 'BatchNorm' in op.name])
+        with tf.Session() as sess:
+            load_values(sess, export_values)
+            saver = tf.train.Saver(tf.global_variables(), write_version=2)
+            saver.save(sess, os.path.join(FLAGS.output_dir, 'model.ckpt'),
+                       write_meta_graph=False)
+            graph_def = graph_util.convert_variables_to_constants(
+                sess, graph.as_graph_def(), [o.op.name for o in outputs])
+        tf.train.write_graph(graph_def, FLAGS.output_dir, 'frozen_graph.pb',
+                             as_text=False)
+    print('Exported %s to %s (%d BatchNorm ops)' % (FLAGS.model_name,
+                                                    FLAGS.output_dir, num_bn))
+
+    if FLAGS.verify:
+        verify(values, export_values, export_use_batch)
+
+
+if __name__ == '__main__':
+    tf.app.run()
@@ -0,0 +1,111 @@
+"""
+Launch a distributed training as local processes.
+
+Starts --num_ps parameter servers and --num_workers workers of
+Textbox_train.py on consecutive ports of --host, with the matching
+--job_name, --task, --ps_hosts and --worker_hosts flags. Worker 0 is the chief
+(initialization, summaries and checkpoints), the gradients of the workers are
+aggregated by SyncReplicasOptimizer (--sync_replicas=False for asynchronous
+updates) and every worker reads its own subset of the record files. Any other
+argument is passed to every process. The output of every process goes to
+--log_dir/<job>_<task>.log. The parameter servers are stopped when all the
+workers are done.
+
+python launch_distributed.py --num_workers=4 --num_ps=1 -- \
+    --dataset_dir=./data/sythtext/ --train_dir=./logs/ --clone_on_cpu=True
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+
+def cluster_hosts(host, base_port, num_ps, num_workers):
+    """host:port lists of the parameter servers and of the workers, on
+    consecutive ports.
+    """
+    ps_hosts = ['%s:%d' % (host, base_port + i) for i in range(num_ps)]
+    worker_hosts = ['%s:%d' % (host, base_port + num_ps + i)
+                    for i in range(num_workers)]
+    return ps_hosts, worker_hosts
+
+
+def start_process(script, job_name, task, ps_hosts, worker_hosts, extra_args,
+                  log_dir, gpu=None):
+    command = [sys.executable, script,
+               '--job_name=%s' % job_name,
+               '--task=%d' % task,
+               '--ps_hosts=%s' % ','.join(ps_hosts),
+               '--worker_hosts=%s' % ','.join(worker_hosts)] + extra_args
+    env = dict(os.environ)
+    if gpu is not None:
+        env['CUDA_VISIBLE_DEVICES'] = gpu
+    log = open(os.path.join(log_dir, '%s_%d.log' % (job_name, task)), 'w')
+    print('%s %d: %s' % (job_name, task, ' '.join(command)))
+    return subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT,
+                            env=env)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Launch a local distributed training.')
+    parser.add_argument('--num_workers', type=int, default=2)
+    parser.add_argument('--num_ps', type=int, default=1)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--base_port', type=int, default=2222)
+    parser.add_argument('--script', default='Textbox_train.py')
+    parser.add_argument('--log_dir', default='./logs/distributed/')
+    parser.add_argument('--worker_gpus', default=None,
+                        help='Comma-separated CUDA_VISIBLE_DEVICES of the '
+                        'workers, round robin. Parameter servers never use '
+                        'a GPU.')
+    args, extra_args = parser.parse_known_args(argv[1:])
+    if extra_args and extra_args[0] == '--':
+        extra_args = extra_args[1:]
+
+    if not os.path.isdir(args.log_dir):
+        os.makedirs(args.log_dir)
+    ps_hosts, worker_hosts = cluster_hosts(args.host, args.base_port,
+                                           args.num_ps, args.num_workers)
+    gpus = args.worker_gpus.split(',') if args.worker_gpus else None
+
+    ps = [start_process(args.script, 'ps', i, ps_hosts, worker_hosts,
+                        extra_args, args.log_dir, gpu='')
+          for i in range(args.num_ps)]
+    workers = [start_process(args.script, 'worker', i, ps_hosts, worker_hosts,
+                             extra_args, args.log_dir,
+                             gpu=gpus[i % len(gpus)] if gpus else None)
+               for i in range(args.num_workers)]
+    failed = False
+    try:
+        running = list(workers)
+        while running:
+            time.sleep(1)
+            for p in list(running):
+                if p.poll() is None:
+                    continue
+                running.remove(p)
+                if p.returncode != 0:
+                    print('worker %d failed (exit code %d), see %s' % (
+                        workers.index(p), p.returncode, args.log_dir))
+                    failed = True
+            if failed:
+                break
+    except KeyboardInterrupt:
+        failed = True
+    finally:
+        for p in workers + ps:
+            if p.poll() is None:
+                p.terminate()
+        for p in workers + ps:
+            p.wait()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -13,6 +13,32 @@ from processing import txt_preprocessing
 slim = tf.contrib.slim
 
 
+def worker_files(dataset_dir, file_pattern, worker_index, num_workers):
+	"""
+	Record files read by one of num_workers workers (replicas and clones).
+	Every file goes to a single worker: largest first, to the worker with
+	the fewest bytes so far, so that uneven shards still give every worker
+	about the same number of records. Raises a ValueError with fewer files
+	than workers, rather than having workers read the same files.
+	"""
+	files = sorted(tf.gfile.Glob(os.path.join(dataset_dir, file_pattern)))
+	if len(files) < num_workers:
+		raise ValueError('%d record files for %d input pipelines (replicas x '
+						 'clones): write the records with at least that many '
+						 'shards, or lower --num_clones' % (len(files), num_workers))
+	sizes = dict((f, tf.gfile.Stat(f).length) for f in files)
+	loads = [0] * num_workers
+	shards = [[] for _ in range(num_workers)]
+	for f in sorted(files, key=lambda f: (-sizes[f], f)):
+		worker = loads.index(min(loads))
+		shards[worker].append(f)
+		loads[worker] += sizes[f]
+	tf.logging.info('Worker %d/%d reads %d files, %.1f MB (largest worker %.1f MB)'
+					% (worker_index, num_workers, len(shards[worker_index]),
+					   loads[worker_index] / 2.**20, max(loads) / 2.**20))
+	return sorted(shards[worker_index])
+
+
 def get_batch(dataset_dir,
 			  num_readers,
 			  batch_size,
@@ -22,9 +48,21 @@ def get_batch(dataset_dir,
 			  FLAGS,
 			  file_pattern = '*.tfrecord',
 			  is_training = True,
-			  shuffe = False):
+			  shuffe = False,
+			  packed_bbox = False,
+			  compression = None,
+			  data_format = 'NHWC',
+			  worker_index = 0,
+			  num_workers = 1):
 	
-	dataset = sythtextprovider.get_datasets(dataset_dir,file_pattern = file_pattern)
+	data_sources = None
+	if num_workers > 1:
+		data_sources = worker_files(dataset_dir, file_pattern,
+									worker_index, num_workers)
+	dataset = sythtextprovider.get_datasets(dataset_dir,file_pattern = file_pattern,
+											packed_bbox = packed_bbox,
+											compression = compression,
+											data_sources = data_sources)
 
 	provider = slim.dataset_data_provider.DatasetDataProvider(
 				dataset,
@@ -59,6 +97,9 @@ def get_batch(dataset_dir,
 
 		b_image, b_glocalisations, b_gscores= \
 			tf_utils.reshape_list(r, batch_shape)
+		# Preprocessing works on NHWC images, transpose the batch once.
+		if data_format == 'NCHW':
+			b_image = tf.transpose(b_image, perm=(0, 3, 1, 2))
 
 		return b_image, b_glocalisations, b_gscores
 
@@ -80,6 +121,8 @@ def get_batch(dataset_dir,
 
 		image, glabels, gbboxes,g_bbox_img,glocalisations, gscores = \
 			tf_utils.reshape_list(r, batch_shape)
+		if data_format == 'NCHW':
+			image = tf.transpose(image, perm=(0, 3, 1, 2))
 
 		return image, glabels, gbboxes, g_bbox_img, glocalisations, gscores
 
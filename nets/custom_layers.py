@@ -27,6 +27,8 @@ from tensorflow.python.ops import nn
 from tensorflow.python.ops import init_ops
 from tensorflow.python.ops import variable_scope
 
+slim = tf.contrib.slim
+
 
 def abs_smooth(x):
     """Smoothed absolute function. Useful to compute an L1 smooth error.
@@ -89,7 +91,7 @@ def l2_normalization(
         elif data_format == 'NCHW':
             # norm_dim = tf.range(2, inputs_rank)
             norm_dim = tf.range(1, 2)
-            params_shape = (inputs_shape[1])
+            params_shape = inputs_shape[1:2]
 
         # Normalize along spatial dimensions.
         outputs = nn.l2_normalize(inputs, norm_dim, epsilon=1e-12)
@@ -162,3 +164,72 @@ def channel_to_last(inputs,
         elif data_format == 'NCHW':
             net = tf.transpose(inputs, perm=(0, 2, 3, 1))
         return net
+
+
+def merged_heads(inputs,
+                 num_outputs,
+                 kernel_size,
+                 head_scopes,
+                 use_batch,
+                 batch_norm_params,
+                 padding='SAME',
+                 scope='conv_merged'):
+    """Compute several prediction heads with a single convolution.
+
+    The bias-free kernel of all the heads lives in `scope`; the output is
+    moved channel last and split, then every head gets its own biases or
+    batch norm under its head scope. Variable names thus match the ones of
+    separate `slim.conv2d` heads, and converting a checkpoint only requires
+    concatenating the kernels along the output channels.
+
+    Args:
+      inputs: 4D input Tensor;
+      num_outputs: List of output channels of every head;
+      kernel_size: Kernel size shared by the heads;
+      head_scopes: List of the scope names of the separate heads;
+      use_batch: List of booleans, batch norm or biases for every head;
+      batch_norm_params: List of the batch norm parameters of every head;
+      padding: Padding of the convolution.
+    Return:
+      List of the head outputs, in NHWC format.
+    """
+    net = slim.conv2d(inputs, sum(num_outputs), kernel_size,
+                      activation_fn=None, normalizer_fn=None,
+                      biases_initializer=None, padding=padding, scope=scope)
+    net = channel_to_last(net)
+    outputs = tf.split(net, num_outputs, axis=3)
+    for i, head_scope in enumerate(head_scopes):
+        # Per-channel ops: applying them on a slice is exact.
+        if use_batch[i]:
+            with tf.variable_scope(head_scope):
+                outputs[i] = slim.batch_norm(outputs[i], data_format='NHWC',
+                                             **batch_norm_params[i])
+        else:
+            outputs[i] = slim.bias_add(outputs[i], data_format='NHWC',
+                                       scope=head_scope)
+    return outputs
+
+
+
+def recompute_block(block_fn, inputs, recompute=True):
+    """Run a block of layers, keeping only its output for the backward pass.
+
+    With `recompute`, the intermediate activations of `block_fn(inputs)` are
+    freed after the forward pass and computed again during backprop
+    (tf.contrib.layers.recompute_grad): less activation memory for one more
+    forward pass of the block. The block must not have side effects such as
+    batch norm updates. Its variables are resource variables, with the same
+    names (and checkpoints) as without recompute.
+
+    Args:
+      block_fn: Function of a Tensor, creating its variables in the current
+        variable scope;
+      inputs: Input Tensor;
+      recompute: If False, simply return block_fn(inputs).
+    Return:
+      Output Tensor of the block.
+    """
+    if not recompute:
+        return block_fn(inputs)
+    with tf.variable_scope(tf.get_variable_scope(), use_resource=True):
+        return tf.contrib.layers.recompute_grad(block_fn)(inputs)
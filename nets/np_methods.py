@@ -238,6 +238,50 @@ def bboxes_nms(classes, scores, bboxes, nms_threshold=0.45):
     return classes[idxes], scores[idxes], bboxes[idxes]
 
 
+def bboxes_nms_padded(scores, bboxes, nms_threshold=0.5, keep_top_k=200):
+    """Reference of tfe.bboxes_nms_batch_padded, i.e. of
+    tf.image.non_max_suppression applied image per image: greedy selection
+    by decreasing score, suppression above nms_threshold, zero jaccard for
+    empty boxes.
+
+    Args:
+      scores: Batch x N array; bboxes: Batch x N x 4 array.
+    Return:
+      scores, bboxes, num_valid: Batch x keep_top_k | x 4 arrays padded with
+      zero, and the number of boxes kept with a positive score.
+    """
+    batch_size = scores.shape[0]
+    out_scores = np.zeros((batch_size, keep_top_k), dtype=scores.dtype)
+    out_bboxes = np.zeros((batch_size, keep_top_k, 4), dtype=bboxes.dtype)
+    num_valid = np.zeros((batch_size, ), dtype=np.int32)
+    for b in range(batch_size):
+        boxes = np.concatenate([np.minimum(bboxes[b, :, :2], bboxes[b, :, 2:]),
+                                np.maximum(bboxes[b, :, :2], bboxes[b, :, 2:])],
+                               axis=1)
+        vol = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        selected = []
+        for i in np.argsort(-scores[b], kind='mergesort'):
+            if len(selected) == keep_top_k:
+                break
+            suppressed = False
+            for j in selected:
+                if vol[i] <= 0. or vol[j] <= 0.:
+                    continue
+                h = min(boxes[i, 2], boxes[j, 2]) - max(boxes[i, 0], boxes[j, 0])
+                w = min(boxes[i, 3], boxes[j, 3]) - max(boxes[i, 1], boxes[j, 1])
+                inter = max(h, 0.) * max(w, 0.)
+                if inter / (vol[i] + vol[j] - inter) > nms_threshold:
+                    suppressed = True
+                    break
+            if not suppressed:
+                selected.append(i)
+        n = len(selected)
+        out_scores[b, :n] = scores[b, selected]
+        out_bboxes[b, :n] = bboxes[b, selected]
+        num_valid[b] = np.sum(out_scores[b] > 0.)
+    return out_scores, out_bboxes, num_valid
+
+
 import numpy as np
  
 # Malisiewicz et al.
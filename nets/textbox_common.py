@@ -244,6 +244,27 @@ def textbox_anchor_one_layer(img_shape,
 
 
 
+def scaled_shape(img_shape, short_side=None, multiple=32):
+    """
+    Network input shape keeping the aspect ratio of an image.
+
+    Arguments:
+      img_shape: (height, width) of the image;
+      short_side: Length of the short side after resizing. None keeps the
+        native resolution;
+      multiple: Both sides are rounded to a multiple of it, which bounds the
+        number of distinct shapes, hence of anchor sets to compute.
+    Return:
+      (height, width) tuple.
+    """
+    height, width = float(img_shape[0]), float(img_shape[1])
+    if short_side is not None:
+        factor = float(short_side) / min(height, width)
+        height, width = height * factor, width * factor
+    return (max(multiple, int(round(height / multiple)) * multiple),
+            max(multiple, int(round(width / multiple)) * multiple))
+
+
 ## produce anchor for all layers
 def textbox_achor_all_layers(img_shape,
                            layers_shape,
@@ -329,6 +350,7 @@ def tf_ssd_bboxes_select_layer(predictions_layer, localizations_layer,
                                select_threshold=None,
                                num_classes=21,
                                ignore_class=0,
+                               top_k=None,
                                scope=None):
     """Extract classes, scores and bounding boxes from features in one layer.
     Batch-compatible: inputs are supposed to have batch-type shapes.
@@ -338,6 +360,8 @@ def tf_ssd_bboxes_select_layer(predictions_layer, localizations_layer,
       localizations_layer: A SSD localization layer;
       select_threshold: Classification threshold for selecting a box. All boxes
         under the threshold are set to 'zero'. If None, no threshold applied.
+      top_k: If set, keep only the top_k scores of every image, N = top_k
+        (or the number of anchors of the layer if smaller).
     Return:
       d_scores, d_bboxes: Dictionary of scores and bboxes Tensors of
         size Batches X N x 1 | 4. Each key corresponding to a class.
@@ -347,6 +371,9 @@ def tf_ssd_bboxes_select_layer(predictions_layer, localizations_layer,
                        [predictions_layer, localizations_layer]):
         # Reshape features: Batches x N x N_labels | 4
         p_shape = tfe.get_shape(predictions_layer)
+        num_anchors = 1
+        for d in p_shape[1:-1]:
+            num_anchors = num_anchors * d
         predictions_layer = tf.reshape(predictions_layer,
                                        tf.stack([p_shape[0], -1, p_shape[-1]]))
         l_shape = tfe.get_shape(localizations_layer)
@@ -362,6 +389,9 @@ def tf_ssd_bboxes_select_layer(predictions_layer, localizations_layer,
                 fmask = tf.cast(tf.greater_equal(scores, select_threshold), scores.dtype)
                 scores = scores * fmask
                 bboxes = localizations_layer * tf.expand_dims(fmask, axis=-1)
+                if top_k:
+                    scores, bboxes = _layer_top_k(scores, bboxes, top_k,
+                                                  num_anchors)
                 # Append to dictionary.
                 d_scores[c] = scores
                 d_bboxes[c] = bboxes
@@ -369,10 +399,56 @@ def tf_ssd_bboxes_select_layer(predictions_layer, localizations_layer,
         return d_scores, d_bboxes
 
 
+def _batch_gather(params, idxes):
+    """params[i, idxes[i]] for every image i of a Batches x N x D Tensor.
+    The whole batch is gathered at once, with flat indices.
+    """
+    shape = tfe.get_shape(params, 3)
+    offsets = tf.range(shape[0]) * shape[1]
+    idxes = idxes + tf.expand_dims(offsets, 1)
+    return tf.gather(tf.reshape(params, [-1, shape[2]]), idxes)
+
+
+def _top_k_indices(scores, top_k, num_anchors, sorted=False):
+    """tf.nn.top_k with k = min(top_k, num_anchors), static if num_anchors is.
+    """
+    if isinstance(num_anchors, tf.Tensor):
+        top_k = tf.minimum(top_k, num_anchors)
+    else:
+        top_k = min(top_k, num_anchors)
+    return tf.nn.top_k(scores, k=top_k, sorted=sorted)
+
+
+def pad_to_top_k(tensors, top_k):
+    """Zero-pad Batches x N | x 4 Tensors along N to at least top_k, so that
+    a top_k over them is valid and of static size top_k even when N is
+    smaller or unknown. Padded candidates have a zero score.
+    """
+    num = tfe.get_shape(tensors[0], 2)[1]
+    if isinstance(num, int):
+        if num >= top_k:
+            return tensors
+        padding = top_k - num
+    else:
+        padding = tf.maximum(top_k - num, 0)
+    return [tf.pad(t, tf.stack([[0, 0], [0, padding]] +
+                               [[0, 0]] * (len(t.get_shape()) - 2)))
+            for t in tensors]
+
+
+def _layer_top_k(scores, bboxes, top_k, num_anchors):
+    """Top_k scores of every image and their boxes, Batches x N | x 4 Tensors
+    with N = min(top_k, num_anchors), static if num_anchors is.
+    """
+    scores, idxes = _top_k_indices(scores, top_k, num_anchors)
+    return scores, _batch_gather(bboxes, idxes)
+
+
 def tf_ssd_bboxes_select(predictions_net, localizations_net,
                          select_threshold=None,
                          num_classes=21,
                          ignore_class=0,
+                         top_k=None,
                          scope=None):
     """Extract classes, scores and bounding boxes from network output layers.
     Batch-compatible: inputs are supposed to have batch-type shapes.
@@ -382,6 +458,8 @@ def tf_ssd_bboxes_select(predictions_net, localizations_net,
       localizations_net: List of localization layers;
       select_threshold: Classification threshold for selecting a box. All boxes
         under the threshold are set to 'zero'. If None, no threshold applied.
+      top_k: If set, candidates kept per layer and per image before the
+        layers are concatenated.
     Return:
       d_scores, d_bboxes: Dictionary of scores and bboxes Tensors of
         size Batches X N x 1 | 4. Each key corresponding to a class.
@@ -395,7 +473,8 @@ def tf_ssd_bboxes_select(predictions_net, localizations_net,
                                                         localizations_net[i],
                                                         select_threshold,
                                                         num_classes,
-                                                        ignore_class)
+                                                        ignore_class,
+                                                        top_k=top_k)
             l_scores.append(scores)
             l_bboxes.append(bboxes)
         # Concat results.
@@ -409,6 +488,128 @@ def tf_ssd_bboxes_select(predictions_net, localizations_net,
         return d_scores, d_bboxes
 
 
+def anchors_table(anchors):
+    """Flatten the anchors of all the layers into one [N, 4] numpy table of
+    (cy, cx, h, w), in the order of the flattened network outputs.
+    """
+    tables = []
+    for anchors_layer in anchors:
+        shape = np.broadcast(*anchors_layer).shape
+        tables.append(np.stack([np.broadcast_to(a, shape).reshape(-1)
+                                for a in anchors_layer], axis=1))
+    return np.concatenate(tables, axis=0)
+
+
+def tf_ssd_bboxes_decode_selected(localizations, anchors,
+                                  prior_scaling=[0.1, 0.1, 0.2, 0.2]):
+    """Decode gathered raw localizations, same as tf_ssd_bboxes_decode_layer.
+
+    Arguments:
+      localizations: Tensor ... x 4 of raw localization features;
+      anchors: Tensor ... x 4 of their (cy, cx, h, w) anchors.
+    Return:
+      Tensor ... x 4: ymin, xmin, ymax, xmax
+    """
+    yref, xref, href, wref = tf.unstack(anchors, axis=-1)
+    cx = localizations[..., 0] * wref * prior_scaling[0] + xref
+    cy = localizations[..., 1] * href * prior_scaling[1] + yref
+    w = wref * tf.exp(localizations[..., 2] * prior_scaling[2])
+    h = href * tf.exp(localizations[..., 3] * prior_scaling[3])
+    return tf.stack([cy - h / 2., cx - w / 2., cy + h / 2., cx + w / 2.],
+                    axis=-1)
+
+
+def tf_ssd_bboxes_select_decode(predictions_net, localizations_net, anchors,
+                                select_threshold=None,
+                                num_classes=21,
+                                ignore_class=0,
+                                top_k=400,
+                                layer_top_k=None,
+                                prior_scaling=[0.1, 0.1, 0.2, 0.2],
+                                scope=None):
+    """Select and sort the top_k boxes, then decode only those.
+
+    Same result as tf_ssd_bboxes_decode, tf_ssd_bboxes_select and
+    tfe.bboxes_sort, but the raw localizations of the discarded anchors are
+    never decoded: the top_k raw offsets and their anchors are gathered from
+    the flattened anchor table and decoded.
+
+    Args:
+      predictions_net: List of SSD prediction layers;
+      localizations_net: List of raw (not decoded) localization layers;
+      anchors: List of numpy anchors of the layers, as TextboxNet.anchors;
+      select_threshold: Classification threshold, lower scores and their
+        boxes are set to zero. If None, no threshold applied.
+      top_k: Boxes kept per image, sorted by decreasing score;
+      layer_top_k: If set, candidates kept per layer before the top_k.
+    Return:
+      d_scores, d_bboxes: Dictionary of scores and bboxes Tensors of
+        size Batches X top_k | x 4. Each key corresponding to a class.
+    """
+    select_threshold = 0.0 if select_threshold is None else select_threshold
+    with tf.name_scope(scope, 'ssd_bboxes_select_decode',
+                       [predictions_net, localizations_net]):
+        table = tf.constant(anchors_table(anchors))
+        l_predictions = []
+        l_localizations = []
+        l_sizes = []
+        for predictions_layer, localizations_layer in zip(predictions_net,
+                                                          localizations_net):
+            p_shape = tfe.get_shape(predictions_layer)
+            num_anchors = 1
+            for d in p_shape[1:-1]:
+                num_anchors = num_anchors * d
+            l_predictions.append(tf.reshape(
+                predictions_layer, tf.stack([p_shape[0], -1, p_shape[-1]])))
+            l_localizations.append(tf.reshape(
+                localizations_layer, tf.stack([p_shape[0], -1, 4])))
+            l_sizes.append(num_anchors)
+
+        d_scores = {}
+        d_bboxes = {}
+        for c in range(0, num_classes):
+            if c == ignore_class:
+                continue
+            if layer_top_k:
+                # Candidates of every layer, with their row in the table.
+                l_scores = []
+                l_rows = []
+                l_locs = []
+                start = 0
+                for i, num_anchors in enumerate(l_sizes):
+                    scores, idxes = _top_k_indices(l_predictions[i][:, :, c],
+                                                   layer_top_k, num_anchors)
+                    l_scores.append(scores)
+                    l_rows.append(idxes + start)
+                    l_locs.append(_batch_gather(l_localizations[i], idxes))
+                    start = start + num_anchors
+                scores = tf.concat(l_scores, axis=1)
+                rows = tf.concat(l_rows, axis=1)
+                localizations = tf.concat(l_locs, axis=1)
+            else:
+                scores = tf.concat([p[:, :, c] for p in l_predictions], axis=1)
+                rows = None
+                localizations = tf.concat(l_localizations, axis=1)
+            # Padded candidates point to row 0 and are masked below.
+            candidates = pad_to_top_k(
+                [scores, localizations] + ([rows] if rows is not None else []),
+                top_k)
+            scores, localizations = candidates[:2]
+            scores, idxes = tf.nn.top_k(scores, k=top_k, sorted=True)
+            localizations = _batch_gather(localizations, idxes)
+            if rows is not None:
+                idxes = _batch_gather(tf.expand_dims(candidates[2], -1),
+                                      idxes)[:, :, 0]
+            bboxes = tf_ssd_bboxes_decode_selected(
+                localizations, tf.gather(table, idxes), prior_scaling)
+            # Remove boxes under the threshold.
+            fmask = tf.cast(tf.greater_equal(scores, select_threshold),
+                            scores.dtype)
+            d_scores[c] = scores * fmask
+            d_bboxes[c] = bboxes * tf.expand_dims(fmask, axis=-1)
+        return d_scores, d_bboxes
+
+
 def tf_ssd_bboxes_select_layer_all_classes(predictions_layer, localizations_layer,
                                            select_threshold=None):
     """Extract classes, scores and bounding boxes from features in one layer.
@@ -481,3 +682,88 @@ def tf_ssd_bboxes_select_all_classes(predictions_net, localizations_net,
         bboxes = tf.concat(l_bboxes, axis=1)
         return classes, scores, bboxes
 
+
+
+# =========================================================================== #
+# Hard negative mining.
+# =========================================================================== #
+def hard_negative_mask(loss_neg, nmask, pmask, negative_ratio=3.,
+                       mode='global', num_bins=256):
+    """Negatives kept by the online hard example mining.
+
+    Arguments:
+      loss_neg: Batches x N loss of the anchors, zero on the positives;
+      nmask, pmask: Batches x N boolean negative and positive masks;
+      negative_ratio: Negatives kept per positive (plus one);
+      mode: 'global': top (n_pos + 1) * negative_ratio negative losses of the
+        whole batch, thresholded by the smallest one;
+        'per_image': the same selection inside every image, so that an image
+        with many hard negatives cannot starve the others. A single top_k of
+        the largest per-image count replaces the top_k over the batch;
+        'histogram': per image too, at a fixed cost: the threshold is the
+        edge of a num_bins histogram of the losses, which keeps the
+        negatives of the threshold bin as well.
+    Return:
+      Batches x N boolean mask of the kept negatives.
+    """
+    if mode == 'global':
+        n_pos = tf.reduce_sum(tf.cast(pmask, tf.int32)) + 1
+        loss_neg_flat = tf.reshape(loss_neg, [-1])
+        n_neg = tf.minimum(tf.cast(negative_ratio * tf.cast(n_pos, tf.float32),
+                                   tf.int32),
+                           tf.size(loss_neg_flat))
+        val, idxes = tf.nn.top_k(loss_neg_flat, k=n_neg)
+        minval = val[-1]
+        return tf.logical_and(nmask, loss_neg >= minval)
+
+    # Negatives kept in every image.
+    n_pos = tf.reduce_sum(tf.cast(pmask, tf.int32), axis=1) + 1
+    n_neg = tf.minimum(tf.cast(negative_ratio * tf.cast(n_pos, tf.float32),
+                               tf.int32),
+                       tf.shape(loss_neg)[1])
+    if mode == 'per_image':
+        val, idxes = tf.nn.top_k(loss_neg, k=tf.reduce_max(n_neg))
+        # n_neg-th largest loss of every image.
+        minval = _batch_gather(tf.expand_dims(val, -1),
+                               tf.expand_dims(n_neg - 1, 1))[:, :, 0]
+    elif mode == 'histogram':
+        batch_size = tf.shape(loss_neg)[0]
+        maxval = tf.expand_dims(tf.reduce_max(loss_neg, axis=1), 1)
+        width = maxval / num_bins + 1e-12
+        bins = tf.minimum(tf.cast(loss_neg / width, tf.int32), num_bins - 1)
+        # Histograms of all the images with one segment sum.
+        bins = bins + tf.expand_dims(tf.range(batch_size) * num_bins, 1)
+        counts = tf.unsorted_segment_sum(tf.ones_like(loss_neg), bins,
+                                         batch_size * num_bins)
+        counts = tf.reshape(counts, tf.stack([batch_size, num_bins]))
+        # Highest bin with at least n_neg losses above its lower edge.
+        above = tf.cumsum(counts, axis=1, reverse=True)
+        reach = above >= tf.expand_dims(tf.cast(n_neg, above.dtype), 1)
+        threshold_bin = tf.reduce_sum(tf.cast(reach, tf.int32), axis=1) - 1
+        minval = tf.expand_dims(tf.cast(threshold_bin, width.dtype), 1) * width
+    else:
+        raise ValueError('Unknown hard negative mining mode %s' % mode)
+    return tf.logical_and(nmask, loss_neg >= minval)
+
+
+def focal_loss(logits, labels, gamma=2., alpha=0.25):
+    """Focal loss of every anchor, -alpha_t * (1 - p_t)^gamma * log(p_t)
+    (Lin et al., Focal Loss for Dense Object Detection). The easy negatives
+    are down-weighted instead of sampled: no sort over the anchors.
+
+    Arguments:
+      logits: ... x num_classes Tensor;
+      labels: ... int Tensor, 0 for the background;
+      gamma: Focusing parameter, 0 gives the cross entropy;
+      alpha: Weight of the positives, 1 - alpha for the background.
+    Return:
+      ... Tensor of losses.
+    """
+    cross_entropy = tf.nn.sparse_softmax_cross_entropy_with_logits(
+        logits=logits, labels=labels)
+    # Probability of the true class.
+    p_t = tf.exp(-cross_entropy)
+    alpha_t = tf.where(labels > 0,
+                       alpha * tf.ones_like(cross_entropy),
+                       (1. - alpha) * tf.ones_like(cross_entropy))
+    return alpha_t * tf.pow(1. - p_t, gamma) * cross_entropy
@@ -90,6 +90,8 @@ class TextboxNet(object):
 			self.params = params
 		else:
 			self.params = self.default_params
+		# Anchors of every input shape already seen.
+		self._anchors_cache = {}
 
 	# ======================================================================= #
 	def net(self, inputs,
@@ -97,9 +99,12 @@ class TextboxNet(object):
 			dropout_keep_prob=0.5,
 			reuse=None,
 			scope='text_box_300',
-			use_batch=False):
+			use_batch=False,
+			merge_heads=False,
+			recompute=False):
 		"""
-		Text network definition.
+		Text network definition. With recompute, only the outputs of the
+		conv1-conv4 VGG blocks are kept for the backward pass.
 		"""
 		r = text_net(inputs,
 					feat_layers=self.params.feat_layers,
@@ -108,6 +113,8 @@ class TextboxNet(object):
 					dropout_keep_prob=dropout_keep_prob,
 					reuse=reuse,
 					use_batch=use_batch,
+					merge_heads=merge_heads,
+					recompute=recompute,
 					scope=scope)
 
 		return r
@@ -118,16 +125,30 @@ class TextboxNet(object):
 		return ssd_arg_scope(weight_decay, data_format=data_format)
 
 
+	def feat_shapes(self, img_shape):
+		"""Shapes of the feature layers for a given input shape.
+		"""
+		if tuple(img_shape[:2]) == tuple(self.params.img_shape):
+			return self.params.feat_shapes
+		return text_net_feat_shapes(img_shape)
+
 	def anchors(self, img_shape, dtype=np.float32):
 		"""Compute the default anchor boxes, given an image shape.
+		Any input shape supported by the network is accepted: anchors keep
+		their size in pixels, and are cached per shape.
 		"""
-		return textbox_common.textbox_achor_all_layers(img_shape,
-									  self.params.feat_shapes,
+		img_shape = tuple(int(s) for s in img_shape[:2])
+		key = (img_shape, np.dtype(dtype).name)
+		if key not in self._anchors_cache:
+			self._anchors_cache[key] = textbox_common.textbox_achor_all_layers(
+									  img_shape,
+									  self.feat_shapes(img_shape),
 									  self.params.anchor_ratios,
 									  self.params.scales,
 									  self.params.anchor_sizes,
 									  0.5,
 									  dtype)
+		return self._anchors_cache[key]
 
 	def bboxes_encode(self, bboxes, anchors, num,
 					  scope='text_bboxes_encode'):
@@ -149,21 +170,51 @@ class TextboxNet(object):
 
 	def detected_bboxes(self, predictions, localisations,
 						select_threshold=None, nms_threshold=0.5,
-						clipping_bbox=None, top_k=400, keep_top_k=200):
+						clipping_bbox=None, top_k=400, keep_top_k=200,
+						layer_top_k=None, anchors=None, batched_nms=False):
 		"""Get the detected bounding boxes from the SSD network output.
+		With `layer_top_k`, only the best layer_top_k anchors of every feature
+		layer and image are sorted and go through the NMS.
+		With `anchors`, `localisations` are the raw network outputs: the
+		top_k boxes are selected first and only they are decoded.
+		With `batched_nms`, the NMS of the whole batch is vectorized
+		(tfe.bboxes_nms_batch_padded) instead of mapped image per image.
 		"""
-		# Select top_k bboxes from predictions, and clip
-		rscores, rbboxes = \
-			textbox_common.tf_ssd_bboxes_select(predictions, localisations,
-											select_threshold=select_threshold,
-											num_classes=self.params.num_classes)
-		rscores, rbboxes = \
-			tfe.bboxes_sort(rscores, rbboxes, top_k=top_k)
+		if anchors is not None:
+			rscores, rbboxes = \
+				textbox_common.tf_ssd_bboxes_select_decode(
+					predictions, localisations, anchors,
+					select_threshold=select_threshold,
+					num_classes=self.params.num_classes,
+					top_k=top_k,
+					layer_top_k=layer_top_k,
+					prior_scaling=self.params.prior_scaling)
+		else:
+			# Select top_k bboxes from predictions, and clip
+			rscores, rbboxes = \
+				textbox_common.tf_ssd_bboxes_select(predictions, localisations,
+												select_threshold=select_threshold,
+												num_classes=self.params.num_classes,
+												top_k=layer_top_k)
+			if layer_top_k:
+				# Fewer candidates than top_k after pruning small layers, or
+				# an unknown number of them: pad with zero scores.
+				for c in rscores:
+					rscores[c], rbboxes[c] = textbox_common.pad_to_top_k(
+						[rscores[c], rbboxes[c]], top_k)
+			rscores, rbboxes = \
+				tfe.bboxes_sort(rscores, rbboxes, top_k=top_k)
 		# Apply NMS algorithm.
-		rscores, rbboxes = \
-			tfe.bboxes_nms_batch(rscores, rbboxes,
-								 nms_threshold=nms_threshold,
-								 keep_top_k=keep_top_k)
+		if batched_nms:
+			rscores, rbboxes, _ = \
+				tfe.bboxes_nms_batch_padded(rscores, rbboxes,
+											nms_threshold=nms_threshold,
+											keep_top_k=keep_top_k)
+		else:
+			rscores, rbboxes = \
+				tfe.bboxes_nms_batch(rscores, rbboxes,
+									 nms_threshold=nms_threshold,
+									 keep_top_k=keep_top_k)
 		if clipping_bbox is not None:
 			rbboxes = tfe.bboxes_clip(clipping_bbox, rbboxes)
 		return rscores, rbboxes
@@ -175,8 +226,18 @@ class TextboxNet(object):
 			   use_hard_neg=False,
 			   alpha=1.,
 			   label_smoothing=0.,
+			   ohem='global',
+			   ohem_bins=256,
+			   cls_loss='softmax',
+			   focal_gamma=2.,
+			   focal_alpha=0.25,
 			   scope='text_box_loss'):
 		"""Define the SSD network losses.
+		`ohem` is the hard negative mining mode of
+		textbox_common.hard_negative_mask: 'global', 'per_image' or
+		'histogram'. `cls_loss='focal'` replaces the cross entropy and the
+		mining by a focal loss over all the anchors, normalized by the
+		number of positives.
 		"""
 		return text_losses(logits, localisations,
 						  glocalisations, gscores,
@@ -185,6 +246,11 @@ class TextboxNet(object):
 						  negative_ratio=negative_ratio,
 						  alpha=alpha,
 						  label_smoothing=label_smoothing,
+						  ohem=ohem,
+						  ohem_bins=ohem_bins,
+						  cls_loss=cls_loss,
+						  focal_gamma=focal_gamma,
+						  focal_alpha=focal_alpha,
 						  scope=scope)
 
 
@@ -196,6 +262,8 @@ def text_net(inputs,
 			dropout_keep_prob=0.5,
 			reuse=None,
 			use_batch=False,
+			merge_heads=False,
+			recompute=False,
 			scope='text_box_300'):
 	batch_norm_params = {
 	  # Decay for the moving averages.
@@ -206,20 +274,25 @@ def text_net(inputs,
 	}
 	end_points = {}
 	with tf.variable_scope(scope, 'text_box_300', [inputs], reuse=reuse):
-		# Original VGG-16 blocks.
-		net = slim.repeat(inputs, 2, slim.conv2d, 64, [3, 3], scope='conv1')
+		# Original VGG-16 blocks. With recompute, only the block outputs
+		# (end_points) of conv1-conv4 are kept for the backward pass.
+		net = custom_layers.recompute_block(
+			vgg_block(2, 64, 'conv1'), inputs, recompute)
 		end_points['conv1'] = net
 		net = slim.max_pool2d(net, [2, 2], scope='pool1')
 		# Block 2.
-		net = slim.repeat(net, 2, slim.conv2d, 128, [3, 3], scope='conv2')
+		net = custom_layers.recompute_block(
+			vgg_block(2, 128, 'conv2'), net, recompute)
 		end_points['conv2'] = net # 150,150 128
 		net = slim.max_pool2d(net, [2, 2], scope='pool2')
 		# Block 3. # 75 75 256
-		net = slim.repeat(net, 3, slim.conv2d, 256, [3, 3], scope='conv3')
+		net = custom_layers.recompute_block(
+			vgg_block(3, 256, 'conv3'), net, recompute)
 		end_points['conv3'] = net
 		net = slim.max_pool2d(net, [2, 2], scope='pool3',padding='SAME')
 		# Block 4. # 38 38 512
-		net = slim.repeat(net, 3, slim.conv2d, 512, [3, 3], scope='conv4')
+		net = custom_layers.recompute_block(
+			vgg_block(3, 512, 'conv4'), net, recompute)
 		end_points['conv4'] = net
 		#net = slim.max_pool2d(net, [2, 2],scope='pool4')
 		net = slim.max_pool2d(net, [2, 2], scope='pool4')
@@ -274,13 +347,45 @@ def text_net(inputs,
 										  end_points[layer],
 										  normalizations[i],
 										  is_training=is_training,
-										  use_batch=use_batch)
+										  use_batch=use_batch,
+										  merge_heads=merge_heads)
 			#predictions.append(prediction_fn(p))
 			logits.append(p)
 			localisations.append(l)
 
 		return localisations, logits, end_points
 
+def text_net_feat_shapes(img_shape):
+	"""
+	Shapes of the feature layers of text_net for an input shape, following
+	its strides: stride 2 'SAME' pools/convs round up, 'global' is a 3x3
+	'VALID' conv. 300x300 gives the default feat_shapes.
+	"""
+	def down(n):
+		return int(math.ceil(n / 2.))
+	shapes = []
+	for n in img_shape[:2]:
+		conv4 = down(down(down(n)))
+		conv7 = down(conv4)
+		conv8 = down(conv7)
+		conv9 = down(conv8)
+		conv10 = down(conv9)
+		shapes.append([conv4, conv7, conv8, conv9, conv10, conv10 - 2])
+	if min(shapes[0][-1], shapes[1][-1]) < 1:
+		raise ValueError('Input shape %s too small for text_box_300' % (img_shape,))
+	return list(zip(shapes[0], shapes[1]))
+
+
+def vgg_block(num_convs, num_outputs, scope):
+	"""
+	Function of a VGG block: num_convs 3x3 convolutions, scope/scope_i.
+	"""
+	def block_fn(net):
+		return slim.repeat(net, num_convs, slim.conv2d, num_outputs, [3, 3],
+						   scope=scope)
+	return block_fn
+
+
 def conv2d(inputs, out, kernel_size, scope,stride=1,activation_fn=tf.nn.relu, 
 			padding = 'SAME', use_batch=False, batch_norm_params={}, rate = 1):
 	if use_batch:
@@ -295,7 +400,8 @@ def text_multibox_layer(layer,
 					   inputs,
 					   normalization=-1,
 					   is_training=True,
-					   use_batch=False):
+					   use_batch=False,
+					   merge_heads=False):
 	"""
 	Construct a multibox layer, return a class and localization predictions.
 	The  most different between textbox and ssd is the prediction shape
@@ -303,6 +409,7 @@ def text_multibox_layer(layer,
 	and location has shape (38,38,2,6,4)
 	besise,the kernel for fisrt 5 layers is 1*5 and padding is (0,2)
 	kernel for the last layer is 1*1 and padding is 0
+	With merge_heads, both predictions come from a single convolution.
 	"""
 	batch_norm_params = {
 	  # Decay for the moving averages.
@@ -321,20 +428,10 @@ def text_multibox_layer(layer,
 	num_classes = 2
 	# Location.
 	num_loc_pred = 2*num_box * 4
-
-	if(layer == 'global'):
-		loc_pred = conv2d(net, num_loc_pred, [1, 1], activation_fn=None, padding = 'VALID',
-						   scope='conv_loc',use_batch=use_batch, batch_norm_params=batch_norm_params)
-	else:
-		loc_pred = conv2d(net, num_loc_pred, [1, 5], activation_fn=None, padding = 'SAME',
-						   scope='conv_loc',use_batch=use_batch, batch_norm_params=batch_norm_params)
-
-	loc_pred = custom_layers.channel_to_last(loc_pred)
-	loc_pred = tf.reshape(loc_pred, loc_pred.get_shape().as_list()[:-1] + [2,num_box,4])
 	# Class prediction.
 	scores_pred = 2 * num_box * num_classes
 
-	batch_norm_params = {
+	cls_batch_norm_params = {
 	  # Decay for the moving averages.
 	  'decay': 0.9997,
 	  # epsilon to prevent 0s in variance.
@@ -342,13 +439,24 @@ def text_multibox_layer(layer,
 	  'is_training': is_training,
 	}
 	if(layer == 'global'):
-		sco_pred = conv2d(net, scores_pred, [1, 1], activation_fn=None, padding = 'VALID',
-						   scope='conv_cls',use_batch=use_batch, batch_norm_params=batch_norm_params)
+		kernel_size, padding = [1, 1], 'VALID'
 	else:
-		sco_pred = conv2d(net, scores_pred, [1, 5], activation_fn=None, padding = 'SAME',
-						   scope='conv_cls',use_batch=use_batch, batch_norm_params=batch_norm_params)
+		kernel_size, padding = [1, 5], 'SAME'
 
-	sco_pred = custom_layers.channel_to_last(sco_pred)
+	if merge_heads:
+		loc_pred, sco_pred = custom_layers.merged_heads(
+			net, [num_loc_pred, scores_pred], kernel_size,
+			['conv_loc', 'conv_cls'], [use_batch, use_batch],
+			[batch_norm_params, cls_batch_norm_params], padding=padding)
+	else:
+		loc_pred = conv2d(net, num_loc_pred, kernel_size, activation_fn=None, padding = padding,
+						   scope='conv_loc',use_batch=use_batch, batch_norm_params=batch_norm_params)
+		loc_pred = custom_layers.channel_to_last(loc_pred)
+		sco_pred = conv2d(net, scores_pred, kernel_size, activation_fn=None, padding = padding,
+						   scope='conv_cls',use_batch=use_batch, batch_norm_params=cls_batch_norm_params)
+		sco_pred = custom_layers.channel_to_last(sco_pred)
+
+	loc_pred = tf.reshape(loc_pred, tensor_shape(loc_pred, 4)[:-1] + [2,num_box,4])
 	sco_pred = tf.reshape(sco_pred, tensor_shape(sco_pred, 4)[:-1] + [2,num_box,num_classes])
 	return sco_pred, loc_pred
 
@@ -377,6 +485,8 @@ def ssd_arg_scope(weight_decay=0.0005, data_format='NHWC'):
 
 	Args:
 	  weight_decay: The l2 regularization coefficient.
+	  data_format: NHWC or NCHW, layout of the network input. Predictions
+		are always returned channel last.
 
 	Returns:
 	  An arg_scope.
@@ -387,10 +497,11 @@ def ssd_arg_scope(weight_decay=0.0005, data_format='NHWC'):
 						#weights_initializer=tf.truncated_normal_initializer(stddev=0.03, seed = 1000),
 						weights_initializer=tf.contrib.layers.xavier_initializer(),
 						biases_initializer=tf.zeros_initializer()):
-		with slim.arg_scope([slim.conv2d, slim.max_pool2d],
+		with slim.arg_scope([slim.conv2d, slim.max_pool2d, slim.avg_pool2d],
 							padding='SAME',
 							data_format=data_format):
-			with slim.arg_scope([custom_layers.pad2d,
+			with slim.arg_scope([slim.batch_norm,
+								 custom_layers.pad2d,
 								 custom_layers.l2_normalization,
 								 custom_layers.channel_to_last],
 								data_format=data_format) as sc:
@@ -408,22 +519,29 @@ def text_losses(logits, localisations,
 			   negative_ratio=3.,
 			   alpha=1.,
 			   label_smoothing=0.,
+			   ohem='global',
+			   ohem_bins=256,
+			   cls_loss='softmax',
+			   focal_gamma=2.,
+			   focal_alpha=0.25,
 			   scope=None):
 	with tf.name_scope(scope, 'text_loss'):
+		# Anchors of all the layers, image per image: Batches x N.
 		alllogits = []
 		alllocalization = []
 		allglocalization = []
 		allgscores = []
 		for i in range(len(logits)):
-			alllogits.append(tf.reshape(logits[i], [-1, 2]))
-			allgscores.append(tf.reshape(gscores[i], [-1]))
-			allglocalization.append(tf.reshape(glocalisations[i], [-1,4]))
-			alllocalization.append(tf.reshape(localisations[i], [-1,4]))
+			batch_size = tfe.get_shape(logits[i])[0]
+			alllogits.append(tf.reshape(logits[i], [batch_size, -1, 2]))
+			allgscores.append(tf.reshape(gscores[i], [batch_size, -1]))
+			allglocalization.append(tf.reshape(glocalisations[i], [batch_size, -1,4]))
+			alllocalization.append(tf.reshape(localisations[i], [batch_size, -1,4]))
 
-		alllogits = tf.concat(alllogits, 0)
-		allgscores = tf.concat(allgscores, 0)
-		alllocalization =tf.concat(alllocalization, 0)
-		allglocalization =tf.concat(allglocalization, 0)
+		alllogits = tf.concat(alllogits, 1)
+		allgscores = tf.concat(allgscores, 1)
+		alllocalization =tf.concat(alllocalization, 1)
+		allglocalization =tf.concat(allglocalization, 1)
 
 		pmask = allgscores > match_threshold
 		ipmask = tf.cast(pmask ,tf.int32)
@@ -435,30 +553,42 @@ def text_losses(logits, localisations,
 		inmask = tf.cast(nmask, tf.int32)
 		fnmask = tf.cast(nmask, tf.float32)
 
-		loss = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=alllogits,labels=ipmask)
-		l_cross_pos = tf.losses.compute_weighted_loss(loss, fpmask)
+		if cls_loss == 'focal':
+			# All the anchors, weighted: no mining, no sort.
+			loss = textbox_common.focal_loss(alllogits, ipmask,
+											 gamma=focal_gamma,
+											 alpha=focal_alpha)
+			n_norm = tf.maximum(tf.reduce_sum(fpmask), 1.)
+			l_cross_pos = tf.reduce_sum(loss * fpmask) / n_norm
+			l_cross_neg = tf.reduce_sum(loss * fnmask) / n_norm
+			# model_deploy sums the LOSSES collection of every clone.
+			tf.losses.add_loss(l_cross_pos)
+			tf.losses.add_loss(l_cross_neg)
+			n_neg = tf.reduce_sum(inmask)
+		else:
+			loss = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=alllogits,labels=ipmask)
+			l_cross_pos = tf.losses.compute_weighted_loss(loss, fpmask)
 
 
-		#loss = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=alllogits,labels=ipmask)
-		#l_cross_all_neg = tf.losses.compute_weighted_loss(loss, fnmask)
-		#l_cross_neg = tf.reduce_sum(loss * fnmask)/tf.cast(n_neg, tf.float32)
-		#l_cross_pos = tf.reduce_sum(loss * fpmask)/tf.cast(n_pos, tf.float32)
-		#loss = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=alllogits,labels=ipmask)
+			#loss = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=alllogits,labels=ipmask)
+			#l_cross_all_neg = tf.losses.compute_weighted_loss(loss, fnmask)
+			#l_cross_neg = tf.reduce_sum(loss * fnmask)/tf.cast(n_neg, tf.float32)
+			#l_cross_pos = tf.reduce_sum(loss * fpmask)/tf.cast(n_pos, tf.float32)
+			#loss = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=alllogits,labels=ipmask)
 
-		
-		loss_neg = tf.where(pmask,
-						   tf.cast(tf.zeros_like(ipmask),tf.float32),
-						   loss)
-		loss_neg_flat = tf.reshape(loss_neg, [-1])
-		n_neg = tf.minimum(3*n_pos, tf.cast(n,tf.int32))
-		val, idxes = tf.nn.top_k(loss_neg_flat, k=n_neg)
-		minval = val[-1]
-		nmask = tf.logical_and(nmask, loss_neg >= minval)
+			
+			loss_neg = tf.where(pmask,
+							   tf.cast(tf.zeros_like(ipmask),tf.float32),
+							   loss)
+			nmask = textbox_common.hard_negative_mask(loss_neg, nmask, pmask,
+													  negative_ratio=negative_ratio,
+													  mode=ohem,
+													  num_bins=ohem_bins)
 
-		fnmask = tf.cast(nmask, tf.float32)
-		l_cross_neg = tf.losses.compute_weighted_loss(loss, fnmask)
+			fnmask = tf.cast(nmask, tf.float32)
+			l_cross_neg = tf.losses.compute_weighted_loss(loss, fnmask)
 
-		n_neg = tf.reduce_sum(tf.cast(nmask, tf.int32))
+			n_neg = tf.reduce_sum(tf.cast(nmask, tf.int32))
 
 		#l_cross_neg = l_cross_all_neg + l_cross_neg
 
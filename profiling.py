@@ -0,0 +1,140 @@
+"""
+Periodic full-trace profiling of the training and evaluation steps.
+
+Every `every_n_steps` steps, one step runs with a full trace. Its RunMetadata
+is dumped to --profile_dir as:
+  timeline_<step>.json : Chrome trace (chrome://tracing, Perfetto);
+  profile_<step>.txt   : op time aggregated by the name scopes of PROFILE_SCOPES
+                         (innermost scope of the op, its gradients included,
+                         'other' otherwise) and the top ops by time.
+Profiler wraps the slim.learning.train step function of the training scripts,
+ProfileHook is a SessionRunHook for slim.evaluation.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import os
+
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+import step_timing
+
+slim = tf.contrib.slim
+
+# Name scopes of our own code the op times are attributed to.
+PROFILE_SCOPES = ('text_bboxes_encode', 'text_loss', 'ssd_bboxes_select',
+                  'ssd_bboxes_decode', 'bboxes_sort', 'bboxes_nms_batch',
+                  'bboxes_matching_batch', 'gradient_accumulation')
+
+
+def scope_of(op_name, scopes=PROFILE_SCOPES):
+    """Innermost scope of `scopes` an op belongs to, 'other' if none.
+    Uniquified scopes (text_loss_1, bboxes_nms_batch_padded, ...) match too.
+    """
+    for name in reversed(op_name.split('/')[:-1]):
+        for scope in scopes:
+            if name == scope or name.startswith(scope + '_'):
+                return scope
+    return 'other'
+
+
+def profile_table(stats, scopes=PROFILE_SCOPES, top_n=20):
+    """Text table of the op times of a traced step, by scope and by op.
+
+    Args:
+      stats: List of (op name, op type, device, ms), see step_timing.node_stats.
+    """
+    total = sum(s[3] for s in stats) or 1.
+    by_scope = collections.defaultdict(lambda: [0., 0])
+    for name, _, _, duration in stats:
+        entry = by_scope[scope_of(name, scopes)]
+        entry[0] += duration
+        entry[1] += 1
+    lines = ['%-24s %12s %7s %8s' % ('scope', 'time (ms)', '%', 'ops')]
+    for scope, (duration, count) in sorted(by_scope.items(),
+                                           key=lambda x: -x[1][0]):
+        lines.append('%-24s %12.2f %6.1f%% %8d' % (
+            scope, duration, 100. * duration / total, count))
+    lines.append('')
+    lines.append('%-60s %-24s %-22s %10s' % ('op', 'type', 'scope', 'time (ms)'))
+    for name, op_type, _, duration in sorted(stats, key=lambda s: -s[3])[:top_n]:
+        lines.append('%-60s %-24s %-22s %10.2f' % (
+            name[-60:], op_type, scope_of(name, scopes), duration))
+    return '\n'.join(lines)
+
+
+def write_profile(run_metadata, graph, profile_dir, step,
+                  scopes=PROFILE_SCOPES, top_n=20):
+    """Write the Chrome trace and the op time table of a traced run.
+    """
+    tf.gfile.MakeDirs(profile_dir)
+    trace = timeline.Timeline(run_metadata.step_stats, graph=graph)
+    with tf.gfile.GFile(os.path.join(profile_dir,
+                                     'timeline_%d.json' % step), 'w') as f:
+        f.write(trace.generate_chrome_trace_format())
+    table = profile_table(step_timing.node_stats(run_metadata.step_stats, graph),
+                          scopes, top_n)
+    with tf.gfile.GFile(os.path.join(profile_dir,
+                                     'profile_%d.txt' % step), 'w') as f:
+        f.write(table + '\n')
+    tf.logging.info('Profile of step %d written to %s' % (step, profile_dir))
+    return table
+
+
+class Profiler(object):
+    """slim.learning.train step function profiling a step every
+    `every_n_steps` runs of the wrapped step function.
+    """
+
+    def __init__(self, profile_dir, every_n_steps, train_step_fn=None,
+                 scopes=PROFILE_SCOPES, top_n=20):
+        self._profile_dir = profile_dir
+        self._every_n_steps = every_n_steps
+        self._train_step_fn = train_step_fn or slim.learning.train_step
+        self._scopes = scopes
+        self._top_n = top_n
+        self._num_steps = 0
+
+    def __call__(self, sess, train_op, global_step, train_step_kwargs):
+        self._num_steps += 1
+        if self._num_steps % self._every_n_steps:
+            return self._train_step_fn(sess, train_op, global_step,
+                                       train_step_kwargs)
+        run_metadata = tf.RunMetadata()
+        total_loss, should_stop = self._train_step_fn(
+            step_timing.TracedSession(sess, train_op, run_metadata),
+            train_op, global_step, train_step_kwargs)
+        write_profile(run_metadata, sess.graph, self._profile_dir,
+                      sess.run(global_step), self._scopes, self._top_n)
+        return total_loss, should_stop
+
+
+class ProfileHook(tf.train.SessionRunHook):
+    """SessionRunHook profiling a run every `every_n_steps` runs, e.g. the
+    evaluation batches of slim.evaluation.
+    """
+
+    def __init__(self, profile_dir, every_n_steps, scopes=PROFILE_SCOPES,
+                 top_n=20):
+        self._profile_dir = profile_dir
+        self._every_n_steps = every_n_steps
+        self._scopes = scopes
+        self._top_n = top_n
+        self._num_steps = 0
+
+    def before_run(self, run_context):
+        self._num_steps += 1
+        if self._num_steps % self._every_n_steps:
+            return None
+        return tf.train.SessionRunArgs(
+            None, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE))
+
+    def after_run(self, run_context, run_values):
+        if self._num_steps % self._every_n_steps:
+            return
+        write_profile(run_values.run_metadata, run_context.session.graph,
+                      self._profile_dir, self._num_steps, self._scopes,
+                      self._top_n)
@@ -0,0 +1,275 @@
+"""
+Step time breakdown of the training loop.
+
+StepTimer is a slim.learning.train step function which wraps the step
+function actually used (slim.learning.train_step or the gradient
+accumulation one) and splits the step time into:
+  dequeue          : time blocked in the input queues dequeues;
+  forward_backward : network, loss and gradients;
+  apply            : optimizer update, moving averages;
+  summary          : summary op run and event write;
+  checkpoint       : checkpoint save.
+The wall time of every step is measured; one step every
+`trace_every_n_steps` runs with a full trace, whose op timings give the split
+of the wall time between dequeue, forward_backward and apply. Summaries and
+checkpoints are run by the timer itself, between two steps, instead of the
+Supervisor threads (run slim.learning.train with save_summaries_secs=0 and
+save_interval_secs=0). The fill ratio of every bounded input queue is
+sampled too.
+
+Every `log_every_n_steps`, the means over the last `window` steps are written
+as TensorBoard scalars (step_time/*, queue_fill/*) and appended to
+<logdir>/step_time.log.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.ops import gen_data_flow_ops
+
+slim = tf.contrib.slim
+
+QUEUE_TYPES = ('FIFOQueue', 'FIFOQueueV2', 'PaddingFIFOQueue',
+               'PaddingFIFOQueueV2', 'RandomShuffleQueue',
+               'RandomShuffleQueueV2', 'PriorityQueue', 'PriorityQueueV2')
+PHASES = ('dequeue', 'forward_backward', 'apply')
+
+
+def op_phase(op_type):
+    """Phase of the training step an op type belongs to.
+    """
+    if op_type.startswith('QueueDequeue'):
+        return 'dequeue'
+    if (op_type.startswith('Apply') or op_type.startswith('ResourceApply') or
+            op_type.startswith('SparseApply') or
+            op_type.startswith('ResourceSparseApply') or
+            op_type in ('Assign', 'AssignAdd', 'AssignSub',
+                        'AssignVariableOp', 'AssignAddVariableOp',
+                        'AssignSubVariableOp')):
+        return 'apply'
+    return 'forward_backward'
+
+
+def node_stats(step_stats, graph):
+    """List of (op name, op type, device, duration in ms) of a traced run.
+    GPU kernels are taken from the 'stream:all' timeline, the other streams
+    repeat them.
+    """
+    stats = []
+    for dev_stats in step_stats.dev_stats:
+        device = dev_stats.device
+        if '/stream:' in device and not device.endswith('/stream:all'):
+            continue
+        if '/memcpy' in device:
+            continue
+        for node in dev_stats.node_stats:
+            name = node.node_name.split(':')[0]
+            try:
+                op_type = graph.get_operation_by_name(name).type
+            except KeyError:
+                # _SOURCE, RecvTensor, ...
+                op_type = node.timeline_label.split('(')[0].split('=')[-1].strip()
+            duration = (node.all_end_rel_micros or
+                        node.op_end_rel_micros) / 1000.
+            stats.append((name, op_type, device, duration))
+    return stats
+
+
+def phase_split(stats, wall_ms):
+    """Split the wall time of a traced step between the phases.
+
+    The dequeues block the whole step: their longest op is the input wait.
+    The rest is shared between the other phases in proportion of their op
+    times (ops of a phase run in parallel, their sum exceeds the wall time).
+    """
+    times = dict((phase, 0.) for phase in PHASES)
+    dequeue = 0.
+    for _, op_type, _, duration in stats:
+        phase = op_phase(op_type)
+        if phase == 'dequeue':
+            dequeue = max(dequeue, duration)
+        else:
+            times[phase] += duration
+    dequeue = min(dequeue, wall_ms)
+    rest = wall_ms - dequeue
+    total = times['forward_backward'] + times['apply']
+    split = {'dequeue': dequeue}
+    for phase in ('forward_backward', 'apply'):
+        split[phase] = rest * times[phase] / total if total > 0 else 0.
+    return split
+
+
+def queue_fill_tensors(graph=None):
+    """{queue name: size / capacity Tensor} of the bounded queues of a graph.
+    Build before the graph is finalized.
+    """
+    graph = graph or tf.get_default_graph()
+    fills = {}
+    for op in graph.get_operations():
+        if op.type not in QUEUE_TYPES:
+            continue
+        capacity = op.get_attr('capacity')
+        if capacity <= 0:
+            continue
+        with tf.device(op.device), tf.name_scope('queue_fill'):
+            if op.type.endswith('V2'):
+                size = gen_data_flow_ops.queue_size_v2(op.outputs[0])
+            else:
+                size = gen_data_flow_ops.queue_size(op.outputs[0])
+            fills[op.name] = tf.cast(size, tf.float32) / float(capacity)
+    return fills
+
+
+class TracedSession(object):
+    """Session proxy adding a full trace to the run of `train_op` only.
+    """
+
+    def __init__(self, sess, train_op, run_metadata):
+        self._sess = sess
+        self._train_op = train_op
+        self._run_metadata = run_metadata
+
+    def _fetches_train_op(self, fetches):
+        if isinstance(fetches, (list, tuple)):
+            return any(f is self._train_op for f in fetches)
+        return fetches is self._train_op
+
+    def run(self, fetches, feed_dict=None, options=None, run_metadata=None):
+        if not self._fetches_train_op(fetches):
+            return self._sess.run(fetches, feed_dict=feed_dict,
+                                  options=options, run_metadata=run_metadata)
+        outputs = self._sess.run(
+            fetches, feed_dict=feed_dict,
+            options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+            run_metadata=self._run_metadata)
+        # Nested proxies: the inner one gets the trace too.
+        if run_metadata is not None:
+            run_metadata.CopyFrom(self._run_metadata)
+        return outputs
+
+    def __getattr__(self, name):
+        return getattr(self._sess, name)
+
+
+class StepTimer(object):
+    """slim.learning.train step function measuring the step time breakdown.
+
+    Args:
+      logdir: Directory of the events and of step_time.log.
+      train_step_fn: Step function wrapped, slim.learning.train_step by default.
+      summary_op, saver: Summaries and checkpoints run between two steps, every
+        save_summaries_secs / save_interval_secs (0 or None to disable).
+      trace_every_n_steps: A step every n runs with a full trace.
+      log_every_n_steps: Period of the scalars and of the text log.
+      window: Number of steps the means are computed over.
+    """
+
+    def __init__(self, logdir, train_step_fn=None, summary_op=None, saver=None,
+                 save_summaries_secs=0, save_interval_secs=0,
+                 trace_every_n_steps=50, log_every_n_steps=100, window=100):
+        self._logdir = logdir
+        self._train_step_fn = train_step_fn or slim.learning.train_step
+        self._summary_op = summary_op
+        self._saver = saver
+        self._save_summaries_secs = save_summaries_secs
+        self._save_interval_secs = save_interval_secs
+        self._trace_every_n_steps = trace_every_n_steps
+        self._log_every_n_steps = log_every_n_steps
+        self._fills = queue_fill_tensors()
+        self._writer = tf.summary.FileWriterCache.get(logdir)
+        self._log_path = os.path.join(logdir, 'step_time.log')
+        self._step_times = collections.deque(maxlen=window)
+        self._splits = collections.deque(maxlen=max(1, window //
+                                                    max(trace_every_n_steps, 1)))
+        self._summary_times = collections.deque(maxlen=window)
+        self._checkpoint_times = collections.deque(maxlen=window)
+        self._num_steps = 0
+        self._last_summary = time.time()
+        self._last_save = time.time()
+
+    def _timed(self, fn, times):
+        start = time.time()
+        fn()
+        times.append(1000. * (time.time() - start))
+
+    def _write_summary(self, sess, global_step):
+        summary, step = sess.run([self._summary_op, global_step])
+        self._writer.add_summary(summary, step)
+
+    def _save(self, sess, global_step):
+        self._saver.save(sess, os.path.join(self._logdir, 'model.ckpt'),
+                         global_step=global_step)
+
+    def breakdown(self):
+        """Mean times of the window, in ms per step.
+        """
+        times = {'step': np.mean(self._step_times) if self._step_times else 0.}
+        if self._splits:
+            # Fractions of the traced steps, applied to the untraced steps.
+            walls = np.array([sum(s.values()) for s in self._splits])
+            for phase in PHASES:
+                fraction = np.mean(np.array([s[phase] for s in self._splits]) /
+                                   np.maximum(walls, 1e-6))
+                times[phase] = fraction * times['step']
+        for name, values in [('summary', self._summary_times),
+                             ('checkpoint', self._checkpoint_times)]:
+            times[name] = np.mean(values) if values else 0.
+        return times
+
+    def _log(self, sess, step):
+        times = self.breakdown()
+        fills = sess.run(self._fills) if self._fills else {}
+        values = [tf.Summary.Value(tag='step_time/%s_ms' % name,
+                                   simple_value=value)
+                  for name, value in sorted(times.items())]
+        values += [tf.Summary.Value(tag='queue_fill/%s' % name,
+                                    simple_value=value)
+                   for name, value in sorted(fills.items())]
+        self._writer.add_summary(tf.Summary(value=values), step)
+        line = 'step %d: %.1f ms/step (dequeue %.1f, forward_backward %.1f, ' \
+            'apply %.1f), summary %.1f ms, checkpoint %.1f ms | queues %s' % (
+                step, times['step'], times.get('dequeue', 0.),
+                times.get('forward_backward', 0.), times.get('apply', 0.),
+                times['summary'], times['checkpoint'],
+                ' '.join('%s=%.2f' % item for item in sorted(fills.items())))
+        tf.logging.info(line)
+        with open(self._log_path, 'a') as f:
+            f.write(line + '\n')
+
+    def __call__(self, sess, train_op, global_step, train_step_kwargs):
+        self._num_steps += 1
+        traced = (self._trace_every_n_steps and
+                  self._num_steps % self._trace_every_n_steps == 0)
+        run_metadata = tf.RunMetadata() if traced else None
+        run_sess = (TracedSession(sess, train_op, run_metadata) if traced
+                    else sess)
+        start = time.time()
+        total_loss, should_stop = self._train_step_fn(
+            run_sess, train_op, global_step, train_step_kwargs)
+        wall_ms = 1000. * (time.time() - start)
+        if traced:
+            self._splits.append(phase_split(
+                node_stats(run_metadata.step_stats, sess.graph), wall_ms))
+        else:
+            self._step_times.append(wall_ms)
+
+        now = time.time()
+        if self._summary_op is not None and self._save_summaries_secs and (
+                should_stop or now - self._last_summary >= self._save_summaries_secs):
+            self._timed(lambda: self._write_summary(sess, global_step),
+                        self._summary_times)
+            self._last_summary = now
+        if self._saver is not None and self._save_interval_secs and (
+                now - self._last_save >= self._save_interval_secs):
+            self._timed(lambda: self._save(sess, global_step),
+                        self._checkpoint_times)
+            self._last_save = now
+        if self._num_steps % self._log_every_n_steps == 0 or should_stop:
+            self._log(sess, sess.run(global_step))
+        return total_loss, should_stop
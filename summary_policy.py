@@ -0,0 +1,175 @@
+"""
+Summary policy of the training scripts.
+
+The summaries are split into three categories by op type, scalars,
+histograms and images, each written every n global steps (0 to disable).
+Instead of the Supervisor thread running the whole summary op on a new batch
+every save_summaries_secs, the summaries due at a step are fetched in the
+same session.run as the train op: they only cost their own computation and
+serialization. Histograms can be capped to a random sample of their values.
+
+A policy is a preset name, optionally followed by overrides:
+  production
+  standard,histograms=5000,histogram_samples=1000
+Keys: scalars, histograms, images (periods in steps) and histogram_samples
+(maximum number of values per histogram, 0 for all).
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import tensorflow as tf
+
+slim = tf.contrib.slim
+
+CATEGORIES = ('scalars', 'histograms', 'images')
+SUMMARY_TYPES = {'ScalarSummary': 'scalars',
+                 'HistogramSummary': 'histograms',
+                 'ImageSummary': 'images'}
+PRESETS = {
+    # Everything, often: short debugging runs.
+    'debug': dict(scalars=10, histograms=100, images=100,
+                  histogram_samples=0),
+    'standard': dict(scalars=100, histograms=1000, images=1000,
+                     histogram_samples=10000),
+    # Losses and learning rate only: long runs on many clones.
+    'production': dict(scalars=200, histograms=0, images=0,
+                       histogram_samples=1000),
+}
+
+
+def parse_policy(spec):
+    """Policy dict of a 'preset[,key=value...]' string, None for ''.
+    """
+    if not spec:
+        return None
+    items = spec.split(',')
+    if items[0] not in PRESETS:
+        raise ValueError('Unknown summary preset %s, expected one of %s' % (
+            items[0], ', '.join(sorted(PRESETS))))
+    policy = dict(PRESETS[items[0]])
+    for item in items[1:]:
+        key, _, value = item.partition('=')
+        if key not in policy:
+            raise ValueError('Unknown summary policy key %s' % key)
+        policy[key] = int(value)
+    return policy
+
+
+def enabled(policy, category):
+    """Whether the summaries of a category are built; all of them without
+    policy.
+    """
+    return policy is None or policy[category] > 0
+
+
+def histogram(name, values, max_samples=0):
+    """Histogram summary of at most `max_samples` values, drawn uniformly
+    (with replacement), 0 for all the values.
+    """
+    with tf.name_scope('sampled_histogram'):
+        values = tf.reshape(values, [-1])
+        size = values.get_shape()[0].value
+        if max_samples and (size is None or size > max_samples):
+            indices = tf.random_uniform([max_samples], maxval=tf.size(values),
+                                        dtype=tf.int32)
+            values = tf.gather(values, indices)
+    return tf.summary.histogram(name, values)
+
+
+def image(name, images, data_format='NHWC', max_outputs=2):
+    """Image summary of the first images of a batch.
+    """
+    if data_format == 'NCHW':
+        images = tf.transpose(images, perm=(0, 2, 3, 1))
+    return tf.summary.image(name, images, max_outputs=max_outputs)
+
+
+def split_summaries(summaries):
+    """{category: summary ops} of a list of summary ops. Other summary types
+    go with the scalars.
+    """
+    categories = dict((category, []) for category in CATEGORIES)
+    for summary in summaries:
+        categories[SUMMARY_TYPES.get(summary.op.type, 'scalars')].append(summary)
+    return categories
+
+
+class _SummarySession(object):
+    """Session proxy adding summary ops to the fetches of the run of
+    `train_op`.
+    """
+
+    def __init__(self, sess, train_op, summary_ops):
+        self._sess = sess
+        self._train_op = train_op
+        self._summary_ops = summary_ops
+        self.summaries = []
+
+    def run(self, fetches, feed_dict=None, options=None, run_metadata=None):
+        is_list = isinstance(fetches, (list, tuple))
+        fetch_list = list(fetches) if is_list else [fetches]
+        if not any(f is self._train_op for f in fetch_list):
+            return self._sess.run(fetches, feed_dict=feed_dict,
+                                  options=options, run_metadata=run_metadata)
+        # Flat fetches, so that the train op is still seen by nested proxies.
+        outputs = self._sess.run(fetch_list + self._summary_ops,
+                                 feed_dict=feed_dict, options=options,
+                                 run_metadata=run_metadata)
+        self.summaries = outputs[len(fetch_list):]
+        outputs = outputs[:len(fetch_list)]
+        return outputs if is_list else outputs[0]
+
+    def __getattr__(self, name):
+        return getattr(self._sess, name)
+
+
+class SummaryPolicy(object):
+    """slim.learning.train step function writing the summaries of a policy
+    with the train op runs. Run slim.learning.train with summary_op=None.
+
+    Args:
+      logdir: Directory of the events.
+      summaries: Summary ops, split by category.
+      policy: Policy dict, see parse_policy.
+      train_step_fn: Step function wrapped, slim.learning.train_step by default.
+      steps_per_run: Global steps of one train op run.
+    """
+
+    def __init__(self, logdir, summaries, policy, train_step_fn=None,
+                 steps_per_run=1):
+        self._writer = tf.summary.FileWriterCache.get(logdir)
+        self._train_step_fn = train_step_fn or slim.learning.train_step
+        self._steps_per_run = steps_per_run
+        self._periods = {}
+        self._merged = {}
+        for category, ops in sorted(split_summaries(summaries).items()):
+            if ops and policy[category] > 0:
+                self._periods[category] = policy[category]
+                self._merged[category] = tf.summary.merge(
+                    ops, name='%s_summary_op' % category)
+        self._step = None
+
+    def _due(self):
+        # A multiple of the period is crossed by this run.
+        end = self._step + self._steps_per_run
+        return [category for category, period in sorted(self._periods.items())
+                if end // period > self._step // period]
+
+    def __call__(self, sess, train_op, global_step, train_step_kwargs):
+        if self._step is None:
+            self._step = sess.run(global_step)
+        due = self._due()
+        if not due:
+            self._step += self._steps_per_run
+            return self._train_step_fn(sess, train_op, global_step,
+                                       train_step_kwargs)
+        summary_sess = _SummarySession(sess, train_op,
+                                       [self._merged[c] for c in due])
+        total_loss, should_stop = self._train_step_fn(
+            summary_sess, train_op, global_step, train_step_kwargs)
+        # Other workers move the global step too.
+        self._step = sess.run(global_step)
+        for summary in summary_sess.summaries:
+            self._writer.add_summary(summary, self._step)
+        return total_loss, should_stop
@@ -229,6 +229,115 @@ def bboxes_nms_batch(scores, bboxes, nms_threshold=0.5, keep_top_k=200,
         return scores, bboxes
 
 
+def _jaccard_matrix(bboxes):
+    """Batch x N x N jaccard between all the pairs of boxes of every image,
+    with the conventions of tf.image.non_max_suppression: corners in any
+    order and a zero jaccard for empty boxes.
+    """
+    ymin = tf.minimum(bboxes[:, :, 0], bboxes[:, :, 2])
+    xmin = tf.minimum(bboxes[:, :, 1], bboxes[:, :, 3])
+    ymax = tf.maximum(bboxes[:, :, 0], bboxes[:, :, 2])
+    xmax = tf.maximum(bboxes[:, :, 1], bboxes[:, :, 3])
+    vol = (ymax - ymin) * (xmax - xmin)
+    int_h = tf.maximum(tf.minimum(ymax[:, :, None], ymax[:, None, :]) -
+                       tf.maximum(ymin[:, :, None], ymin[:, None, :]), 0.)
+    int_w = tf.maximum(tf.minimum(xmax[:, :, None], xmax[:, None, :]) -
+                       tf.maximum(xmin[:, :, None], xmin[:, None, :]), 0.)
+    inter_vol = int_h * int_w
+    union_vol = vol[:, :, None] + vol[:, None, :] - inter_vol
+    valid = tf.logical_and(vol[:, :, None] > 0., vol[:, None, :] > 0.)
+    return tf.where(valid, inter_vol / tf.where(valid, union_vol,
+                                                tf.ones_like(union_vol)),
+                    tf.zeros_like(inter_vol))
+
+
+def bboxes_nms_batch_padded(scores, bboxes, nms_threshold=0.5, keep_top_k=200,
+                            scope=None):
+    """Vectorized non-maximum selection of a batch of padded inputs.
+
+    Same results, image per image, as bboxes_nms_batch, without a loop over
+    the batch: the jaccard matrix of every image is computed at once, and the
+    greedy selection is the fixed point of
+        keep[i] = no kept box before i overlaps i above nms_threshold,
+    reached after at most N (usually a few) vectorized iterations.
+
+    Args:
+      scores: Batch x N Tensor/Dictionary containing float scores.
+      bboxes: Batch x N x 4 Tensor/Dictionary containing boxes coordinates.
+      nms_threshold: Matching threshold in NMS algorithm;
+      keep_top_k: Number of total object to keep after NMS.
+    Return:
+      scores, bboxes, num_valid: Batch x keep_top_k | x 4 Tensors/Dictionaries
+        sorted by score and padded with zero, and the Batch number of boxes
+        kept with a positive score per image.
+    """
+    # Dictionaries as inputs.
+    if isinstance(scores, dict) or isinstance(bboxes, dict):
+        with tf.name_scope(scope, 'bboxes_nms_batch_padded_dict'):
+            d_scores = {}
+            d_bboxes = {}
+            d_num_valid = {}
+            for c in scores.keys():
+                s, b, n = bboxes_nms_batch_padded(scores[c], bboxes[c],
+                                                  nms_threshold=nms_threshold,
+                                                  keep_top_k=keep_top_k)
+                d_scores[c] = s
+                d_bboxes[c] = b
+                d_num_valid[c] = n
+            return d_scores, d_bboxes, d_num_valid
+
+    # Tensors inputs.
+    with tf.name_scope(scope, 'bboxes_nms_batch_padded', [scores, bboxes]):
+        # Enough candidates to fill keep_top_k.
+        num = tfe_tensors.get_shape(scores, 2)[1]
+        if isinstance(num, int):
+            pad = max(keep_top_k - num, 0)
+        else:
+            pad = tf.maximum(keep_top_k - num, 0)
+        scores = tf.pad(scores, [[0, 0], [0, pad]])
+        bboxes = tf.pad(bboxes, [[0, 0], [0, pad], [0, 0]])
+        shape = tfe_tensors.get_shape(scores, 2)
+        # Sort by decreasing score: rank order is index order.
+        scores, idxes = tf.nn.top_k(scores, k=shape[1], sorted=True)
+        offsets = tf.range(shape[0]) * shape[1]
+        idxes = idxes + tf.expand_dims(offsets, 1)
+        bboxes = tf.gather(tf.reshape(bboxes, [-1, 4]), idxes)
+
+        # suppress[b, i, j]: box j, before i, overlaps i.
+        jaccard = _jaccard_matrix(bboxes)
+        rank = tf.range(shape[1])
+        before = tf.less(tf.expand_dims(rank, 0), tf.expand_dims(rank, 1))
+        suppress = tf.logical_and(jaccard > nms_threshold,
+                                  tf.expand_dims(before, 0))
+        suppress = tf.cast(suppress, scores.dtype)
+
+        def condition(i, keep, changed):
+            return tf.logical_and(changed, i < shape[1])
+
+        def body(i, keep, changed):
+            overlaps = tf.squeeze(
+                tf.matmul(suppress, tf.expand_dims(keep, -1)), axis=-1)
+            new_keep = tf.cast(tf.equal(overlaps, 0.), keep.dtype)
+            changed = tf.reduce_any(tf.not_equal(new_keep, keep))
+            return i + 1, new_keep, changed
+
+        keep = tf.ones_like(scores)
+        _, keep, _ = tf.while_loop(condition, body,
+                                   [0, keep, tf.constant(True)],
+                                   back_prop=False)
+
+        # Kept boxes first, in rank order, then the suppressed ones.
+        key = keep * tf.cast(shape[1] - rank, scores.dtype)
+        key, idxes = tf.nn.top_k(key, k=keep_top_k, sorted=True)
+        valid = tf.cast(key > 0., scores.dtype)
+        idxes = idxes + tf.expand_dims(offsets, 1)
+        scores = tf.gather(tf.reshape(scores, [-1]), idxes) * valid
+        bboxes = tf.gather(tf.reshape(bboxes, [-1, 4]), idxes) * \
+            tf.expand_dims(valid, -1)
+        num_valid = tf.reduce_sum(tf.cast(scores > 0., tf.int32), axis=1)
+        return scores, bboxes, num_valid
+
+
 # def bboxes_fast_nms(classes, scores, bboxes,
 #                     nms_threshold=0.5, eta=3., num_classes=21,
 #                     pad_output=True, scope=None):
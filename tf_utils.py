@@ -17,7 +17,9 @@
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
+import contextlib
 import os
+import time
 from pprint import pprint
 
 import tensorflow as tf
@@ -101,7 +103,10 @@ def configure_learning_rate(flags, num_samples_per_epoch, global_step):
     Returns:
       A `Tensor` representing the learning rate.
     """
-    decay_steps = int(num_samples_per_epoch / flags.batch_size *
+    # With gradient accumulation, a global step consumes accumulate_steps
+    # batches.
+    batch_size = flags.batch_size * getattr(flags, 'accumulate_steps', 1)
+    decay_steps = int(num_samples_per_epoch / batch_size *
                       flags.num_epochs_per_decay)
 
     if flags.learning_rate_decay_type == 'exponential':
@@ -257,6 +262,175 @@ def get_variables_to_train(flags):
     return variables_to_train
 
 
+def accumulate_gradients(optimizer, grads_and_vars, accumulate_steps,
+                         global_step=None, update_ops=None):
+    """Gradient accumulation over `accumulate_steps` micro-steps.
+
+    Gradients are summed into local (not checkpointed) accumulators; the
+    last micro-step applies their average once and resets them, so
+    `global_step` and the learning rate schedule count effective steps.
+
+    Args:
+      optimizer: Optimizer applying the averaged gradients.
+      grads_and_vars: List of (gradient, variable) of compute_gradients.
+      accumulate_steps: Number of micro-steps per effective step.
+      global_step: Incremented by the apply op only.
+      update_ops: Ops to run on every micro-step, e.g. the batch norm updates
+        of the micro-batch.
+    Returns:
+      accumulate_op: micro-step, adds the gradients to the accumulators;
+      apply_op: last micro-step, adds the gradients, applies the average and
+        zeroes the accumulators.
+    """
+    grads_and_vars = [(g, v) for g, v in grads_and_vars if g is not None]
+    update_ops = list(update_ops or [])
+    accumulators = []
+    with tf.name_scope('gradient_accumulation'):
+        for _, var in grads_and_vars:
+            accumulators.append(tf.Variable(
+                tf.zeros(var.get_shape(), dtype=var.dtype.base_dtype),
+                trainable=False,
+                collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                name=var.op.name.replace('/', '_') + '_accumulator'))
+
+        with tf.control_dependencies(update_ops):
+            accumulate_op = tf.group(
+                *[acc.assign_add(g) for acc, (g, _) in
+                  zip(accumulators, grads_and_vars)],
+                name='accumulate')
+
+        # The last micro-step uses the values returned by assign_add, so the
+        # average always holds its own gradients.
+        with tf.control_dependencies(update_ops):
+            averages = [acc.assign_add(g) / float(accumulate_steps)
+                        for acc, (g, _) in zip(accumulators, grads_and_vars)]
+        grad_updates = optimizer.apply_gradients(
+            zip(averages, [v for _, v in grads_and_vars]),
+            global_step=global_step)
+        with tf.control_dependencies([grad_updates]):
+            apply_op = tf.group(
+                *[acc.assign(tf.zeros_like(acc)) for acc in accumulators],
+                name='apply')
+    return accumulate_op, apply_op
+
+
+def accumulate_train_step_fn(accumulate_op, accumulate_steps):
+    """slim.learning.train step function running `accumulate_steps - 1`
+    accumulation micro-steps before the default train step, which runs the
+    apply op.
+    """
+    def train_step_fn(sess, train_op, global_step, train_step_kwargs):
+        for _ in range(accumulate_steps - 1):
+            sess.run(accumulate_op)
+        return slim.learning.train_step(sess, train_op, global_step,
+                                        train_step_kwargs)
+    return train_step_fn
+
+
+def l2_regularization_loss(weight_decay):
+    """L2 regularization loss of the variables regularized by the network
+    arg_scope (slim.l2_regularizer(weight_decay)), computed again from the
+    variables. Inside a tf.while_loop, the REGULARIZATION_LOSSES tensors
+    built outside would be loop invariants, evaluated once per run.
+    """
+    names = set(loss.op.name.split('/Regularizer/')[0] for loss in
+                tf.get_collection(tf.GraphKeys.REGULARIZATION_LOSSES))
+    variables = [v for v in tf.global_variables() if v.op.name in names]
+    return tf.add_n([weight_decay * tf.nn.l2_loss(v) for v in variables],
+                    name='regularization_loss')
+
+
+def moving_average_updates(variable_averages, variables, global_step, decay):
+    """Update ops of the existing moving averages of `variables`, as
+    ExponentialMovingAverage(decay, global_step).apply(variables) does, for
+    use inside a tf.while_loop where apply() cannot create its variables.
+    """
+    step = tf.cast(global_step, tf.float32)
+    decay = tf.minimum(decay, (1. + step) / (10. + step))
+    updates = []
+    for var in variables:
+        average = variable_averages.average(var)
+        updates.append(tf.assign_sub(average, (average - var) * (1. - decay)))
+    return tf.group(*updates)
+
+
+@contextlib.contextmanager
+def loop_collections(keys=(tf.GraphKeys.LOSSES, tf.GraphKeys.UPDATE_OPS,
+                           tf.GraphKeys.SUMMARIES, 'EXTRA_LOSSES')):
+    """Give the model built inside a tf.while_loop empty collections: its
+    losses and update ops do not mix with the ones of the model built
+    outside, and the outer collections are restored on exit.
+    """
+    saved = {}
+    for key in keys:
+        collection = tf.get_collection_ref(key)
+        saved[key] = list(collection)
+        del collection[:]
+    try:
+        yield
+    finally:
+        for key in keys:
+            tf.get_collection_ref(key)[:] = saved[key]
+
+
+def multi_step_train_op(step_fn, steps_per_run, global_step,
+                        max_number_of_steps=None, name='train_op'):
+    """In-graph training loop: up to `steps_per_run` training steps in a
+    single session.run.
+
+    Args:
+      step_fn: Function building one training step (dequeue, model, loss,
+        update ops) and returning its loss, with control dependencies on the
+        updates. It is called inside the loop, after the variables and the
+        optimizer slots were created outside.
+      steps_per_run: Number of steps of one run.
+      global_step: Incremented by the steps, stops the loop at
+        `max_number_of_steps`.
+    Returns:
+      Loss of the last step of the run.
+    """
+    def cond(i, loss):
+        keep_going = i < steps_per_run
+        if max_number_of_steps:
+            keep_going = tf.logical_and(
+                keep_going, tf.identity(global_step) < max_number_of_steps)
+        return keep_going
+
+    def body(i, loss):
+        return i + 1, step_fn()
+
+    _, loss = tf.while_loop(cond, body, [tf.constant(0), tf.constant(0.)],
+                            parallel_iterations=1, back_prop=False)
+    return tf.identity(loss, name=name)
+
+
+def boundary_train_step_fn(logdir, summary_op, saver, save_summaries_secs,
+                           save_interval_secs):
+    """slim.learning.train step function writing the summaries and the
+    checkpoints itself, between two runs of a multi-step train op, instead
+    of the Supervisor threads running them concurrently with the loop. Run
+    slim.learning.train with save_summaries_secs=0 and save_interval_secs=0.
+    """
+    writer = tf.summary.FileWriterCache.get(logdir)
+    last = {'summary': time.time(), 'save': time.time()}
+
+    def train_step_fn(sess, train_op, global_step, train_step_kwargs):
+        total_loss, should_stop = slim.learning.train_step(
+            sess, train_op, global_step, train_step_kwargs)
+        now = time.time()
+        if summary_op is not None and (
+                should_stop or now - last['summary'] >= save_summaries_secs):
+            summary, step = sess.run([summary_op, global_step])
+            writer.add_summary(summary, step)
+            last['summary'] = now
+        if now - last['save'] >= save_interval_secs:
+            saver.save(sess, os.path.join(logdir, 'model.ckpt'),
+                       global_step=global_step)
+            last['save'] = now
+        return total_loss, should_stop
+    return train_step_fn
+
+
 # =========================================================================== #
 # Evaluation utils.
 # =========================================================================== #